@@ -0,0 +1,395 @@
+"""
+A small in-process S3 stand-in for the benchmarks.
+
+Implements the part of the S3 REST API used by the commands (path style
+bucket/key requests): bucket listing, HEAD/GET/PUT/DELETE of keys, canned
+ACLs, server-side copies, multi-object deletes and multipart uploads.
+Every request can be delayed by a fixed latency and request bodies are
+read at a limited bandwidth.  The requests are counted by operation.
+
+Only the digest and size of large objects are kept, so pushing huge
+files doesn't hold them in memory.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import re
+import time
+import email.Utils
+import hashlib
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from xml.sax.saxutils import escape
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+# objects up to this size keep their content (the svn config yaml is read back)
+MAX_STORED_SIZE = 1024 * 1024
+
+# the request headers stored with the objects (lower case)
+STORED_HEADERS = ('content-type', 'content-encoding', 'cache-control', 'expires',
+                  'content-disposition', 'x-amz-storage-class',)
+
+# bucket listing page size
+MAX_KEYS = 1000
+
+
+class FakeObject(object):
+    """
+    A stored key: size, ETag, headers and (for small objects) the content.
+    """
+    def __init__(self, size, etag, headers, data=None):
+        self.size = size
+        self.etag = etag
+        self.headers = headers
+        self.data = data
+        self.last_modified = time.time()
+
+
+class FakeS3(object):
+    """
+    The fake S3 storage and the request counters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+        self.requests = {}
+        self.bytes_received = 0
+
+    def count(self, operation, received=0):
+        self.lock.acquire()
+        try:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.bytes_received += received
+        finally:
+            self.lock.release()
+
+    def reset_counters(self):
+        self.lock.acquire()
+        try:
+            self.requests = {}
+            self.bytes_received = 0
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.buckets = {}
+            self.uploads = {}
+        finally:
+            self.lock.release()
+        self.reset_counters()
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the S3 REST requests.  Authentication is not checked.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def parse(self):
+        """
+        Splits the request path into the bucket, key and query arguments.
+        """
+        url = urlparse.urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = urllib.unquote(parts[0])
+        key = len(parts) > 1 and urllib.unquote(parts[1]) or ''
+        query = dict([ (name, values[0]) for name, values in \
+                        urlparse.parse_qs(url.query, keep_blank_values=True).items() ])
+        return bucket, key, query
+
+    def read_body(self):
+        """
+        Reads the request body at the configured bandwidth.  Returns the
+        (md5, size, data) of the body, data is None for large bodies.
+        """
+        if self.headers.get('Expect', '').lower() == '100-continue':
+            self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+
+        length = int(self.headers.get('Content-Length') or 0)
+        md5 = hashlib.md5()
+        chunks = []
+        remaining = length
+        started = time.time()
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            md5.update(chunk)
+            if length <= MAX_STORED_SIZE:
+                chunks.append(chunk)
+            if self.server.bandwidth:
+                # hold the connection until the bytes would have arrived
+                expected = float(length - remaining) / self.server.bandwidth
+                delay = expected - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+        data = length <= MAX_STORED_SIZE and ''.join(chunks) or None
+        return md5.hexdigest(), length, data
+
+    def respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body and 'content-type' not in [ name.lower() for name in (headers or {}) ]:
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+            '<Error><Code>%s</Code><Message>%s</Message></Error>' % (code, code)
+        self.respond(status, body)
+
+    def delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def object_headers(self, obj):
+        headers = {
+            'ETag': '"%s"' % obj.etag,
+            'Last-Modified': email.Utils.formatdate(obj.last_modified, usegmt=True),
+        }
+        headers.update(obj.headers)
+        return headers
+
+    def do_HEAD(self):
+        self.delay()
+        bucket, key, query = self.parse()
+        self.fake.count('HEAD')
+        if bucket not in self.fake.buckets:
+            return self.respond(404)
+        if not key:
+            return self.respond(200)
+        obj = self.fake.buckets[bucket].get(key)
+        if obj is None:
+            return self.respond(404)
+        headers = self.object_headers(obj)
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(obj.size))
+        self.end_headers()
+
+    def do_GET(self):
+        self.delay()
+        bucket, key, query = self.parse()
+        if bucket not in self.fake.buckets:
+            self.fake.count('GET')
+            return self.error(404, 'NoSuchBucket')
+        if not key:
+            self.fake.count('LIST')
+            return self.list_bucket(bucket, query)
+        self.fake.count('GET')
+        obj = self.fake.buckets[bucket].get(key)
+        if obj is None:
+            return self.error(404, 'NoSuchKey')
+        headers = self.object_headers(obj)
+        headers.setdefault('content-type', 'binary/octet-stream')
+        self.respond(200, obj.data or '', headers)
+
+    def list_bucket(self, bucket, query):
+        prefix = query.get('prefix', '')
+        marker = query.get('marker', '')
+        max_keys = min(int(query.get('max-keys') or MAX_KEYS), MAX_KEYS)
+
+        names = sorted([ name for name in self.fake.buckets[bucket].keys() \
+                            if name.startswith(prefix) and name > marker ])
+        truncated = len(names) > max_keys
+        names = names[:max_keys]
+
+        contents = []
+        for name in names:
+            obj = self.fake.buckets[bucket][name]
+            contents.append('<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                '<ETag>"%s"</ETag><Size>%d</Size><StorageClass>STANDARD</StorageClass>'
+                '</Contents>' % (escape(name), time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                    time.gmtime(obj.last_modified)), obj.etag, obj.size))
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+            '<ListBucketResult xmlns="%s"><Name>%s</Name><Prefix>%s</Prefix>' \
+            '<Marker>%s</Marker><MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>%s' \
+            '</ListBucketResult>' % (S3_NS, escape(bucket), escape(prefix), escape(marker),
+                max_keys, truncated and 'true' or 'false', ''.join(contents))
+        self.respond(200, body)
+
+    def do_PUT(self):
+        self.delay()
+        bucket, key, query = self.parse()
+        etag, size, data = self.read_body()
+
+        if not key:
+            self.fake.count('PUT_BUCKET')
+            self.fake.buckets.setdefault(bucket, {})
+            return self.respond(200)
+        if bucket not in self.fake.buckets:
+            self.fake.count('PUT')
+            return self.error(404, 'NoSuchBucket')
+        if 'acl' in query:
+            self.fake.count('PUT_ACL')
+            return self.respond(200)
+        if 'partNumber' in query:
+            self.fake.count('PUT_PART', size)
+            upload = self.fake.uploads.get(query.get('uploadId'))
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            upload['parts'][int(query['partNumber'])] = (etag, size,)
+            return self.respond(200, '', {'ETag': '"%s"' % etag})
+
+        headers = self.stored_headers()
+        copy_source = self.headers.get('x-amz-copy-source')
+        if copy_source:
+            self.fake.count('COPY')
+            source_bucket, source_key = urllib.unquote(copy_source).lstrip('/').split('/', 1)
+            source = self.fake.buckets.get(source_bucket, {}).get(source_key)
+            if source is None:
+                return self.error(404, 'NoSuchKey')
+            if self.headers.get('x-amz-metadata-directive', '').upper() != 'REPLACE':
+                headers = source.headers
+            obj = FakeObject(source.size, source.etag, headers, source.data)
+            self.fake.buckets[bucket][key] = obj
+            body = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                '<CopyObjectResult><LastModified>%s</LastModified><ETag>"%s"</ETag>' \
+                '</CopyObjectResult>' % (time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                    time.gmtime(obj.last_modified)), obj.etag)
+            return self.respond(200, body)
+
+        self.fake.count('PUT', size)
+        self.fake.buckets[bucket][key] = FakeObject(size, etag, headers, data)
+        self.respond(200, '', {'ETag': '"%s"' % etag})
+
+    def stored_headers(self):
+        """
+        The request headers kept with the object (content and metadata).
+        """
+        headers = {}
+        for name in self.headers.keys():
+            if name.startswith('x-amz-meta-') or name in STORED_HEADERS:
+                headers[name] = self.headers[name]
+        return headers
+
+    def do_POST(self):
+        self.delay()
+        bucket, key, query = self.parse()
+        etag, size, data = self.read_body()
+        if bucket not in self.fake.buckets:
+            self.fake.count('POST')
+            return self.error(404, 'NoSuchBucket')
+
+        if 'delete' in query:
+            self.fake.count('DELETE_MULTI')
+            deleted = []
+            for name in re.findall(r'<Key>(.*?)</Key>', data or ''):
+                name = name.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+                self.fake.buckets[bucket].pop(name, None)
+                deleted.append('<Deleted><Key>%s</Key></Deleted>' % escape(name))
+            body = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                '<DeleteResult xmlns="%s">%s</DeleteResult>' % (S3_NS, ''.join(deleted))
+            return self.respond(200, body)
+
+        if 'uploads' in query:
+            self.fake.count('INIT_MULTIPART')
+            upload_id = hashlib.md5('%s/%s/%s' % (bucket, key, time.time())).hexdigest()
+            self.fake.uploads[upload_id] = dict(headers=self.stored_headers(), parts={})
+            body = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                '<InitiateMultipartUploadResult xmlns="%s"><Bucket>%s</Bucket><Key>%s</Key>' \
+                '<UploadId>%s</UploadId></InitiateMultipartUploadResult>' % (
+                    S3_NS, escape(bucket), escape(key), upload_id)
+            return self.respond(200, body)
+
+        if 'uploadId' in query:
+            self.fake.count('COMPLETE_MULTIPART')
+            upload = self.fake.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            parts = [ upload['parts'][num] for num in sorted(upload['parts'].keys()) ]
+            md5 = hashlib.md5(''.join([ part_etag.decode('hex') for part_etag, part_size in parts ]))
+            etag = '%s-%d' % (md5.hexdigest(), len(parts))
+            self.fake.buckets[bucket][key] = FakeObject(sum([ p[1] for p in parts ]), etag,
+                                                        upload['headers'])
+            body = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                '<CompleteMultipartUploadResult xmlns="%s"><Bucket>%s</Bucket><Key>%s</Key>' \
+                '<ETag>"%s"</ETag></CompleteMultipartUploadResult>' % (
+                    S3_NS, escape(bucket), escape(key), etag)
+            return self.respond(200, body)
+
+        self.fake.count('POST')
+        self.error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        self.delay()
+        bucket, key, query = self.parse()
+        if 'uploadId' in query:
+            self.fake.count('ABORT_MULTIPART')
+            self.fake.uploads.pop(query['uploadId'], None)
+            return self.respond(204)
+        self.fake.count('DELETE')
+        if bucket in self.fake.buckets:
+            self.fake.buckets[bucket].pop(key, None)
+        self.respond(204)
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    The threaded fake S3 server.  latency is in seconds per request,
+    bandwidth in bytes per second per connection (0 for unlimited).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, bandwidth=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeS3Handler)
+        self.fake = FakeS3()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
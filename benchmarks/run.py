@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+"""
+Runs the s3-push, s3-svnsync and s3-gitsync commands end to end against the local fake
+S3 server and reports the throughput, request counts and peak memory.
+
+Usage (from a checkout with Django and boto installed):
+
+    python benchmarks/run.py --shapes=tiny,mixed --engines=processes,threads \\
+        --workers=2,8 --latency=0.02 --bandwidth=10485760
+
+Each command runs in its own Django project (a temporary settings module
+pointing AWS_S3_HOST/AWS_S3_PORT at the fake server).  The peak RSS is the largest
+sampled sum of the command and all of its worker processes (read from /proc).  The s3-svnsync benchmark
+needs pysvn and the svn/svnadmin binaries, the s3-gitsync benchmark the git
+binary, they are skipped otherwise.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+from distutils.spawn import find_executable
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fakes3 import FakeS3Server
+from trees import SHAPES, generate_tree, modify_tree
+
+BUCKET_NAME = 'benchmark'
+
+# the seconds between the RSS samples of the running command
+RSS_INTERVAL = 0.05
+
+SETTINGS = """
+SECRET_KEY = 'benchmark'
+DATABASE_ENGINE = 'sqlite3'
+DATABASE_NAME = ':memory:'
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+INSTALLED_APPS = ('pamazons3',)
+MEDIA_ROOT = %(media_root)r
+AWS_ACCESS_KEY_ID = 'benchmark'
+AWS_SECRET_ACCESS_KEY = 'benchmark'
+AWS_BUCKET_NAME = %(bucket)r
+AWS_S3_HOST = '127.0.0.1'
+AWS_S3_PORT = %(port)d
+AWS_S3_SECURE = False
+"""
+
+MANAGE = """
+import os
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench_settings')
+from django.core.management import execute_from_command_line
+execute_from_command_line()
+"""
+
+
+class BenchmarkProject(object):
+    """
+    A temporary Django project with the pamazons3 app installed and its
+    settings pointed at the fake server.
+    """
+    def __init__(self, path, port):
+        self.path = path
+        self.port = port
+        os.symlink(APP_DIR, os.path.join(path, 'pamazons3'))
+        open(os.path.join(path, 'manage.py'), 'w').write(MANAGE)
+
+    def configure(self, media_root):
+        filename = os.path.join(self.path, 'bench_settings.py')
+        open(filename, 'w').write(SETTINGS % dict(media_root=media_root,
+                                                  bucket=BUCKET_NAME, port=self.port))
+        # remove the stale byte code, the settings may be rewritten within a second
+        if os.path.exists(filename + 'c'):
+            os.remove(filename + 'c')
+
+    def run(self, command, args, log):
+        """
+        Runs the management command and returns the exit status, the
+        elapsed seconds and the peak RSS in kilobytes of the command and
+        its worker processes together, sampled while the command runs.
+        Without /proc the largest single process RSS is returned.
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([ self.path, env.get('PYTHONPATH', '') ])
+        env['DJANGO_SETTINGS_MODULE'] = 'bench_settings'
+        start = time.time()
+        proc = subprocess.Popen([ sys.executable, os.path.join(self.path, 'manage.py'),
+                                  command ] + args, cwd=self.path, env=env,
+                                stdout=log, stderr=subprocess.STDOUT)
+        peak_rss = 0
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            peak_rss = max(peak_rss, get_tree_rss(proc.pid))
+            time.sleep(RSS_INTERVAL)
+        proc.returncode = status
+        elapsed = time.time() - start
+        # ru_maxrss of the child includes the largest of its waited children
+        return os.WEXITSTATUS(status), elapsed, peak_rss or rusage.ru_maxrss
+
+
+def get_process_tree(pid):
+    """
+    Returns the pid and the pids of all of the descendants of the process.
+    """
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue
+        # the command name may contain spaces, the parent pid follows the state
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    pids = [ pid ]
+    for pid in pids:
+        pids.extend(children.get(pid, ()))
+    return pids
+
+
+def get_tree_rss(pid):
+    """
+    Returns the summed RSS in kilobytes of the process and its descendants,
+    0 without /proc.
+    """
+    if not os.path.isdir('/proc'):
+        return 0
+    rss = 0
+    for tree_pid in get_process_tree(pid):
+        try:
+            for line in open('/proc/%d/status' % tree_pid):
+                if line.startswith('VmRSS:'):
+                    rss += int(line.split()[1])
+                    break
+        except IOError:
+            continue
+    return rss
+
+
+def svn_available():
+    if not (find_executable('svn') and find_executable('svnadmin')):
+        return False
+    return subprocess.call([ sys.executable, '-c', 'import pysvn' ],
+                           stderr=open(os.devnull, 'w')) == 0
+
+
+def svn(*args):
+    subprocess.check_call(('svn',) + args, stdout=open(os.devnull, 'w'))
+
+
+def create_working_copy(path, tree):
+    """
+    Imports the tree into a new file:// repository and returns the path
+    of its working copy.
+    """
+    repo = os.path.join(path, 'repo')
+    working_copy = os.path.join(path, 'wc')
+    subprocess.check_call([ 'svnadmin', 'create', repo ])
+    url = 'file://%s/media' % repo
+    svn('import', '-q', '-m', 'benchmark', tree, url)
+    svn('checkout', '-q', url, working_copy)
+    return working_copy
+
+
+def git_available():
+    return bool(find_executable('git'))
+
+
+def git(path, *args):
+    subprocess.check_call(('git',) + args, cwd=path, stdout=open(os.devnull, 'w'))
+
+
+def create_git_repo(path, tree):
+    """
+    Commits a copy of the tree into a new git repository and returns the
+    path of the media directory in its working tree.
+    """
+    media = os.path.join(path, 'media')
+    shutil.copytree(tree, media)
+    git(path, 'init', '-q')
+    git(path, 'add', '-A')
+    git(path, '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost',
+        'commit', '-q', '-m', 'benchmark')
+    return media
+
+
+def make_result(shape, command, run, engine, workers, files, size, server, status, elapsed, rss):
+    fake = server.fake
+    return dict(shape=shape, command=command, run=run, engine=engine, workers=workers,
+                files=files, bytes=size, status=status, seconds=round(elapsed, 3),
+                files_per_sec=round(files / max(elapsed, 0.001), 1),
+                mb_per_sec=round(size / 1048576.0 / max(elapsed, 0.001), 2),
+                requests=sum(fake.requests.values()), request_counts=dict(fake.requests),
+                bytes_received=fake.bytes_received, peak_rss_mb=round(rss / 1024.0, 1))
+
+
+def check_synced(result, server):
+    """
+    Fails the result of a modified run that didn't send the changes, the
+    benchmark would time a no-op.
+    """
+    if not result['status'] and not server.fake.bytes_received:
+        print '%(command)s found no changes in the modified run' % result
+        result['status'] = 1
+
+
+def print_result(result):
+    print '%(shape)-6s %(command)-11s %(run)-8s %(engine)-9s %(workers)3d  %(files)6d files ' \
+          '%(seconds)8.2fs %(files_per_sec)9.1f files/s %(mb_per_sec)8.2f MB/s ' \
+          '%(requests)7d requests %(peak_rss_mb)7.1f MB rss' % result,
+    if result['status']:
+        print ' FAILED (%d)' % result['status']
+    else:
+        print
+    if result['request_counts']:
+        print '    ' + ', '.join([ '%s=%d' % i for i in sorted(result['request_counts'].items()) ])
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--shapes', default=','.join(SHAPES),
+                      help='Comma separated tree shapes (%s)' % ', '.join(SHAPES))
+    parser.add_option('--scale', type='float', default=0.1,
+                      help='Tree size multiplier')
+    parser.add_option('--engines', default='processes,threads',
+                      help='Comma separated upload engines')
+    parser.add_option('--workers', default='2,8',
+                      help='Comma separated upload worker counts')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Fake server latency per request in seconds')
+    parser.add_option('--bandwidth', type='int', default=0,
+                      help='Fake server bandwidth per connection in bytes/s (0 is unlimited)')
+    parser.add_option('--gzip', action='store_true', default=False,
+                      help='Pass --gzip to the commands')
+    parser.add_option('--no-svnsync', action='store_false', dest='svnsync', default=True,
+                      help='Skip the s3-svnsync benchmark')
+    parser.add_option('--no-gitsync', action='store_false', dest='gitsync', default=True,
+                      help='Skip the s3-gitsync benchmark')
+    parser.add_option('--json', dest='json_file',
+                      help='Write the results to the JSON file')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help='Keep the temporary directory (and the command logs)')
+    options, args = parser.parse_args()
+
+    shapes = [ s for s in options.shapes.split(',') if s ]
+    engines = [ e for e in options.engines.split(',') if e ]
+    worker_counts = [ int(w) for w in options.workers.split(',') if w ]
+    do_svnsync = options.svnsync and svn_available()
+    if options.svnsync and not do_svnsync:
+        print 'pysvn or the svn binaries are not available, skipping s3-svnsync'
+    do_gitsync = options.gitsync and git_available()
+    if options.gitsync and not do_gitsync:
+        print 'the git binary is not available, skipping s3-gitsync'
+
+    work_dir = tempfile.mkdtemp(prefix='pamazons3-bench-')
+    server = FakeS3Server(latency=options.latency, bandwidth=options.bandwidth).start()
+    results = []
+    try:
+        project_dir = os.path.join(work_dir, 'project')
+        os.mkdir(project_dir)
+        project = BenchmarkProject(project_dir, server.port)
+        log = open(os.path.join(work_dir, 'commands.log'), 'a')
+        extra_args = [ '--gzip' ] if options.gzip else []
+
+        for shape in shapes:
+            tree = os.path.join(work_dir, shape)
+            os.mkdir(tree)
+            files, size = generate_tree(tree, shape, options.scale)
+            print 'generated %s tree: %d files, %.1f MB' % (shape, files, size / 1048576.0)
+
+            for engine in engines:
+                for workers in worker_counts:
+                    args = [ '--engine=%s' % engine, '--workers=%d' % workers ] + extra_args
+
+                    # initial push into an empty bucket, then a push of the unchanged tree
+                    project.configure(tree)
+                    server.fake.reset()
+                    for run in ('initial', 'noop',):
+                        server.fake.reset_counters()
+                        status, elapsed, rss = project.run('s3-push', args, log)
+                        result = make_result(shape, 's3-push', run, engine, workers, files,
+                                             run == 'initial' and size or 0, server,
+                                             status, elapsed, rss)
+                        print_result(result)
+                        results.append(result)
+
+                    if do_gitsync:
+                        # a sync of the whole tree, then a sync of the modified files
+                        git_dir = tempfile.mkdtemp(dir=work_dir)
+                        media = create_git_repo(git_dir, tree)
+                        project.configure(media)
+                        server.fake.reset()
+                        status, elapsed, rss = project.run('s3-gitsync', args, log)
+                        result = make_result(shape, 's3-gitsync', 'initial', engine, workers,
+                                             files, size, server, status, elapsed, rss)
+                        print_result(result)
+                        results.append(result)
+
+                        modified = modify_tree(media)
+                        assert modified, 'no files were modified'
+                        git(git_dir, 'add', '-A')
+                        git(git_dir, '-c', 'user.name=benchmark', '-c',
+                            'user.email=benchmark@localhost', 'commit', '-q', '-m', 'benchmark')
+                        server.fake.reset_counters()
+                        status, elapsed, rss = project.run('s3-gitsync', args, log)
+                        result = make_result(shape, 's3-gitsync', 'modified', engine, workers,
+                                             len(modified), sum([ os.path.getsize(f) for f in modified ]),
+                                             server, status, elapsed, rss)
+                        check_synced(result, server)
+                        print_result(result)
+                        results.append(result)
+                        shutil.rmtree(git_dir)
+
+                    if not do_svnsync:
+                        continue
+
+                    # a full sync of the working copy, then a sync of modified files
+                    svn_dir = tempfile.mkdtemp(dir=work_dir)
+                    working_copy = create_working_copy(svn_dir, tree)
+                    project.configure(working_copy)
+                    server.fake.reset()
+                    status, elapsed, rss = project.run('s3-svnsync', args, log)
+                    result = make_result(shape, 's3-svnsync', 'initial', engine, workers,
+                                         files, size, server, status, elapsed, rss)
+                    print_result(result)
+                    results.append(result)
+
+                    modified = modify_tree(working_copy)
+                    assert modified, 'no files were modified'
+                    svn('commit', '-q', '-m', 'benchmark', working_copy)
+                    # the working copy revision is the one s3-svnsync syncs to
+                    svn('update', '-q', working_copy)
+                    server.fake.reset_counters()
+                    status, elapsed, rss = project.run('s3-svnsync', args, log)
+                    result = make_result(shape, 's3-svnsync', 'modified', engine, workers,
+                                         len(modified), sum([ os.path.getsize(f) for f in modified ]),
+                                         server, status, elapsed, rss)
+                    check_synced(result, server)
+                    print_result(result)
+                    results.append(result)
+                    shutil.rmtree(svn_dir)
+
+            shutil.rmtree(tree)
+        log.close()
+    finally:
+        server.stop()
+        if options.keep:
+            print 'benchmark files kept in %s' % work_dir
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if options.json_file:
+        json.dump(results, open(options.json_file, 'w'), indent=2)
+
+    if [ r for r in results if r['status'] ]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
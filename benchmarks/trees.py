@@ -0,0 +1,152 @@
+"""
+Synthetic media trees for the benchmarks.
+
+The shapes cover the cases the commands have to handle well:
+
+- tiny: many small files spread over a few directories
+- huge: a few very large files (multipart uploads)
+- deep: a deeply nested directory structure
+- mixed: a typical media root, gzip eligible CSS/Javascript next to images
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import os
+import random
+
+SHAPES = ('tiny', 'huge', 'deep', 'mixed',)
+
+# compressible text used for the CSS/Javascript files
+TEXT = "body { margin: 0; padding: 0; } /* %d */\nfunction f%d(a, b) { return a + b; }\n"
+
+# size of the random blocks written to the binary files
+BLOCK_SIZE = 1024 * 1024
+
+
+def write_text(filename, size, seed):
+    """
+    Writes a compressible text file of about the given size.
+    """
+    lines = []
+    written = 0
+    num = 0
+    while written < size:
+        line = TEXT % (seed, num)
+        lines.append(line)
+        written += len(line)
+        num += 1
+    open(filename, 'wb').write(''.join(lines)[:size])
+
+
+def write_binary(filename, size):
+    """
+    Writes an incompressible (random) file of the given size.
+    """
+    file_obj = open(filename, 'wb')
+    try:
+        block = os.urandom(min(size, BLOCK_SIZE))
+        remaining = size
+        while remaining > 0:
+            file_obj.write(block[:remaining])
+            remaining -= len(block)
+    finally:
+        file_obj.close()
+
+
+def make_dir(root, *parts):
+    path = os.path.join(root, *parts)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def generate_tree(root, shape, scale=1.0, seed=0):
+    """
+    Generates the tree shape under root.  The scale multiplies the file
+    counts (tiny, deep, mixed) or sizes (huge).  Returns the number of
+    files and total bytes written.
+    """
+    rand = random.Random(seed)
+    files = []
+
+    if shape == 'tiny':
+        for num in xrange(int(5000 * scale)):
+            path = make_dir(root, 'dir%02d' % (num % 50))
+            filename = os.path.join(path, 'file%05d.txt' % num)
+            write_text(filename, rand.randint(100, 4096), num)
+            files.append(filename)
+
+    elif shape == 'huge':
+        path = make_dir(root, 'video')
+        for num in xrange(3):
+            filename = os.path.join(path, 'clip%d.mp4' % num)
+            write_binary(filename, int(200 * 1024 * 1024 * scale))
+            files.append(filename)
+
+    elif shape == 'deep':
+        for num in xrange(int(2000 * scale)):
+            parts = [ 'level%d-%d' % (depth, (num >> depth) % 2) for depth in xrange(12) ]
+            path = make_dir(root, *parts)
+            filename = os.path.join(path, 'file%05d.txt' % num)
+            write_text(filename, rand.randint(100, 2048), num)
+            files.append(filename)
+
+    elif shape == 'mixed':
+        for num in xrange(int(1000 * scale)):
+            kind = num % 4
+            if kind == 0:
+                filename = os.path.join(make_dir(root, 'css'), 'style%04d.css' % num)
+                write_text(filename, rand.randint(2 * 1024, 64 * 1024), num)
+            elif kind == 1:
+                filename = os.path.join(make_dir(root, 'js'), 'script%04d.js' % num)
+                write_text(filename, rand.randint(2 * 1024, 256 * 1024), num)
+            elif kind == 2:
+                filename = os.path.join(make_dir(root, 'img', 'set%02d' % (num % 20)),
+                                        'image%04d.png' % num)
+                write_binary(filename, rand.randint(10 * 1024, 512 * 1024))
+            else:
+                filename = os.path.join(make_dir(root, 'html'), 'page%04d.html' % num)
+                write_text(filename, rand.randint(512, 16 * 1024), num)
+            files.append(filename)
+
+    else:
+        raise ValueError("Unknown tree shape: %s" % shape)
+
+    return len(files), sum([ os.path.getsize(f) for f in files ])
+
+
+def modify_tree(root, fraction=0.1, seed=1):
+    """
+    Appends to a fraction of the files in the tree.  Returns the list of
+    modified filenames.
+    """
+    rand = random.Random(seed)
+    modified = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if '.svn' in dirnames:
+            dirnames.remove('.svn')
+        for name in filenames:
+            if rand.random() < fraction:
+                filename = os.path.join(dirpath, name)
+                open(filename, 'ab').write('\n/* modified */\n')
+                modified.append(filename)
+    return modified
@@ -0,0 +1,139 @@
+"""
+Compression cache for the S3 commands.
+
+Stores the gzip/brotli outputs on disk keyed by the content digest of the
+source file and the compression settings.  Pushing the same content again,
+to another prefix or bucket or after a failed run, reuses the compressed
+bytes instead of compressing the file again.  The cache is kept under its
+size limit by removing the least recently used entries.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import os
+import errno
+import hashlib
+import tempfile
+import time
+
+# the seconds after which a temporary file is left over from a crashed run,
+# the younger ones may still be written by a running compression
+TEMP_MAX_AGE = 24 * 60 * 60
+
+
+class CompressionCache(object):
+    """
+    The on-disk cache of compressed file contents.  Entries are stored as
+    <path>/<xx>/<sha1 of digest, encoding and level>.  The entry mtime is
+    updated on every hit and is used as the LRU order for the eviction.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def get_filename(self, digest, encoding, level):
+        name = hashlib.sha1('%s:%s:%s' % (digest, encoding, level)).hexdigest()
+        return os.path.join(self.path, name[:2], name)
+
+    def lookup(self, digest, encoding, level):
+        """
+        Returns the cached filename of the compressed content or None.
+        """
+        filename = self.get_filename(digest, encoding, level)
+        try:
+            os.utime(filename, None)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return filename
+
+    def temp_filename(self):
+        """
+        Returns a new temporary file in the cache directory.  Storing the
+        temporary file is a rename on the same filesystem.
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, filename = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        os.close(fd)
+        return filename
+
+    def store(self, digest, encoding, level, temp_filename):
+        """
+        Moves the compressed temporary file into the cache and returns the
+        cached filename.
+        """
+        filename = self.get_filename(digest, encoding, level)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        os.rename(temp_filename, filename)
+        return filename
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is under
+        its size limit.  The temporary files of the running compressions
+        (of any run sharing the cache) are kept, the stale ones are
+        removed.  Returns the number of removed entries.
+        """
+        entries = []
+        total_size = 0
+        stale_time = time.time() - TEMP_MAX_AGE
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                filename = os.path.join(root, name)
+                try:
+                    file_stat = os.stat(filename)
+                except OSError:
+                    continue
+                if name.endswith('.tmp'):
+                    if file_stat.st_mtime < stale_time:
+                        try:
+                            os.remove(filename)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((file_stat.st_mtime, file_stat.st_size, filename,))
+                total_size += file_stat.st_size
+
+        removed = 0
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total_size -= size
+            removed += 1
+        return removed
@@ -0,0 +1,181 @@
+"""
+Adaptive request concurrency for the S3 commands.
+
+The ConcurrencyLimiter bounds the number of S3 requests in flight across
+all of the worker processes and threads.  The limit is grown by one while
+the request throughput keeps rising and is halved when S3 throttles the
+requests (503 SlowDown) or a request times out (AIMD).  The failed
+requests are retried with a jittered exponential backoff.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import time
+import random
+import socket
+import httplib
+
+from multiprocessing import Condition, Value
+
+import boto.exception
+
+# the S3 error codes and statuses of throttled requests
+THROTTLE_CODES = ('SlowDown', 'Throttling', 'RequestLimitExceeded', 'ServiceUnavailable',)
+THROTTLE_STATUSES = (503,)
+
+# the server errors worth retrying
+RETRY_CODES = ('RequestTimeout', 'InternalError', 'RequestTimeTooSkewed',)
+RETRY_STATUSES = (500, 502, 503, 504,)
+
+# the backoff of the first retry and the longest backoff (seconds)
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+
+# seconds between the throughput measurements of the limiter
+WINDOW = 1.0
+
+# the throughput drop (fraction of the last window) undoing the last increase
+DROP_THRESHOLD = 0.9
+
+# seconds a waiting request rechecks the limit
+WAIT_TIMEOUT = 1.0
+
+
+def is_timeout_error(e):
+    return isinstance(e, socket.timeout) or \
+        (isinstance(e, boto.exception.BotoServerError) and e.error_code == 'RequestTimeout')
+
+
+def is_throttle_error(e):
+    """
+    Returns True if the error means S3 is asking for fewer requests.
+    Timeouts are handled the same way.
+    """
+    if isinstance(e, boto.exception.BotoServerError):
+        if e.status in THROTTLE_STATUSES or e.error_code in THROTTLE_CODES:
+            return True
+    return is_timeout_error(e)
+
+
+def is_retryable_error(e):
+    """
+    Returns True if the failed request can be sent again.
+    """
+    if isinstance(e, boto.exception.BotoServerError):
+        return e.status in RETRY_STATUSES or e.error_code in THROTTLE_CODES + RETRY_CODES
+    return isinstance(e, (socket.error, httplib.HTTPException,))
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    The jittered exponential backoff (full jitter) of the given retry.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class ConcurrencyLimiter(object):
+    """
+    The AIMD limit of the S3 requests in flight.  The state is kept in
+    shared memory so the limiter created in the command process is shared
+    by the forked worker processes (and the worker threads).
+    """
+    def __init__(self, initial, maximum, minimum=1, window=WINDOW):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.window = window
+        self.condition = Condition()
+
+        now = time.time()
+        self.limit = Value('i', min(max(initial, self.minimum), self.maximum), lock=False)
+        self.in_flight = Value('i', 0, lock=False)
+        self.saturated = Value('i', 0, lock=False)
+        self.increased = Value('i', 0, lock=False)
+        self.window_start = Value('d', now, lock=False)
+        self.window_count = Value('i', 0, lock=False)
+        self.last_rate = Value('d', 0.0, lock=False)
+        self.last_decrease = Value('d', 0.0, lock=False)
+
+    def acquire(self):
+        """
+        Waits until another request can be sent.
+        """
+        self.condition.acquire()
+        try:
+            while self.in_flight.value >= self.limit.value:
+                self.saturated.value = 1
+                self.condition.wait(WAIT_TIMEOUT)
+            self.in_flight.value += 1
+            if self.in_flight.value >= self.limit.value:
+                self.saturated.value = 1
+        finally:
+            self.condition.release()
+
+    def release(self, throttled=False):
+        """
+        Ends the request.  A throttled request halves the limit, at most
+        once per window so a burst of throttled responses counts once.
+        """
+        self.condition.acquire()
+        try:
+            self.in_flight.value -= 1
+            now = time.time()
+            if throttled:
+                if now - self.last_decrease.value >= self.window:
+                    self.limit.value = max(self.minimum, self.limit.value // 2)
+                    self.last_decrease.value = now
+                    self.reset_window(now, 0.0)
+            else:
+                self.window_count.value += 1
+                self.update(now)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def update(self, now):
+        """
+        Measures the throughput of the finished window.  The limit is grown
+        while the throughput rises and the limit was reached, the last
+        increase is undone if the throughput dropped.
+        """
+        elapsed = now - self.window_start.value
+        if elapsed < self.window:
+            return
+        rate = self.window_count.value / elapsed
+        last_rate = self.last_rate.value
+        if self.increased.value and rate < last_rate * DROP_THRESHOLD:
+            self.limit.value = max(self.minimum, self.limit.value - 1)
+            self.increased.value = 0
+        elif self.saturated.value and rate >= last_rate and self.limit.value < self.maximum:
+            self.limit.value += 1
+            self.increased.value = 1
+        else:
+            self.increased.value = 0
+        self.reset_window(now, rate)
+
+    def reset_window(self, now, rate):
+        self.window_start.value = now
+        self.window_count.value = 0
+        self.saturated.value = 0
+        self.last_rate.value = rate
+
+    def get_limit(self):
+        return self.limit.value
@@ -0,0 +1,174 @@
+"""
+Resumable run journal for the S3 commands.
+
+The journal is an append-only file of the operations completed by a run.
+The first line names the run target (for example the bucket, svn url and
+revision window of a s3-svnsync run).  A rerun of the same target skips the
+journaled operations and only does the remaining work, a run of another
+target starts a new journal.  The journal is removed once the run
+completes.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import os
+import time
+import errno
+import threading
+
+# the journal header prefix, followed by the run target
+HEADER = '# pamazons3 journal: '
+
+# the entries and seconds between the durable checkpoints
+CHECKPOINT_ENTRIES = 1000
+CHECKPOINT_INTERVAL = 30
+
+
+class SyncJournal(object):
+    """
+    The journal of a single run target.  The command registers the
+    entries of each queued file with expect() and the collector of the
+    worker events completes them.  Each entry is an operation name (for
+    example put:css/site.css) and a token, such as the file size and
+    mtime, that must match for the entry to count on a rerun.
+
+    The optional on_checkpoint callback is called with the journal
+    filename after each durable checkpoint (s3-svnsync copies the journal
+    into the svn config bucket).
+    """
+    def __init__(self, path, target, on_checkpoint=None):
+        self.path = path
+        self.target = target
+        self.on_checkpoint = on_checkpoint
+        self.completed = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self._file = None
+        self.unsynced = 0
+        self.last_checkpoint = time.time()
+
+    def open(self):
+        """
+        Loads the completed entries of the journal if it belongs to the
+        same target, otherwise a new journal is started.  Returns the
+        number of loaded entries.
+        """
+        self.completed = {}
+        try:
+            journal_file = open(self.path, 'r')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            try:
+                header = journal_file.readline().rstrip('\n')
+                if header == HEADER + self.target:
+                    for line in journal_file:
+                        if not line.endswith('\n'):
+                            # a torn write of the last entry
+                            break
+                        entry, token = line.rstrip('\n').split('\t', 1)
+                        self.completed[entry] = token
+            finally:
+                journal_file.close()
+
+        if self.completed:
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write(HEADER + self.target + '\n')
+            self.sync()
+        return len(self.completed)
+
+    def is_done(self, entry, token=''):
+        return self.completed.get(entry) == str(token)
+
+    def expect(self, file_key, entries):
+        """
+        Registers the (entry, token) pairs completed by the processing of
+        the queued file key.
+        """
+        self.lock.acquire()
+        try:
+            self.pending[file_key] = entries
+        finally:
+            self.lock.release()
+
+    def complete(self, file_key):
+        """
+        Journals the entries of the processed file key.
+        """
+        self.lock.acquire()
+        try:
+            entries = self.pending.pop(file_key, ())
+            if not entries or self._file is None:
+                return
+            for entry, token in entries:
+                self.completed[entry] = str(token)
+                self._file.write('%s\t%s\n' % (entry, token))
+            self.unsynced += len(entries)
+            if self.unsynced >= CHECKPOINT_ENTRIES or \
+                    time.time() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                self.checkpoint()
+        finally:
+            self.lock.release()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.unsynced = 0
+        self.last_checkpoint = time.time()
+
+    def checkpoint(self):
+        """
+        Makes the journaled entries durable.
+        """
+        if self._file is None:
+            return
+        self.sync()
+        if self.on_checkpoint is not None:
+            self.on_checkpoint(self.path)
+
+    def close(self):
+        """
+        Checkpoints and closes the journal of an unfinished run.
+        """
+        if self._file is not None:
+            self.checkpoint()
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """
+        Removes the journal of the completed run.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def __len__(self):
+        return len(self.completed)
@@ -24,24 +24,63 @@ THE SOFTWARE.
 """
 
 import os
+import sys
 import datetime, time
 import gzip
-import email
 import mimetypes
 import hashlib
 import optparse
+import base64
+import binascii
+import tempfile
+import threading
+import heapq
+import sqlite3
 
-from cStringIO import StringIO
-from multiprocessing import Queue
+from collections import deque
+from multiprocessing import Queue, Process, Manager, cpu_count
+from multiprocessing.queues import SimpleQueue
+from Queue import Empty, Full
 
 # amazon s3 boto library
 import boto
+import boto.s3.connection
+import boto.s3.multipart
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# optional brotli library for the .br variants
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from ...cache import CompressionCache
+from ...concurrency import ConcurrencyLimiter, is_throttle_error, is_retryable_error, \
+    backoff_delay
+from ...manifest import ManifestEntry, SyncManifest
+from ...metrics import RunMetrics, MetricsCollector
+from ...plan import SyncPlan
+from ...policy import HeaderPolicy
+
+# the upload scheduling modes
+SCHEDULE_MODES = ('size', 'fifo',)
 
 # default optparse list
 DEFAULT_OPTIONS = (
     optparse.make_option('--gzip',
         action='store_true', dest='gzip', 
         help="Enables gzipping CSS and Javascript files."),
+    optparse.make_option('--brotli',
+        action='store_true', dest='brotli',
+        help="Enables brotli variants (.br) of the CSS and Javascript files."),
+    optparse.make_option('--compress-cache',
+        dest='compress_cache', default=None,
+        help="The directory caching the compressed files by content digest."),
+    optparse.make_option('--compress-cache-size',
+        dest='compress_cache_size', default=512, type='int',
+        help="The compression cache size limit (MB)."),
     optparse.make_option('--expires',
         action='store_true', dest='expires', 
         help="Enables setting a far future expires header."),
@@ -51,6 +90,57 @@ DEFAULT_OPTIONS = (
     optparse.make_option('--workers',
         dest='processes', default=4, type='int',
         help="Specifies the number of worker processes to use to upload the files."),
+    optparse.make_option('--prepare-workers',
+        dest='prepare_processes', default=cpu_count(), type='int',
+        help="Specifies the number of worker processes used to check, digest and gzip the files."),
+    optparse.make_option('--adaptive',
+        action='store_true', dest='adaptive',
+        help="Adapts the number of S3 requests in flight to the throughput, starting at --workers."),
+    optparse.make_option('--max-workers',
+        dest='max_processes', default=32, type='int',
+        help="The most upload workers used by --adaptive."),
+    optparse.make_option('--retries',
+        dest='retries', default=5, type='int',
+        help="The number of retries of a failed or throttled S3 request."),
+    optparse.make_option('--engine',
+        dest='engine', default='processes', type='choice', choices=('processes', 'threads',),
+        help="Runs the upload workers as processes (default) or as threads."),
+    optparse.make_option('--no-copy',
+        action='store_true', dest='no_copy',
+        help="Uploads every file instead of copying the keys with the same content on S3."),
+    optparse.make_option('--schedule',
+        dest='schedule', default='size', type='choice', choices=SCHEDULE_MODES,
+        help="The upload order: size (largest files first, default) or fifo (scan order)."),
+    optparse.make_option('--lookahead',
+        dest='lookahead', default=1000, type='int',
+        help="The number of scanned files reordered by the size schedule."),
+    optparse.make_option('--multipart-threshold',
+        dest='multipart_threshold', default=64, type='int',
+        help="Files larger than this size (MB) are sent as S3 multipart uploads."),
+    optparse.make_option('--part-size',
+        dest='part_size', default=16, type='int',
+        help="The multipart upload part size (MB, 5 minimum)."),
+    optparse.make_option('--part-threads',
+        dest='part_threads', default=4, type='int',
+        help="The number of multipart upload parts sent in parallel by each worker."),
+    optparse.make_option('--destination',
+        action='append', dest='destination', metavar='NAME',
+        help="Only syncs the named settings.AWS_DESTINATIONS destination (repeatable)."),
+    optparse.make_option('--shard',
+        dest='shard', default=None, metavar='I/N',
+        help="Only syncs the I-th of N slices of the files (by a hash of the S3 key)."),
+    optparse.make_option('--journal',
+        dest='journal', default=None, metavar='PATH',
+        help="The journal of the completed operations used to resume an interrupted run."),
+    optparse.make_option('--plan',
+        dest='plan', default=None, metavar='PATH',
+        help="Writes the uploads, copies and deletes to the plan file instead (see s3-apply)."),
+    optparse.make_option('--report',
+        dest='report', default=None, metavar='PATH',
+        help="Writes the JSON run report (counts, bytes, request latencies) to the file."),
+    optparse.make_option('--progress',
+        action='store_true', dest='progress',
+        help="Shows the live progress with the throughput and ETA."),
     optparse.make_option('--verbose', '--v', dest='verbose',
         help="Specifies the basic output.", action="store_true"),
     optparse.make_option('--debug', '--V', '--d',
@@ -58,20 +148,692 @@ DEFAULT_OPTIONS = (
         help="Specifies the maximum debug output."),
 )
 
-# global FIFO queue 
-s3_queue = Queue()
+# date formats used by S3: HEAD responses use RFC 822, bucket listings ISO 8601
+S3_DATETIME_FORMATS = (
+    '%a, %d %b %Y %H:%M:%S %Z',
+    '%Y-%m-%dT%H:%M:%S.%fZ',
+    '%Y-%m-%dT%H:%M:%SZ',
+)
+
+# the change detection modes used to skip unchanged files
+COMPARE_MODES = ('mtime', 'hash', 'size',)
+
+# read size used when digesting files
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+# the S3 metadata entry holding the file MD5 digest (multipart ETags are not MD5s)
+MD5_METADATA = 'md5'
+
+# the S3 metadata entry holding the upload fingerprint of the key
+FINGERPRINT_METADATA = 'fingerprint'
+
+# the compressed variants (encoding, key extension) and compression levels
+COMPRESSED_VARIANTS = (('gzip', '.gz',), ('br', '.br',),)
+COMPRESS_LEVELS = {'gzip': 6, 'br': 11}
+
+# the smallest multipart upload part allowed by S3
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# the most keys S3 accepts in a single multi-object delete request
+MAX_DELETE_BATCH = 1000
+
+# the options of a settings.AWS_DESTINATIONS destination
+DESTINATION_OPTIONS = ('name', 'bucket', 'prefix', 'access_key_id', 'secret_access_key',)
+
+# headers left out of the upload fingerprint (the expires date changes daily)
+FINGERPRINT_EXCLUDED_HEADERS = ('Expires', 'x-amz-meta-%s' % MD5_METADATA,
+                                'x-amz-meta-%s' % FINGERPRINT_METADATA,)
+
+# the most files waiting between the pipeline stages
+QUEUE_SIZE = 1000
+
+# the seconds the size schedule waits for its lookahead window to fill, a
+# slow scan starts the uploads with the files found so far
+LOOKAHEAD_INTERVAL = 2
+
+# the seconds between the worker liveness checks, the most crashed workers
+# restarted per pool and the worker crashes an item may cause before it fails
+SUPERVISE_INTERVAL = 0.5
+MAX_RESTARTS = 10
+MAX_ITEM_CRASHES = 2
+
+# the file sizes copied from a key with the same content instead of uploaded
+# (the largest single S3 copy is 5GB)
+MIN_COPY_SIZE = 16 * 1024
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
+# global FIFO queues, the scanned files and the prepared files
+s3_queue = Queue(QUEUE_SIZE)
+s3_upload_queue = Queue(QUEUE_SIZE)
+
+# the worker file events collected by the command process
+s3_result_queue = Queue()
+
+# the copies deferred until their source files are uploaded
+s3_copy_queue = Queue()
+
+# the worker status reports read by the pool supervisor (written without a
+# feeder thread, so the report of a crashing worker is not lost)
+s3_status_queue = SimpleQueue()
+
+# the manager process of the shared content digest registry
+copy_manager = None
 
 def get_queue():
     """
-    The S3 file queue used by the worker processes.
+    The S3 file queue used by the prepare stage workers.
     """
     global s3_queue
     return s3_queue
 
 
+def get_upload_queue():
+    """
+    The prepared S3 file queue used by the upload stage workers.
+    """
+    global s3_upload_queue
+    return s3_upload_queue
+
+
+def get_result_queue():
+    """
+    The file event queue read by the command metrics collector.
+    """
+    global s3_result_queue
+    return s3_result_queue
+
+
+def get_copy_queue():
+    """
+    The queue of the copies deferred by the prepare stage.
+    """
+    global s3_copy_queue
+    return s3_copy_queue
+
+
+def get_status_queue():
+    """
+    The worker status queue read by the pool supervisor.
+    """
+    global s3_status_queue
+    return s3_status_queue
+
+
+def create_copy_registry():
+    """
+    Returns a new content digest registry shared by the worker processes.
+    """
+    global copy_manager
+    if copy_manager is None:
+        copy_manager = Manager()
+    return copy_manager.dict()
+
+
+def get_worker_options(options):
+    """
+    Returns the S3Worker keyword arguments for the DEFAULT_OPTIONS
+    command line values.
+    """
+    if options.get('brotli') and brotli is None:
+        raise ImportError, "The brotli library is not installed."
+
+    limiter = None
+    if options.get('adaptive'):
+        limiter = ConcurrencyLimiter(options.get('processes'), get_upload_worker_count(options))
+
+    return dict(
+        do_brotli=options.get('brotli'),
+        multipart_threshold=options.get('multipart_threshold'),
+        part_size=options.get('part_size'),
+        part_threads=options.get('part_threads'),
+        retries=options.get('retries'),
+        limiter=limiter,
+        copy_registry=create_copy_registry() if not options.get('no_copy') else None,
+        policy=create_header_policy(options),
+        do_compress=not options.get('plan'),
+    )
+
+
+def get_engine(options):
+    """
+    The engine of the pipeline workers, a planning run writes the plan from
+    the threads of the command.
+    """
+    if options.get('plan'):
+        return 'threads'
+    return options.get('engine')
+
+
+def create_header_policy(options):
+    """
+    Compiles the settings.AWS_HEADER_POLICY rules (and the --expires option)
+    into the header policy of the run.  The rules are matched against the
+    keys relative to the destination prefix.
+    """
+    return HeaderPolicy.from_settings(getattr(settings, 'AWS_HEADER_POLICY', ()),
+                                      options.get('expires'))
+
+
+def get_destinations(options):
+    """
+    Returns the S3 destinations of the run: the settings.AWS_DESTINATIONS
+    (selected with --destination), by default the AWS_BUCKET_NAME with the
+    --prefix option.  A destination without a prefix or credentials uses
+    the --prefix option and the AWS keys.  Raises a ValueError for an
+    invalid destination.
+    """
+    prefix = options.get('prefix') or ''
+    aws_access_key_id = getattr(settings, 'AWS_ACCESS_KEY_ID', None)
+    aws_secret_key = getattr(settings, 'AWS_SECRET_ACCESS_KEY', None)
+
+    if not getattr(settings, 'AWS_DESTINATIONS', None):
+        if options.get('destination'):
+            raise ValueError("--destination requires the AWS_DESTINATIONS setting.")
+        return [S3Destination(settings.AWS_BUCKET_NAME, settings.AWS_BUCKET_NAME, prefix,
+                              aws_access_key_id, aws_secret_key)]
+
+    destinations = []
+    for values in settings.AWS_DESTINATIONS:
+        unknown = [ option for option in values if option not in DESTINATION_OPTIONS ]
+        if unknown:
+            raise ValueError("Unknown destination options: %s" % ', '.join(unknown))
+        if not values.get('bucket'):
+            raise ValueError("Every AWS_DESTINATIONS entry needs a bucket.")
+        destinations.append(S3Destination(values.get('name') or values['bucket'],
+            values['bucket'], values.get('prefix', prefix),
+            values.get('access_key_id') or aws_access_key_id,
+            values.get('secret_access_key') or aws_secret_key))
+
+    names = [ destination.name for destination in destinations ]
+    duplicates = sorted(set([ name for name in names if names.count(name) > 1 ]))
+    if duplicates:
+        raise ValueError("Duplicate destination names: %s (set a name)" % ', '.join(duplicates))
+
+    if options.get('destination'):
+        unknown = [ name for name in options.get('destination') if name not in names ]
+        if unknown:
+            raise ValueError("Unknown destinations: %s" % ', '.join(unknown))
+        destinations = [ destination for destination in destinations \
+                            if destination.name in options.get('destination') ]
+
+    for destination in destinations:
+        destination.qualified = len(destinations) > 1
+    return destinations
+
+
+def get_upload_worker_count(options):
+    """
+    The number of upload workers to start.  With --adaptive the workers
+    are started up to --max-workers and the limiter sets how many of them
+    have a request in flight.
+    """
+    count = int(options.get('processes'))
+    if options.get('adaptive'):
+        count = max(count, int(options.get('max_processes')))
+    return max(count, 1)
+
+
+def create_compress_cache(path, max_size):
+    """
+    Returns the compression cache for the given directory and size limit
+    (MB), or None if the cache isn't configured.
+    """
+    if not path:
+        return None
+    return CompressionCache(path, max_size * 1024 * 1024)
+
+
+def finish_run(metrics, options, verbosity=0):
+    """
+    Prints the run summary and writes the JSON run report if requested.
+    """
+    metrics.finish()
+    if verbosity > 0 or options.get('progress'):
+        print metrics.summary()
+    if options.get('report'):
+        metrics.write_report(options.get('report'))
+        if verbosity > 0:
+            print "Wrote the run report to %s" % options.get('report')
+
+
+def create_plan(options, command, destinations):
+    """
+    Starts the plan of the --plan option or returns None.  The compression
+    options are applied with the plan.
+    """
+    if not options.get('plan'):
+        return None
+    return SyncPlan(options.get('plan')).create(command, destinations,
+                                                gzip=bool(options.get('gzip')),
+                                                brotli=bool(options.get('brotli')))
+
+
+def finish_plan(plan, process_result=0, skipped=0):
+    """
+    Closes the plan with the totals of the planned operations.  The plan
+    of a run with failed checks is left incomplete, it can't be applied.
+    """
+    if process_result:
+        plan.abort()
+        print "The plan %s is incomplete, the run failed" % plan.path
+        return
+    plan.close(skipped)
+    print "Plan: %d uploads (%.1f MB), %d copies (%.1f MB), %d skipped, %d deletes " \
+        "written to %s" % (plan.counts['uploaded'], plan.bytes['uploaded'] / 1048576.0,
+                           plan.counts['copied'], plan.bytes['copied'] / 1048576.0,
+                           skipped, plan.counts['deleted'], plan.path)
+
+
+def create_upload_workers(options, process_args, worker_options, plan=None):
+    """
+    Creates the upload stage workers, a single plan worker writing the
+    prepared files to the plan when planning.
+    """
+    if plan is not None:
+        return create_workers(S3PlanWorker, 1, process_args, dict(worker_options, plan=plan))
+    return create_workers(S3UploadWorker, get_upload_worker_count(options), process_args,
+                          worker_options)
+
+
+def create_workers(worker_class, count, process_args, worker_options):
+    """
+    Creates the given number of pipeline stage workers.
+    """
+    return [ worker_class(num, *process_args, **worker_options) \
+                for num in xrange(max(count, 1)) ]
+
+
+def start_workers(workers, engine='processes', args=()):
+    """
+    Starts the given worker instances as processes or threads
+    and returns the started processes/threads.  The args are
+    passed to the worker runs.
+    """
+    if engine == 'threads':
+        started = [ S3WorkerThread(worker, args) for worker in workers ]
+    else:
+        started = [ Process(target=worker, args=args) for worker in workers ]
+    for worker in started:
+        worker.start()
+    return started
+
+
+def get_file_size(s3_file):
+    """
+    Returns the local size of the file to upload (0 for the deletes).
+    The stat result is kept for the prepare stage.
+    """
+    if not s3_file.do_upload():
+        return 0
+    if s3_file.stat is None:
+        try:
+            s3_file.stat = os.stat(s3_file.filename)
+        except OSError:
+            return 0
+    return s3_file.stat.st_size
+
+
+def schedule_files(s3_files, schedule='size', lookahead=1000,
+                   interval=LOOKAHEAD_INTERVAL):
+    """
+    Orders the S3 files for the pipeline.  The size schedule yields the
+    largest files of the lookahead window first, so the large files are
+    started early instead of leaving a single worker busy at the end of
+    the run.  A lookahead larger than the file count sorts all of the files.
+    The window stops growing after the interval (seconds), the workers
+    aren't kept idle by a slow scan.
+    """
+    if schedule != 'size':
+        for s3_file in s3_files:
+            yield s3_file
+        return
+
+    heap = []
+    window = max(lookahead, 1)
+    deadline = time.time() + interval
+    for count, s3_file in enumerate(s3_files):
+        heapq.heappush(heap, (-get_file_size(s3_file), count, s3_file,))
+        if len(heap) < window and time.time() >= deadline:
+            window = len(heap)
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def put_item(queue, item, consumers=None):
+    """
+    Puts the item on the bounded queue, waiting while the queue is full.
+    Raises a RuntimeError if the consuming workers have all exited.
+    """
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return
+        except Full:
+            if consumers is not None and not any([ c.is_alive() for c in consumers ]):
+                raise RuntimeError("The workers exited before the queue was processed.")
+
+
+def get_item(queue):
+    """
+    Takes the next item from the worker queue.  The queue read lock is only
+    taken once an item is ready, a worker killed while it waits for an item
+    doesn't leave the lock held by the other workers.
+    """
+    while True:
+        queue._reader.poll(SUPERVISE_INTERVAL)
+        try:
+            return queue.get(False)
+        except Empty:
+            pass
+
+
+def run_pipeline(s3_files, prepare_workers, upload_workers, engine='processes',
+                 metrics=None, show_progress=False, journal=None, final_files=()):
+    """
+    Runs the S3 files through the pipeline.  The prepare stage (change
+    check, digest and gzip) runs as processes, the upload stage uses the
+    given engine.  Both stages are started before the first file is queued
+    and the bounded queues hold back the producer when a stage falls
+    behind.  The copies deferred by the prepare stage are sent once the
+    uploads are done, then the final files (the deletes of s3-svnsync and
+    of the s3-push mirror, which may be copy sources).  The worker events
+    are collected into the run metrics and the completed files into the
+    run journal.  Returns the sum of the worker exit codes, a failed file
+    listing (the scan) fails the run without sending the final files.
+    """
+    pool = S3WorkerPool(prepare_workers, upload_workers, engine, metrics, show_progress, journal)
+    pool.start()
+    try:
+        for s3_file in s3_files:
+            pool.put(s3_file)
+        for s3_file in final_files:
+            pool.metrics.queue()
+        pool.metrics.close_queue()
+    except RuntimeError, e:
+        print e
+        return pool.finish()
+    except Exception, e:
+        print "The file listing failed: %s" % e
+        return pool.stop() + 1
+    return pool.stop(final_files)
+
+
+def parse_s3_datetime(value):
+    """
+    Parses the last modified date string returned by S3 into a datetime.
+    """
+    for date_format in S3_DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError("Unknown S3 date format: %s" % value)
+
+
+def file_md5(filename, chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Computes the hex MD5 digest of the given file.  The file is read in
+    chunks so memory use does not depend on the file size.
+    """
+    md5 = hashlib.md5()
+    file_obj = open(filename, 'rb')
+    try:
+        while True:
+            chunk = file_obj.read(chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+    finally:
+        file_obj.close()
+    return md5.hexdigest()
+
+
+def md5_tuple(hexdigest):
+    """
+    Returns the (hex, base64) MD5 pair used by boto for the Content-MD5 header.
+    """
+    return (hexdigest, base64.b64encode(binascii.unhexlify(hexdigest)),)
+
+
+def compress_file(filename, encoding='gzip', compresslevel=None, output_filename=None,
+                  chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Compresses the given file with gzip or brotli into the output file (a new
+    temporary file by default) and returns the output filename.  The file is
+    read in chunks, the caller removes the temporary file when done.
+    """
+    if compresslevel is None:
+        compresslevel = COMPRESS_LEVELS[encoding]
+    if output_filename is None:
+        fd, output_filename = tempfile.mkstemp(suffix='.%s' % encoding)
+        os.close(fd)
+
+    temp_file = open(output_filename, 'wb')
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=compresslevel)
+        process = getattr(compressor, 'process', None) or compressor.compress
+    else:
+        compressor = gzip.GzipFile(mode='wb', compresslevel=compresslevel, fileobj=temp_file)
+
+    file_obj = open(filename, 'rb')
+    try:
+        while True:
+            chunk = file_obj.read(chunk_size)
+            if not chunk:
+                break
+            if encoding == 'br':
+                temp_file.write(process(chunk))
+            else:
+                compressor.write(chunk)
+    finally:
+        file_obj.close()
+        if encoding == 'br':
+            temp_file.write(compressor.finish())
+        else:
+            compressor.close()
+        temp_file.close()
+    return output_filename
+
+
+def variant_key(file_key, extension):
+    """
+    Returns the key of a compressed variant of the file key, for example
+    css/site.css => css/site.gz.css
+    """
+    base, ext = os.path.splitext(file_key)
+    return ''.join([base, extension, ext])
+
+
+def variant_keys(file_key):
+    """
+    Returns the keys of the compressed variants uploaded for the file key.
+    """
+    return [ variant_key(file_key, extension) for encoding, extension in COMPRESSED_VARIANTS ]
+
+
+def original_key(file_key):
+    """
+    Returns the key of the file a compressed variant key belongs to, for
+    example css/site.gz.css => css/site.css, other keys are returned as is.
+    """
+    base, ext = os.path.splitext(file_key)
+    for encoding, extension in COMPRESSED_VARIANTS:
+        if base.endswith(extension):
+            return base[:-len(extension)] + ext
+    return file_key
+
+
+def utf8(value):
+    """
+    Returns the (key name) value as a UTF-8 string.  boto lists the key
+    names as unicode and the JSON plan values are unicode, the file keys of
+    the commands (and the S3 listing order) are the UTF-8 bytes.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def parse_shard(value):
+    """
+    Parses the --shard=I/N value (I from 1 to N) into the (index, count)
+    pair with a zero based index, or None without a shard.  Raises a
+    ValueError for an invalid shard.
+    """
+    if not value:
+        return None
+    try:
+        index, count = [ int(part) for part in value.split('/') ]
+    except ValueError:
+        raise ValueError("Invalid shard %r, expected I/N." % value)
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError("Invalid shard %r, I must be from 1 to N." % value)
+    return (index - 1, count,)
+
+
+def in_shard(file_key, shard):
+    """
+    Returns True if the file key belongs to the shard.  The keys are
+    partitioned by the MD5 of the key, so every host running a shard of
+    the same file set computes the same disjoint slices.  The compressed
+    variants belong to the shard of their file.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    if isinstance(file_key, unicode):
+        file_key = file_key.encode('utf-8')
+    return int(hashlib.md5(original_key(file_key)).hexdigest()[:8], 16) % count == index
+
+
+def get_shard_suffix(shard):
+    """
+    The suffix of the journal (and config) names of a shard, empty without
+    a shard.
+    """
+    if shard is None:
+        return ''
+    return '-%d-of-%d' % (shard[0] + 1, shard[1])
+
+
+def build_headers(file_key, filename, policy):
+    """
+    Builds the upload headers (content type, cache headers, ACL, storage
+    class and metadata) of the given file from the header policy.
+    """
+    return policy.get_headers(file_key, mimetypes.guess_type(filename)[0])
+
+
+def upload_fingerprint(headers, do_gzip=False, do_brotli=False):
+    """
+    Returns a digest of the upload headers and options.  A changed fingerprint
+    means the file needs to be pushed again even if the content is the same.
+    """
+    items = sorted([ (name, value) for name, value in headers.items() \
+                        if name not in FINGERPRINT_EXCLUDED_HEADERS ])
+    variants = bool(do_gzip)
+    if do_brotli:
+        variants = (variants, 'br',)
+    return hashlib.md5(repr((items, variants,))).hexdigest()
+
+
+def connect_s3(aws_access_key_id, aws_secret_key):
+    """
+    Opens the s3 connection.  The optional AWS_S3_HOST, AWS_S3_PORT and
+    AWS_S3_SECURE settings point the commands at another S3 compatible
+    endpoint (path style requests are used for a custom host).
+    """
+    kwargs = {}
+    if getattr(settings, 'AWS_S3_HOST', None):
+        kwargs['host'] = settings.AWS_S3_HOST
+        kwargs['calling_format'] = boto.s3.connection.OrdinaryCallingFormat()
+    if getattr(settings, 'AWS_S3_PORT', None):
+        kwargs['port'] = int(settings.AWS_S3_PORT)
+    if hasattr(settings, 'AWS_S3_SECURE'):
+        kwargs['is_secure'] = bool(settings.AWS_S3_SECURE)
+    return boto.connect_s3(aws_access_key_id, aws_secret_key, **kwargs)
+
+
+def connect_s3_bucket(aws_bucket, aws_access_key_id, aws_secret_key, validate=True):
+    """
+    Opens the s3 connection and returns the bucket instance.  If the bucket
+    does not exist, it will be created.  Without validate the bucket is
+    assumed to exist and no request is made.
+    """
+    conn = connect_s3(aws_access_key_id, aws_secret_key)
+    if not validate:
+        return conn.get_bucket(aws_bucket, validate=False)
+    try:
+        bucket = conn.get_bucket(aws_bucket)
+    except boto.exception.S3ResponseError:
+        bucket = conn.create_bucket(aws_bucket)
+    return bucket
+
+
+class S3Destination(object):
+    """
+    A bucket and key prefix the files are pushed to, with its credentials
+    and the bucket index built by the command.  With several destinations
+    the event (and journal) names are qualified with the destination name.
+    """
+    def __init__(self, name, bucket_name, prefix='', aws_access_key_id=None,
+                 aws_secret_key=None):
+        self.name = name
+        self.bucket_name = bucket_name
+        self.prefix = prefix or ''
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_key = aws_secret_key
+        self.bucket_index = None
+        self.qualified = False
+
+    def get_key(self, rel_key):
+        return self.prefix + rel_key
+
+    def get_event_key(self, file_key):
+        if self.qualified:
+            return '%s:%s' % (self.name, file_key)
+        return file_key
+
+    def connect(self, validate=True):
+        return connect_s3_bucket(self.bucket_name, self.aws_access_key_id,
+                                 self.aws_secret_key, validate)
+
+    def __str__(self):
+        return '<S3Destination %s %s:%s>' % (self.name, self.bucket_name, self.prefix)
+
+
+class S3Target(object):
+    """
+    The push of a file to one of the destinations (the index into the
+    destinations of the workers): the key, the fingerprint the key was
+    last pushed with and the key copied instead of uploading the file.
+    """
+    def __init__(self, destination, file_key):
+        self.destination = destination
+        self.file_key = file_key
+
+        # the fingerprint the key was last pushed with (from the manifest)
+        self.last_fingerprint = None
+
+        # the key with the same content copied instead of uploading the file, the
+        # svn copy source to check, if the copy waits for the source upload and
+        # if only the headers of the key changed
+        self.copy_source = None
+        self.copy_hint = None
+        self.deferred = False
+        self.headers_only = False
+
+    def __str__(self):
+        return '<S3Target %d %s>' % (self.destination, self.file_key)
+
+
 class S3File(object):
     """
-    Contains the file information and S3 file key and the action.
+    Contains the file information and S3 file key and the action.  The
+    file is read, digested and compressed once and pushed to each of its
+    targets, by default the file key of the first destination.
     """
     def __init__(self, bucket_name, file_key, filename, delete=False):
         self.bucket_name = bucket_name
@@ -79,6 +841,39 @@ class S3File(object):
         self.filename = filename
         self.delete = delete
 
+        # the key relative to the destination prefix (matched by the header policy)
+        self.rel_key = file_key
+        self.targets = [ S3Target(0, file_key) ]
+
+        # the stat result of the scan, set by the prepare stage otherwise
+        self.stat = None
+
+        # set by the prepare stage
+        self.size = None
+        self.digest = None
+        self.headers = None
+        self.fingerprint = None
+
+        # the compressed variants: (encoding, key extension, filename, is temporary),
+        # the filename is None if the variants are only copied
+        self.variants = []
+
+    @classmethod
+    def create(cls, destinations, rel_key, filename, delete=False):
+        """
+        Creates the S3 file of the key relative to the destination prefixes
+        with a target in each of the destinations.
+        """
+        s3_file = cls(destinations[0].bucket_name, destinations[0].get_key(rel_key),
+                      filename, delete)
+        s3_file.rel_key = rel_key
+        s3_file.targets = [ S3Target(num, destination.get_key(rel_key)) \
+                                for num, destination in enumerate(destinations) ]
+        return s3_file
+
+    def is_deferred(self):
+        return bool([ target for target in self.targets if target.deferred ])
+
     def do_delete(self):
         return self.delete
     
@@ -90,10 +885,107 @@ class S3File(object):
         return '<S3File%s %s => %s>' % (delete_str, self.file_key, self.filename)
 
 
+class S3DeleteBatch(object):
+    """
+    A batch of S3 keys of a destination removed with a single multi-object
+    delete request.
+    """
+    def __init__(self, bucket_name, file_keys, destination=0):
+        self.bucket_name = bucket_name
+        self.file_keys = file_keys
+        self.destination = destination
+
+    @classmethod
+    def create_batches(cls, bucket_name, file_keys, batch_size=MAX_DELETE_BATCH,
+                       destination=0):
+        """
+        Splits the file keys into the delete batches.
+        """
+        file_keys = list(file_keys)
+        return [ cls(bucket_name, file_keys[i:i + batch_size], destination) \
+                    for i in xrange(0, len(file_keys), batch_size) ]
+
+    def do_delete(self):
+        return True
+
+    def do_upload(self):
+        return False
+
+    def __str__(self):
+        return '<S3DeleteBatch %d keys>' % len(self.file_keys)
+
+
+class S3KeyInfo(object):
+    """
+    The size, ETag and last modified date of a key stored on S3, and the
+    upload fingerprint if known (the listing has no metadata).
+    """
+    __slots__ = ('name', 'size', 'etag', 'last_modified', 'fingerprint',)
+
+    def __init__(self, name, size, etag, last_modified, fingerprint=None):
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_key(cls, key):
+        """
+        Creates the key info from a boto key (listing or HEAD result).
+        """
+        return cls(utf8(key.name), int(key.size or 0), (key.etag or '').strip('"'),
+                   parse_s3_datetime(key.last_modified), key.get_metadata(FINGERPRINT_METADATA))
+
+    def __str__(self):
+        return '<S3KeyInfo %s (%d bytes)>' % (self.name, self.size)
+
+
+class S3BucketIndex(object):
+    """
+    In-memory index of the keys under a bucket prefix.  The index is built
+    once from the paged bucket listing (1000 keys per request) so the workers
+    can check for changed files without a HEAD request per file.
+    """
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix or ''
+        self.keys = {}
+        self.digests = {}
+
+    def build(self):
+        """
+        Lists the bucket prefix and loads the key details into the index.
+        """
+        for key in self.bucket.list(prefix=self.prefix):
+            key_info = S3KeyInfo.from_key(key)
+            self.keys[key_info.name] = key_info
+            # multipart ETags aren't content digests
+            if '-' not in key_info.etag:
+                self.digests.setdefault(key_info.etag, key_info.name)
+        return self
+
+    def get(self, file_key):
+        return self.keys.get(file_key)
+
+    def find_digest(self, digest):
+        """
+        Returns the name of a key with the given content digest or None.
+        """
+        return self.digests.get(digest)
+
+    def __contains__(self, file_key):
+        return file_key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
 
-class S3UploadWorker(object):
+class S3Worker(object):
     """
-    Creates a process worker for the AWS S3 connection.
+    Base class of the pipeline stage workers.  Holds the AWS S3 settings,
+    the connection is opened on first use inside the worker process (the
+    bucket is checked once by the pool before the workers start).
     """
     GZIP_CONTENT_TYPES = (
         'text/css',
@@ -111,7 +1003,20 @@ class S3UploadWorker(object):
                  do_gzip=False,
                  do_expires=False,
                  do_force=False,
-                 dry_run=False):
+                 dry_run=False,
+                 do_brotli=False,
+                 compress_cache=None,
+                 compare='mtime',
+                 manifest_path=None,
+                 multipart_threshold=64,
+                 part_size=16,
+                 part_threads=4,
+                 retries=5,
+                 limiter=None,
+                 copy_registry=None,
+                 policy=None,
+                 destinations=None,
+                 do_compress=True):
         self.num = num
         self.aws_bucket = aws_bucket
         self.aws_access_key_id = aws_access_key_id
@@ -121,162 +1026,1280 @@ class S3UploadWorker(object):
         self.do_expires = do_expires
         self.do_force = do_force
         self.dry_run = dry_run
+        self.do_brotli = do_brotli
+        self.compress_cache = compress_cache
+        self.compare = compare
+
+        # multipart sizes are given in MB
+        self.multipart_threshold = max(multipart_threshold * 1024 * 1024, MIN_PART_SIZE)
+        self.part_size = max(part_size * 1024 * 1024, MIN_PART_SIZE)
+        self.part_threads = max(part_threads, 1)
+        self.part_buckets = {}
+        self.retries = max(retries, 0)
+        self.limiter = limiter
+        self.copy_registry = copy_registry
+        self.policy = policy or HeaderPolicy.from_settings(do_expires=do_expires)
+
+        # the variants are not compressed by a planning run
+        self.do_compress = do_compress
+
+        # the files are pushed to the bucket of the worker args by default
+        self.destinations = destinations or [S3Destination(aws_bucket, aws_bucket, prefix,
+                                                           aws_access_key_id, aws_secret_key)]
+
+        # the manifest connections are opened on first use inside the worker
+        self.manifests = None
+        if manifest_path:
+            self.manifests = [ SyncManifest(manifest_path, destination.bucket_name) \
+                                 for destination in self.destinations ]
+
+        # the connections and reusable keys by destination
+        self.buckets = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.reset()
         
         if self.verbosity > 1:
-            print "S3ProcessWorker init (worker: %d)" % self.num
-        
-        # open s3 connection
-        conn = boto.connect_s3(self.aws_access_key_id, self.aws_secret_key)
-        try:
-            self.bucket = conn.get_bucket(self.aws_bucket)
-        except boto.exception.S3ResponseError:
-            self.bucket = conn.create_bucket(self.aws_bucket)
-            
-        self.key = boto.s3.key.Key(self.bucket)
+            print "%s init (worker: %d)" % (self.__class__.__name__, self.num)
+
+    def reset(self):
+        """
+        Clears the counters and timings of the run.  A worker object (the
+        threads engine) runs again for the deferred copies and the deletes,
+        each run reports only its own failures.
+        """
+        self.timings = []
         self.upload_count = 0
         self.skip_count = 0
         self.delete_count = 0
-        
-        if self.verbosity > 0:
-            print "Connected to s3 (worker: %d)" % self.num
+        self.copy_count = 0
+        self.failed_count = 0
+        self.retry_count = 0
+
+    def get_bucket(self, destination=0):
+        """
+        The S3 bucket instance of the destination, connected on first use.
+        """
+        if destination not in self.buckets:
+            self.buckets[destination] = self.destinations[destination].connect(validate=False)
+            if self.verbosity > 0:
+                print "Connected to s3 %s (worker: %d)" % (
+                    self.destinations[destination].bucket_name, self.num)
+        return self.buckets[destination]
+
+    def get_s3_key(self, destination=0):
+        """
+        The reusable S3 key instance of the worker for the destination.
+        """
+        if destination not in self.keys:
+            self.keys[destination] = boto.s3.key.Key(self.get_bucket(destination))
+        return self.keys[destination]
+
+    @property
+    def bucket(self):
+        return self.get_bucket(0)
+
+    @property
+    def key(self):
+        return self.get_s3_key(0)
+
+    def get_event_key(self, target, file_key=None):
+        """
+        The name of the target key in the worker events.
+        """
+        return self.destinations[target.destination].get_event_key(file_key or target.file_key)
+
+    def record_manifest(self, s3_file, target, etag):
+        """
+        Records the file pushed to the target in the local manifest.  A
+        manifest error doesn't fail the push, the key is checked again by
+        the next push.
+        """
+        if self.manifests and not self.dry_run:
+            try:
+                self.manifests[target.destination].update(ManifestEntry.from_stat(
+                    target.file_key, s3_file.filename, s3_file.stat or os.stat(s3_file.filename),
+                    digest=s3_file.digest, etag=etag, fingerprint=s3_file.fingerprint))
+            except sqlite3.Error, e:
+                print "Unable to record %s in the manifest: %s" % (self.get_event_key(target), e)
+
+    def add_timing(self, operation, started):
+        """
+        Records the duration of an S3 request started at the given time.
+        """
+        self.lock.acquire()
+        try:
+            self.timings.append((operation, time.time() - started,))
+        finally:
+            self.lock.release()
+
+    def request(self, operation, func, *args, **kwargs):
+        """
+        Makes the S3 request through the concurrency limiter.  Throttled,
+        timed out and server failed requests are retried with a jittered
+        exponential backoff.  The request and backoff timings are recorded.
+        """
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            started = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                self.add_timing(operation, started)
+                throttled = is_throttle_error(e)
+                if self.limiter:
+                    self.limiter.release(throttled)
+                if attempt >= self.retries or not (throttled or is_retryable_error(e)):
+                    raise
+                delay = backoff_delay(attempt)
+                if self.verbosity > 0:
+                    print "Retrying %s in %.1fs after: %s (worker: %d)" % (operation, delay,
+                                                                           e, self.num)
+                time.sleep(delay)
+                self.lock.acquire()
+                try:
+                    self.timings.append(('BACKOFF', delay,))
+                finally:
+                    self.lock.release()
+                self.retry_count += 1
+                attempt += 1
+                continue
+            self.add_timing(operation, started)
+            if self.limiter:
+                self.limiter.release()
+            return result
+
+    def emit(self, event, file_key, size=0, keys=1, error=None, failed=0):
+        """
+        Sends the file event with the request timings to the command process.
+        """
+        self.lock.acquire()
+        try:
+            timings = self.timings
+            self.timings = []
+        finally:
+            self.lock.release()
+        get_result_queue().put((event, file_key, size, keys, timings, error, failed,))
+
+    def report(self, state, item=None):
+        """
+        Sends the worker state (busy with the item, idle, stopping after the
+        end of queue marker or exited) to the pool supervisor.
+        """
+        get_status_queue().put(((self.__class__.__name__, self.num,), state, item,))
 
-    def compress_string(self, s):
+    def get_queue(self):
         """
-        Gzips a given string.
+        The queue the worker takes its files from.
         """
-        zbuf = StringIO()
-        zfile = gzip.GzipFile(mode='wb', compresslevel=6, fileobj=zbuf)
-        zfile.write(s)
-        zfile.close()
-        return zbuf.getvalue()
+        raise NotImplementedError
+
+    def process(self, s3_file):
+        raise NotImplementedError
 
-    def delete_s3(self, s3_file):
+    def get_encodings(self, s3_file):
+        """
+        Returns the (encoding, key extension) compressed variants created
+        for the prepared file.
         """
-        Handles the s3 delete processing of the given file
+        encodings = []
+        if self.do_gzip:
+            encodings.append('gzip')
+        if self.do_brotli:
+            encodings.append('br')
+
+        if not encodings or self.dry_run or \
+                s3_file.headers.get('Content-Type') not in self.GZIP_CONTENT_TYPES:
+            return []
+        # Compressing only if file is large enough (>1K recommended) 
+        if s3_file.size <= 1024:
+            if self.verbosity > 0:
+                print "Skipping gzip on %s, less than 1k" % s3_file.file_key
+            return []
+        return [ (encoding, extension) for encoding, extension in COMPRESSED_VARIANTS \
+                    if encoding in encodings ]
+
+    def compress_variants(self, s3_file):
+        """
+        Returns the compressed variants of the prepared file.
+        """
+        variants = []
+        for encoding, extension in self.get_encodings(s3_file):
+            compressed_filename, temporary = self.compress(s3_file, encoding)
+            variants.append((encoding, extension, compressed_filename, temporary,))
+        return variants
+
+    def copy_variants(self, s3_file):
         """
+        Returns the variants of a file copied on S3, there's nothing to compress.
+        """
+        return [ (encoding, extension, None, False,) \
+                    for encoding, extension in self.get_encodings(s3_file) ]
+
+    def remove_variants(self, variants):
+        """
+        Removes the temporary compressed files of the variants.
+        """
+        for encoding, extension, compressed_filename, temporary in variants:
+            if temporary:
+                os.remove(compressed_filename)
+
+    def compress(self, s3_file, encoding):
+        """
+        Compresses the file with the given encoding.  Returns the compressed
+        filename and whether it is a temporary file.  The compression cache
+        is used when configured.
+        """
+        if self.compress_cache is None:
+            return compress_file(s3_file.filename, encoding), True
+
+        level = COMPRESS_LEVELS[encoding]
+        cached_filename = self.compress_cache.lookup(s3_file.digest, encoding, level)
+        if cached_filename:
+            if self.verbosity > 1:
+                print "\tusing cached %s of %s" % (encoding, s3_file.file_key)
+            return cached_filename, False
+
+        temp_filename = compress_file(s3_file.filename, encoding, level,
+                                      self.compress_cache.temp_filename())
+        return self.compress_cache.store(s3_file.digest, encoding, level, temp_filename), False
+
+    def run(self, s3_file=None):
+        """ 
+        Runs the worker process. Takes the next file to work on from the
+        queue until the end of queue marker (None) is received.  A worker
+        restarted by the supervisor starts with the file of the crashed one.
+        """
+        self.reset()
+        while True:
+            if s3_file is None:
+                s3_file = get_item(self.get_queue())
+                if s3_file is None:
+                    # a worker crashing from here on is restarted with a new marker
+                    self.report('stopping')
+                    break
+            self.report('busy', s3_file)
+            try:
+                self.process(s3_file)
+            except Exception, e:
+                # the failed file is reported, the worker moves on to the next file
+                print "Failed %s: %s (worker: %d)" % (getattr(s3_file, 'file_key', s3_file),
+                                                      e, self.num)
+                self.failed_count += 1
+                self.emit('failed', getattr(s3_file, 'file_key', None), error=str(e))
+            self.report('idle')
+            s3_file = None
+
+        for manifest in self.manifests or ():
+            manifest.close()
+            
         if self.verbosity > 0:
-            print "Deleting file key %s (worker: %d)" % (s3_file.file_key, self.num)
-        if not self.dry_run:
-            self.bucket.delete_key(s3_file.file_key)
+            print "Finished processing files (worker: %d)" % self.num
             
-            # delete the gzipped file also if present
-            gz_filename, gz_ext = os.path.splitext(s3_file.file_key)
-            gz_file_key = ''.join([gz_filename, '.gz', gz_ext])
-            if self.bucket.get_key(gz_file_key):
-                if self.verbosity > 0:
-                    print "Deleting gzip file key %s (worker: %d)" % (gz_file_key, self.num)
-                self.bucket.delete_key(gz_file_key)
-        self.delete_count += 1
+        if self.verbosity > 1:
+            if self.upload_count:
+                print "\tUploaded %d files" % self.upload_count
+            if self.skip_count:
+                print "\tSkipped %d files" % self.skip_count
+            if self.delete_count:
+                print "\tDeleted %d files" % self.delete_count
+            if self.copy_count:
+                print "\tCopied %d files" % self.copy_count
+            if self.retry_count:
+                print "\tRetried %d requests" % self.retry_count
+            if self.failed_count:
+                print "\tFailed %d files" % self.failed_count
+
+        self.report('exited')
+        if self.failed_count:
+            # the failures are reported in the worker exit code
+            sys.exit(1)
+
+
+# the worker process hook
+S3Worker.__call__ = S3Worker.run
+
+
+class S3PrepareWorker(S3Worker):
+    """
+    The CPU bound stage of the pipeline.  Checks the queued files for
+    changes, digests and gzips the changed files and passes them on to
+    the upload stage.
+    """
+    def get_queue(self):
+        return get_queue()
+
+    def get_key_info(self, destination, file_key):
+        """
+        Looks up the S3 details of the file key in the destination.  Uses the
+        bucket index when available, otherwise a HEAD request is made.
+        """
+        bucket_index = self.destinations[destination].bucket_index
+        if bucket_index is not None:
+            return bucket_index.get(file_key)
+        s3_key = self.request('HEAD', self.get_bucket(destination).get_key, file_key)
+        if s3_key:
+            return S3KeyInfo.from_key(s3_key)
+        return None
+
+    def get_remote_md5(self, destination, s3_key):
+        """
+        Returns the MD5 digest of the S3 key.  Single part uploads use the
+        MD5 as the ETag, multipart uploads store it in the key metadata.
+        """
+        if '-' not in s3_key.etag:
+            return s3_key.etag
+        remote_key = self.request('HEAD', self.get_bucket(destination).get_key, s3_key.name)
+        if remote_key:
+            return remote_key.get_metadata(MD5_METADATA)
+        return None
 
-    def upload_s3(self, s3_file):
+    def has_changed(self, s3_file, target, s3_key):
         """
-        Handles the s3 upload processing of the given file 
+        Compares the local file against the S3 key using the configured
+        compare mode (mtime, hash or size).  The file is digested once for
+        all of the targets.
+        """
+        file_stat = s3_file.stat or os.stat(s3_file.filename)
+        if self.compare == 'size':
+            return file_stat.st_size != s3_key.size
+        elif self.compare == 'hash':
+            if file_stat.st_size != s3_key.size:
+                return True
+            if not s3_file.digest:
+                s3_file.digest = file_md5(s3_file.filename)
+            return s3_file.digest != self.get_remote_md5(target.destination, s3_key)
+        local_datetime = datetime.datetime.utcfromtimestamp(file_stat.st_mtime)
+        return not local_datetime < s3_key.last_modified
+
+    def headers_changed(self, s3_file, target, s3_key):
+        """
+        Returns True if the key was pushed with other headers, as far as
+        known from the key metadata (HEAD) or the manifest.
+        """
+        fingerprint = s3_key.fingerprint or target.last_fingerprint
+        return fingerprint is not None and fingerprint != s3_file.fingerprint
+
+    def check_target(self, s3_file, target):
+        """
+        Returns False if the key of the target is current and can be
+        skipped, the key only needing new headers is marked.
+        """
+        s3_key = self.get_key_info(target.destination, target.file_key)
+        if not s3_key or self.has_changed(s3_file, target, s3_key):
+            return True
+        if self.headers_changed(s3_file, target, s3_key):
+            target.headers_only = True
+            return True
+
+        self.skip_count += 1
+        self.record_manifest(s3_file, target, s3_key.etag)
+        self.emit('skipped', self.get_event_key(target), s3_key.size)
+        if self.verbosity > 1:
+            print "File %s hasn't changed since last uploade" % self.get_event_key(target)
+        return False
+
+    def prepare(self, s3_file):
+        """
+        Builds the headers, digest and gzipped copy of the given file.  The
+        targets with a current key are dropped.  Returns False if the file
+        hasn't changed in any of them and can be skipped.
         """
-        file_key = s3_file.file_key
         filename = s3_file.filename
-        headers = {}
-      
-        content_type = mimetypes.guess_type(filename)[0]
-        if content_type:
-            headers['Content-Type'] = content_type
-        
-        # Check if file on S3 is older than local file, if so, upload
+        s3_file.headers = build_headers(s3_file.rel_key, filename, self.policy)
+        s3_file.fingerprint = upload_fingerprint(s3_file.headers, self.do_gzip, self.do_brotli)
+        s3_file.headers['x-amz-meta-%s' % FINGERPRINT_METADATA] = s3_file.fingerprint
+
+        # Check if file on S3 differs from the local file, if so, upload
         if not self.do_force:
-            s3_key = self.bucket.get_key(file_key)
-            if s3_key:
-                s3_datetime = datetime.datetime(*time.strptime(
-                    s3_key.last_modified, "%a, %d %b %Y %H:%M:%S %Z")[0:6])
-                local_datetime = datetime.datetime.utcfromtimestamp(
-                    os.stat(filename).st_mtime)
-                if local_datetime < s3_datetime:
-                    self.skip_count += 1
-                    if self.verbosity > 1:
-                        print "File %s hasn't changed since last uploade" % file_key
-                    return
+            s3_file.targets = [ target for target in s3_file.targets \
+                                  if self.check_target(s3_file, target) ]
+            if not s3_file.targets:
+                return False
 
-        if self.verbosity > 0:
-            print "Uploading %s (worker: %d)" % (file_key, self.num)
-        
+        if s3_file.stat is None:
+            s3_file.stat = os.stat(filename)
+        s3_file.size = s3_file.stat.st_size
+        if not s3_file.digest:
+            s3_file.digest = file_md5(filename)
+        s3_file.headers['x-amz-meta-%s' % MD5_METADATA] = s3_file.digest
+
+        upload = False
+        for target in s3_file.targets:
+            if target.headers_only and not self.dry_run:
+                # the content is current, the key (and its variants) is copied
+                # onto itself with the new headers
+                target.copy_source = target.file_key
+                if self.verbosity > 1:
+                    print "\t%s has new headers" % self.get_event_key(target)
+            elif self.find_copy_source(s3_file, target):
+                # the compressed variants are copied from the source variants
+                if self.verbosity > 1:
+                    print "\t%s has the content of %s" % (self.get_event_key(target),
+                                                           target.copy_source)
+            else:
+                upload = True
+
+        # compressed once for all of the targets uploading the file
+        if upload and self.do_compress:
+            s3_file.variants = self.compress_variants(s3_file)
+        else:
+            s3_file.variants = self.copy_variants(s3_file)
+        return True
+
+    def find_copy_source(self, s3_file, target):
+        """
+        Looks for an S3 key with the same content in the target destination
+        to copy instead of sending the file: the svn copy source if its
+        digest matches, a file of the run with the same content and headers,
+        or a key of the bucket index with the same ETag.  The copies of files
+        in the run are deferred until the source file is uploaded.  Returns
+        True if a source was found.
+        """
+        if self.copy_registry is None or self.dry_run or \
+                not MIN_COPY_SIZE <= s3_file.size <= MAX_COPY_SIZE:
+            return False
+
+        copy_hint = target.copy_hint
+        if copy_hint and os.path.splitext(copy_hint)[1] == os.path.splitext(target.file_key)[1]:
+            s3_key = self.get_key_info(target.destination, copy_hint)
+            if s3_key and s3_key.size == s3_file.size and \
+                    self.get_remote_md5(target.destination, s3_key) == s3_file.digest:
+                target.copy_source = copy_hint
+                return True
+
+        # the first file of the run with the content is uploaded, the others copy it
+        source = self.copy_registry.setdefault('%d:%s:%s' % (
+            target.destination, s3_file.digest, s3_file.fingerprint), target.file_key)
+        if source != target.file_key:
+            target.copy_source = source
+            target.deferred = True
+            return True
+
+        # an existing key only has matching variants if it is one of the copies
+        bucket_index = self.destinations[target.destination].bucket_index
+        if bucket_index is not None and not self.get_encodings(s3_file):
+            source = bucket_index.find_digest(s3_file.digest)
+            if source and source != target.file_key:
+                target.copy_source = source
+                return True
+        return False
+
+    def process(self, s3_file):
+        if s3_file.do_upload() and not self.prepare(s3_file):
+            return
+        if isinstance(s3_file, S3File) and s3_file.is_deferred():
+            get_copy_queue().put(s3_file)
+        else:
+            put_item(get_upload_queue(), s3_file)
+
+
+class S3UploadWorker(S3Worker):
+    """
+    The network stage of the pipeline.  Uploads the prepared files and
+    deletes the removed files.  The targets of a file are pushed
+    concurrently, each destination with its own connection.
+    """
+    def get_queue(self):
+        return get_upload_queue()
+
+    def get_part_bucket(self, destination, num):
+        """
+        Returns the bucket connection of the destination used by the given
+        multipart thread.  The connections are kept open and reused for the
+        following uploads.
+        """
+        if (destination, num,) not in self.part_buckets:
+            self.part_buckets[(destination, num,)] = \
+                self.destinations[destination].connect(validate=False)
+        return self.part_buckets[(destination, num,)]
+
+    def upload_parts(self, destination, num, upload_id, file_key, filename, parts, errors):
+        """
+        Sends the queued multipart upload parts of the file.  Each part
+        is streamed from its offset in the file.
+        """
+        mp = boto.s3.multipart.MultiPartUpload(self.get_part_bucket(destination, num))
+        mp.key_name = file_key
+        mp.id = upload_id
+        while not errors:
+            try:
+                part_num, offset, size = parts.popleft()
+            except IndexError:
+                break
+            try:
+                self.request('PUT', self.put_part, mp, filename, part_num, offset, size)
+            except Exception, e:
+                errors.append(e)
+            if self.verbosity > 1:
+                print "\tsent part %d of %s (worker: %d)" % (part_num, file_key, self.num)
+
+    def put_part(self, mp, filename, part_num, offset, size):
+        """
+        Sends a single multipart upload part streamed from its file offset.
+        """
         file_obj = open(filename, 'rb')
-        filedata = file_obj.read()
-        file_size = os.fstat(file_obj.fileno()).st_size
+        try:
+            file_obj.seek(offset)
+            mp.upload_part_from_file(file_obj, part_num, size=size)
+        finally:
+            file_obj.close()
+
+    def upload_multipart(self, destination, file_key, filename, file_size, headers):
+        """
+        Uploads the file with an S3 multipart upload, sending the parts in
+        parallel.  Returns the ETag of the completed upload.
+        """
+        parts = deque()
+        for part_num, offset in enumerate(xrange(0, file_size, self.part_size)):
+            parts.append((part_num + 1, offset, min(self.part_size, file_size - offset),))
+
+        mp = self.request('POST', self.get_bucket(destination).initiate_multipart_upload,
+                          file_key, headers=headers)
+        errors = []
+        threads = [ threading.Thread(target=self.upload_parts,
+                        args=(destination, num, mp.id, file_key, filename, parts, errors)) \
+                            for num in xrange(min(self.part_threads, len(parts))) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            mp.cancel_upload()
+            raise errors[0]
+        return self.request('POST', mp.complete_upload).etag.strip('"')
+
+    def upload_file(self, destination, file_key, filename, headers, digest=None):
+        """
+        Streams the file to the given key, switching to a multipart upload
+        above the multipart threshold.  Returns the ETag of the new key.
+        """
+        file_size = os.stat(filename).st_size
+        if file_size > self.multipart_threshold:
+            etag = self.upload_multipart(destination, file_key, filename, file_size, headers)
+        else:
+            etag = self.request('PUT', self.put_file, destination, file_key, filename,
+                                headers, digest)
+        return etag
+
+    def put_file(self, destination, file_key, filename, headers, digest=None):
+        """
+        Sends the file with a single PUT request.  Returns the ETag.
+        """
+        s3_key = self.get_s3_key(destination)
+        file_obj = open(filename, 'rb')
+        try:
+            s3_key.name = file_key
+            s3_key.set_contents_from_file(file_obj, headers, replace=True,
+                md5=digest and md5_tuple(digest) or None)
+            return digest or (s3_key.etag or '').strip('"')
+        finally:
+            file_obj.close()
+
+    def delete_s3(self, destination, file_keys):
+        """
+        Deletes the file keys of the destination with a single multi-object
+        delete request.
+        """
+        event_key = self.destinations[destination].get_event_key(file_keys[0])
+        if self.verbosity > 0:
+            print "Deleting %d file keys of %s (worker: %d)" % (len(file_keys),
+                self.destinations[destination].name, self.num)
+        if self.verbosity > 1:
+            for file_key in file_keys:
+                print "\t%s" % file_key
+
+        errors = []
+        if not self.dry_run:
+            errors = self.request('DELETE', self.get_bucket(destination).delete_keys,
+                                  file_keys, quiet=True).errors
+            for error in errors:
+                print "Failed to delete %s: %s" % (error.key, error.message)
+
+            if self.manifests:
+                try:
+                    self.manifests[destination].remove_keys(file_keys)
+                except sqlite3.Error, e:
+                    print "Unable to remove the deleted keys from the manifest: %s" % e
+        self.delete_count += len(file_keys) - len(errors)
+        self.emit('deleted', event_key, keys=len(file_keys) - len(errors),
+                  error=errors and '%s: %s' % (errors[0].key, errors[0].message) or None,
+                  failed=len(errors))
+
+    def copy_key(self, destination, file_key, source_key, headers):
+        """
+        Copies the source key to the file key on S3 (server-side) with the
+        headers and metadata of the new file.
+        """
+        metadata = dict([ (name[len('x-amz-meta-'):], value) for name, value in headers.items() \
+                            if name.startswith('x-amz-meta-') ])
+        copy_headers = dict([ (name, value) for name, value in headers.items() \
+                                if not name.startswith('x-amz-meta-') ])
+        self.request('COPY', self.get_bucket(destination).copy_key, file_key,
+                     self.destinations[destination].bucket_name, source_key,
+                     metadata=metadata, headers=copy_headers)
+
+    def copy_s3(self, s3_file, target):
+        """
+        Copies the content of the file (and its compressed variants) from the
+        source key with the same content.  The file is uploaded if the copy
+        fails, for example when the source upload failed.
+        """
+        file_key = target.file_key
+        source_key = target.copy_source
+        headers = s3_file.headers
+
+        if self.verbosity > 0:
+            print "Copying %s from %s (worker: %d)" % (self.get_event_key(target), source_key,
+                                                       self.num)
+
+        try:
+            if not self.dry_run:
+                self.copy_key(target.destination, file_key, source_key, headers)
+                for encoding, extension, compressed_filename, temporary in s3_file.variants:
+                    variant_headers = dict(headers)
+                    variant_headers['Content-Encoding'] = encoding
+                    self.copy_key(target.destination, variant_key(file_key, extension),
+                                  variant_key(source_key, extension), variant_headers)
+        except boto.exception.S3ResponseError, e:
+            if self.verbosity > 0:
+                print "Unable to copy %s (%s), uploading (worker: %d)" % (
+                    self.get_event_key(target), e, self.num)
+            target.copy_source = None
+            if s3_file.variants and s3_file.variants[0][2] is None:
+                # only copies were planned, the variants are compressed for this target
+                variants = self.compress_variants(s3_file)
+                try:
+                    self.upload_s3(s3_file, target, variants)
+                finally:
+                    self.remove_variants(variants)
+            else:
+                self.upload_s3(s3_file, target)
+            return
+
+        self.copy_count += 1
+        self.record_manifest(s3_file, target, s3_file.digest)
+        self.emit('copied', self.get_event_key(target), s3_file.size)
+
+    def upload_s3(self, s3_file, target, variants=None):
+        """
+        Handles the s3 upload processing of the given prepared file 
+        """
+        file_key = target.file_key
+        headers = s3_file.headers
+        if variants is None:
+            variants = s3_file.variants
+
+        if self.verbosity > 0:
+            print "Uploading %s (worker: %d)" % (self.get_event_key(target), self.num)
                                 
-        if self.do_expires:
-            # HTTP/1.0
-            headers['Expires'] = "%s GMT" % (email.Utils.formatdate(
-                time.mktime((datetime.datetime.now() +
-                datetime.timedelta(days=365*2)).timetuple())))
-            
-            # HTTP/1.1
-            headers['Cache-Control'] = "max-age %d" % (3600 * 24 * 365 * 2)
-            if self.verbosity > 1:
-                print "\texpires: %s" % (headers['Expires'])
-                print "\tcache-control: %s" % (headers['Cache-Control'])
+        if self.verbosity > 1:
+            for name in ('Expires', 'Cache-Control', 'x-amz-acl', 'x-amz-storage-class',):
+                if name in headers:
+                    print "\t%s: %s" % (name.lower(), headers[name])
 
+        etag = s3_file.digest
+        sent = s3_file.size
         try:
             if not self.dry_run:
-                self.key.name = file_key
-                self.key.set_contents_from_string(filedata, headers, replace=True)
-                self.key.make_public()
+                etag = self.upload_file(target.destination, file_key, s3_file.filename,
+                                        headers, s3_file.digest)
                 
-            if self.do_gzip and not self.dry_run:
-                
-                # Gzipping only if file is large enough (>1K recommended) 
-                if file_size > 1024 and content_type in self.GZIP_CONTENT_TYPES:
-                    headers['Content-Encoding'] = 'gzip'
-                    gzip_filedata = self.compress_string(filedata)
-                    gz_filename, gz_ext = os.path.splitext(file_key)
-                    
-                    self.key.name = ''.join([gz_filename, '.gz', gz_ext])
-                    self.key.set_contents_from_string(gzip_filedata, headers, replace=True)
-                    self.key.make_public()
-                    if self.verbosity > 1:
-                        print "\tgzipped: %dk to %dk" % (file_size / 1024, len(gzip_filedata) / 1024)
-                        
-                elif self.verbosity > 0 and file_size < 1024 and content_type in self.GZIP_CONTENT_TYPES:
-                    print "Skipping gzip on %s, less than 1k" % file_key
+            for encoding, extension, compressed_filename, temporary in variants:
+                if self.dry_run:
+                    break
+                variant_headers = dict(headers)
+                variant_headers['Content-Encoding'] = encoding
+                self.upload_file(target.destination, variant_key(file_key, extension),
+                                 compressed_filename, variant_headers)
+                sent += os.stat(compressed_filename).st_size
+                if self.verbosity > 1:
+                    print "\t%s: %dk to %dk" % (encoding, s3_file.size / 1024,
+                        os.stat(compressed_filename).st_size / 1024)
                 
         except boto.s3.connection.S3CreateError, e:
             print "Failed: %s" % e
+            self.failed_count += 1
+            self.emit('failed', self.get_event_key(target), error=str(e))
+        else:
+            self.upload_count += 1
+            self.record_manifest(s3_file, target, etag)
+            self.emit('uploaded', self.get_event_key(target), sent)
+
+    def push_target(self, s3_file, target):
+        """
+        Deletes, copies or uploads the file in the target destination.  The
+        failure of a target is reported without stopping the other targets.
+        """
+        try:
+            if s3_file.do_delete():
+                self.delete_s3(target.destination,
+                               [ target.file_key ] + variant_keys(target.file_key))
+            elif target.copy_source:
+                self.copy_s3(s3_file, target)
+            else:
+                self.upload_s3(s3_file, target)
         except Exception, e:
-            print e
+            print "Failed %s: %s (worker: %d)" % (self.get_event_key(target), e, self.num)
+            self.failed_count += 1
+            self.emit('failed', self.get_event_key(target), error=str(e))
+
+    def push_targets(self, s3_file):
+        """
+        Pushes the file to its targets, concurrently when there are several
+        (the file is read from the page cache by the other targets).  The
+        temporary compressed files are removed once all of them are done.
+        """
+        try:
+            if len(s3_file.targets) == 1:
+                self.push_target(s3_file, s3_file.targets[0])
+            else:
+                threads = [ threading.Thread(target=self.push_target, args=(s3_file, target,)) \
+                                for target in s3_file.targets ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            self.remove_variants(s3_file.variants)
+
+    def process(self, s3_file):
+        if isinstance(s3_file, S3DeleteBatch):
+            self.delete_s3(s3_file.destination, s3_file.file_keys)
+        else:
+            self.push_targets(s3_file)
+
+
+class S3PlanWorker(S3UploadWorker):
+    """
+    The upload stage of a planning run (--plan), runs as a thread of the
+    command.  Writes the prepared files and the deletes to the plan and
+    reports them as done for the run summary.
+    """
+    def __init__(self, *args, **kwargs):
+        self.plan = kwargs.pop('plan')
+        S3UploadWorker.__init__(self, *args, **kwargs)
+
+    def process(self, s3_file):
+        if isinstance(s3_file, S3DeleteBatch):
+            self.plan_delete(s3_file.destination, s3_file.file_keys)
+        elif s3_file.do_delete():
+            for target in s3_file.targets:
+                self.plan_delete(target.destination,
+                                 [ target.file_key ] + variant_keys(target.file_key))
+        else:
+            self.plan.add_file(s3_file)
+            for target in s3_file.targets:
+                if self.verbosity > 0:
+                    print "Planned %s %s" % (target.copy_source and 'copy of' or 'upload of',
+                                             self.get_event_key(target))
+                self.emit(target.copy_source and 'copied' or 'uploaded',
+                          self.get_event_key(target), s3_file.size)
+
+    def plan_delete(self, destination, file_keys):
+        self.plan.add_delete(destination, file_keys)
+        if self.verbosity > 0:
+            print "Planned delete of %d file keys of %s" % (len(file_keys),
+                self.destinations[destination].name)
+        self.emit('deleted', self.destinations[destination].get_event_key(file_keys[0]),
+                  keys=len(file_keys))
+
+
+class S3ApplyWorker(S3PrepareWorker):
+    """
+    The prepare stage of s3-apply.  The change checks and copy sources were
+    decided by the plan, the uploaded files are only digested again (the
+    multipart uploads have no Content-MD5 check) and compressed.
+    """
+    def prepare(self, s3_file):
+        """
+        Compresses the planned file, returns False if the file no longer has
+        the planned size or content.
+        """
+        try:
+            s3_file.stat = os.stat(s3_file.filename)
+        except OSError:
+            s3_file.stat = None
+        changed = s3_file.stat is None or s3_file.stat.st_size != s3_file.size
+
+        # the copies don't send the file, the uploads (and the compression cache
+        # entries stored under the digest) must have the planned content
+        upload = [ target for target in s3_file.targets if not target.copy_source ]
+        if upload and not changed:
+            changed = file_md5(s3_file.filename) != s3_file.digest
+
+        if changed:
+            for target in s3_file.targets:
+                print "Failed %s: changed since the plan (worker: %d)" % (
+                    self.get_event_key(target), self.num)
+                self.failed_count += 1
+                self.emit('failed', self.get_event_key(target), error='changed since the plan')
+            return False
+
+        if upload:
+            s3_file.variants = self.compress_variants(s3_file)
+        else:
+            s3_file.variants = self.copy_variants(s3_file)
+        return True
+
+
+class S3WorkerThread(threading.Thread):
+    """
+    Runs a worker in a thread of the current process.  Sets the exitcode
+    the same way as a worker process.
+    """
+    def __init__(self, worker, args=()):
+        threading.Thread.__init__(self, target=worker, args=args)
+        self.daemon = True
+        self.exitcode = None
+
+    def run(self):
+        try:
+            threading.Thread.run(self)
+        except:
+            self.exitcode = 1
             raise
         else:
-            self.upload_count += 1
-        
-        if file_obj:
-            file_obj.close()
-    
+            self.exitcode = 0
+
+
+class S3WorkerPool(object):
+    """
+    The running pipeline stages.  The workers are started once and keep
+    their S3 connections open for all of the queued files, so a long
+    running command (s3-push --watch) can feed the pool as the changes come
+    in.  The bucket is checked once before the workers start, the workers
+    connect inside their processes.  A supervisor restarts the crashed
+    workers.  The worker events are collected into the metrics until the
+    pool is stopped.
+    """
+    def __init__(self, prepare_workers, upload_workers, engine='processes',
+                 metrics=None, show_progress=False, journal=None):
+        self.prepare_workers = prepare_workers
+        self.upload_workers = upload_workers
+        self.engine = engine
+        if metrics is None:
+            metrics = RunMetrics(None, None)
+        self.metrics = metrics
+        self.collector = MetricsCollector(get_result_queue(), metrics, show_progress,
+                                          journal=journal)
+        self.copy_collector = S3QueueCollector(get_copy_queue())
+        self.supervisor = S3WorkerSupervisor(metrics)
+        self.prepare_started = []
+        self.upload_started = []
+        self.started = []
+
+    def start(self):
+        workers = self.upload_workers or self.prepare_workers
+        if workers:
+            # the only bucket checks (or creates) of the run
+            for destination in workers[0].destinations:
+                destination.connect()
+        self.collector.start()
+        self.copy_collector.start()
+        self.upload_started = self.start_stage(self.upload_workers, self.engine)
+        self.prepare_started = self.start_stage(self.prepare_workers)
+        self.supervisor.start()
+
+    def start_stage(self, workers, engine='processes'):
+        """
+        Starts a run of the stage workers under the supervisor.  The
+        supervisor replaces the crashed workers in the returned list.
+        """
+        started = start_workers(workers, engine)
+        self.supervisor.add_stage(workers, started, engine)
+        self.started.append(started)
+        return started
+
+    def join_stage(self, started):
+        """
+        Waits for the stage workers to exit, including the workers restarted
+        while waiting.
+        """
+        while True:
+            alive = [ worker for worker in started if worker.is_alive() ]
+            # the exits seen before the check are confirmed (or restarted) by it
+            self.supervisor.check()
+            restarted = [ worker for worker in started if worker.is_alive() ]
+            if not alive and not restarted:
+                return
+            for worker in restarted:
+                worker.join(SUPERVISE_INTERVAL)
+
+    def run_upload_stage(self, s3_files):
+        """
+        Runs the prepared S3 files through a new run of the upload workers.
+        """
+        started = self.start_stage(self.upload_workers, self.engine)
+        for s3_file in s3_files:
+            put_item(get_upload_queue(), s3_file, started)
+        for worker in started:
+            put_item(get_upload_queue(), None, started)
+        self.join_stage(started)
+
+    def put(self, s3_file):
+        """
+        Queues the S3 file (or delete batch) into the prepare stage.
+        """
+        s3_stat = getattr(s3_file, 'stat', None)
+        self.metrics.queue(s3_stat and s3_stat.st_size or 0,
+                           len(getattr(s3_file, 'targets', None) or [None]))
+        put_item(get_queue(), s3_file, self.prepare_started)
+
+    def stop(self, final_files=()):
+        """
+        Stops the stages once the queued files are done, then sends the
+        deferred copies and the final files.  Returns the sum of the
+        worker exit codes.
+        """
+        try:
+            # end of queue markers, the upload stage is closed once the prepare stage is done
+            for worker in self.prepare_started:
+                put_item(get_queue(), None, self.prepare_started)
+            self.join_stage(self.prepare_started)
+            get_copy_queue().put(None)
+            for worker in self.upload_started:
+                put_item(get_upload_queue(), None, self.upload_started)
+            self.join_stage(self.upload_started)
+
+            # the sources of the deferred copies are uploaded
+            self.copy_collector.join()
+            for s3_files in (self.copy_collector.items, final_files,):
+                if s3_files:
+                    self.run_upload_stage(s3_files)
+        except RuntimeError, e:
+            print e
+        return self.finish()
+
+    def finish(self):
+        """
+        Stops the supervisor and the collector after the last event of the
+        exited workers.  The exit codes of the restarted workers replace
+        those of the crashed ones.
+        """
+        self.supervisor.stop()
+        get_result_queue().put(None)
+        self.collector.join()
+        self.metrics.finish()
+        if self.supervisor.restarts:
+            print "Restarted %d crashed workers" % self.supervisor.restarts
+        return sum([ abs(worker.exitcode or 0) for started in self.started \
+                        for worker in started ]) + self.supervisor.failed
+
+
+class S3WorkerSupervisor(threading.Thread):
+    """
+    Watches the stage workers of a pool.  The workers report the file they
+    are busy with on the status queue, a worker exiting without reporting
+    its exit is restarted with that file (once a file has crashed
+    MAX_ITEM_CRASHES workers it is failed instead).  A worker crashing after
+    it took the end of queue marker is restarted with a new marker.  At
+    most MAX_RESTARTS workers are restarted per pool.
+    """
+    def __init__(self, metrics=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.reader = threading.Thread(target=self.read_status)
+        self.reader.daemon = True
+        self.workers = {}
+        self.in_flight = {}
+        self.exited = set()
+        self.stopping = set()
+        self.crashes = {}
+        self.restarts = 0
+        self.failed = 0
+
+    def add_stage(self, workers, started, engine='processes'):
+        """
+        Supervises a run of the stage workers, a new run of the same
+        workers replaces the last one.
+        """
+        self.condition.acquire()
+        try:
+            for num, worker in enumerate(workers):
+                worker_id = (worker.__class__.__name__, worker.num,)
+                self.workers[worker_id] = (worker, started, num, engine,)
+                self.in_flight.pop(worker_id, None)
+                self.exited.discard(worker_id)
+                self.stopping.discard(worker_id)
+        finally:
+            self.condition.release()
+
     def run(self):
-        """ 
-        Runs the worker process. Uses the queue to find the next
-        file to work on.
+        self.reader.start()
+        while not self.stopped.is_set():
+            self.check()
+            self.stopped.wait(SUPERVISE_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+            self.check()
+            get_status_queue().put(None)
+            self.reader.join()
+
+    def read_status(self):
+        """
+        Reads the worker reports until the end of queue marker (None).
         """
         while True:
-            if get_queue().empty():
+            report = get_status_queue().get()
+            if report is None:
                 break
+            worker_id, state, item = report
+            self.condition.acquire()
             try:
-                s3_file = get_queue().get()
-            except:
+                if state == 'busy':
+                    self.in_flight[worker_id] = item
+                elif state == 'idle':
+                    self.in_flight.pop(worker_id, None)
+                elif state == 'stopping':
+                    self.in_flight.pop(worker_id, None)
+                    self.stopping.add(worker_id)
+                elif state == 'exited':
+                    self.in_flight.pop(worker_id, None)
+                    self.exited.add(worker_id)
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+
+    def check(self):
+        """
+        Restarts the workers that exited without reporting it.
+        """
+        self.condition.acquire()
+        try:
+            for worker_id, (worker, started, num, engine) in self.workers.items():
+                process = started[num]
+                if process.is_alive() or process.exitcode is None or \
+                        worker_id in self.exited:
+                    continue
+                # the exit report is written before the worker ends, but
+                # may not have been read yet
+                deadline = time.time() + SUPERVISE_INTERVAL
+                while worker_id not in self.exited and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                # the wait releases the lock, another check may have restarted it
+                if worker_id not in self.exited and started[num] is process:
+                    self.restart(worker, worker_id, started, num, engine)
+        finally:
+            self.condition.release()
+
+    def restart(self, worker, worker_id, started, num, engine):
+        item = self.in_flight.pop(worker_id, None)
+        file_key = getattr(item, 'file_key', item)
+        if item is not None:
+            crash_key = file_key
+            if isinstance(item, S3DeleteBatch):
+                crash_key = tuple(item.file_keys)
+            self.crashes[crash_key] = self.crashes.get(crash_key, 0) + 1
+            if self.crashes[crash_key] >= MAX_ITEM_CRASHES:
+                print "Failed %s: crashed %d workers" % (file_key, self.crashes[crash_key])
+                self.failed += 1
+                get_result_queue().put(('failed', getattr(item, 'file_key', None), 0,
+                                        1, (), 'worker crashed', 0,))
+                item = None
+
+        if self.restarts >= MAX_RESTARTS:
+            print "Not restarting %s %d (exit code %s), restart limit reached" % (
+                worker_id[0], worker.num, started[num].exitcode)
+            if item is not None:
+                self.failed += 1
+                get_result_queue().put(('failed', getattr(item, 'file_key', None), 0,
+                                        1, (), 'worker crashed', 0,))
+            # the worker stays down, its exit code is kept
+            self.exited.add(worker_id)
+            return
+
+        self.restarts += 1
+        if self.metrics is not None:
+            self.metrics.restart()
+        if worker_id in self.stopping:
+            # the crashed worker took the end of queue marker of its replacement
+            self.stopping.discard(worker_id)
+            put_item(worker.get_queue(), None)
+        print "Restarted %s %d (exit code %s)%s" % (worker_id[0], worker.num,
+            started[num].exitcode, item is not None and ', retrying %s' % file_key or '')
+        started[num] = start_workers([worker], engine, (item,))[0]
+
+
+class S3QueueCollector(threading.Thread):
+    """
+    Collects the items of a queue until the end of queue marker (None).
+    """
+    def __init__(self, queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.items = []
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
                 break
+            self.items.append(item)
+
+
+class S3SyncCommand(BaseCommand):
+    """
+    The base of the commands synchronizing the changes of a version control
+    working copy (s3-svnsync, s3-gitsync).  The command sets the
+    destinations, shard, plan, dryrun and verbosity and looks up the changed
+    files of a range of revisions, sync_changes() runs them through the
+    workers.
+    """
+    # the command name in the run metrics and the journal file names
+    SYNC_NAME = None
+
+    def sync_changes(self, changed_files, destinations, journal, options):
+        """
+        Runs the changed files through the workers, to the given
+        destinations.  The operations completed in the journal are skipped,
+        the remaining ones are registered.  The deletions are sent in
+        multi-object delete batches once the uploads are done (a moved file
+        may be copied from a deleted key).  Returns the worker exit code.
+        """
+        s3_files = []
+        delete_keys = set()
+        for s3_file in changed_files:
+            s3_file.targets = [ target for target in s3_file.targets \
+                                  if target.destination in destinations ]
+
+            # the files of the other shards are synchronized by their hosts
+            if not self.is_shard_file(s3_file):
+                continue
+            if s3_file.do_upload():
+                if journal is not None:
+                    targets = []
+                    for target in s3_file.targets:
+                        event_key = self.get_event_key(target.destination, target.file_key)
+                        if journal.is_done('put:%s' % event_key):
+                            continue
+                        journal.expect(event_key, [('put:%s' % event_key, '',)])
+                        targets.append(target)
+                    s3_file.targets = targets
+                if s3_file.targets:
+                    s3_files.append(s3_file)
             else:
-                if s3_file.do_delete():
-                    self.delete_s3(s3_file)
-                else:
-                    self.upload_s3(s3_file)
-            
-        if self.verbosity > 0:
-            print "Finished processing files (worker: %d)" % self.num
-            
-        if self.verbosity > 1:
-            if self.upload_count:
-                print "\tUploaded %d files" % self.upload_count
-            if self.skip_count:
-                print "\tSkipped %d files" % self.skip_count
-            if self.delete_count:
-                print "\tDeleted %d files" % self.delete_count
+                for target in s3_file.targets:
+                    delete_keys.update([ (target.destination, file_key,) for file_key in \
+                                           self.get_delete_keys(s3_file, target) ])
 
+        if journal is not None:
+            delete_keys = [ (destination, file_key,) for destination, file_key in delete_keys \
+                if not journal.is_done('del:%s' % self.get_event_key(destination, file_key)) ]
+        delete_batches = []
+        for num, destination in enumerate(self.destinations):
+            delete_batches.extend(S3DeleteBatch.create_batches(destination.bucket_name,
+                sorted([ file_key for key_num, file_key in delete_keys if key_num == num ]),
+                destination=num))
+        if journal is not None:
+            for batch in delete_batches:
+                journal.expect(self.get_event_key(batch.destination, batch.file_keys[0]),
+                    [ ('del:%s' % self.get_event_key(batch.destination, k), '',) \
+                        for k in batch.file_keys ])
 
-# the worker process hook
-S3UploadWorker.__call__ = S3UploadWorker.run
-        
+        # build the args for the process workers
+        process_args = (
+            self.destinations[0].bucket_name,
+            self.destinations[0].aws_access_key_id,
+            self.destinations[0].aws_secret_key,
+            self.verbosity,
+            self.destinations[0].prefix,
+            options.get('gzip'),
+            options.get('expires'),
+            True, # run with force
+            self.dryrun,
+        )
+
+        compress_cache = create_compress_cache(
+            options.get('compress_cache') or getattr(settings, 'AWS_COMPRESS_CACHE', None),
+            options.get('compress_cache_size'))
+        worker_options = get_worker_options(options)
+        worker_options['compress_cache'] = compress_cache
+        worker_options['destinations'] = self.destinations
+        prepare_workers = create_workers(S3PrepareWorker, options.get('prepare_processes'),
+                                         process_args, worker_options)
+        upload_workers = create_upload_workers(options, process_args, worker_options, self.plan)
+
+        # run the workers until they are all finished
+        metrics = RunMetrics('s3-%s' % self.SYNC_NAME,
+                             ','.join([ self.destinations[num].bucket_name \
+                                          for num in destinations ]), self.dryrun)
+        s3_files = schedule_files(s3_files, options.get('schedule'), options.get('lookahead'))
+        process_result = run_pipeline(s3_files, prepare_workers, upload_workers,
+                                      get_engine(options), metrics, options.get('progress'),
+                                      journal, final_files=delete_batches)
+        finish_run(metrics, options, self.verbosity)
+        if compress_cache is not None:
+            compress_cache.evict()
+        return process_result
+
+    def is_shard_file(self, s3_file):
+        """
+        Returns True if the changed file belongs to this host's shard.
+        """
+        return in_shard(s3_file.file_key, self.shard)
+
+    def get_delete_keys(self, s3_file, target):
+        """
+        The keys of the target deleted for the removed file.
+        """
+        return [ target.file_key ] + variant_keys(target.file_key)
+
+    def get_event_key(self, destination, file_key):
+        return self.destinations[destination].get_event_key(file_key)
+
+    def in_shard(self, destination, file_key):
+        """
+        Returns True if the key of the destination belongs to this host's
+        shard, the keys are split by their key in the first destination.
+        """
+        rel_key = file_key[len(self.destinations[destination].prefix):]
+        return in_shard(self.destinations[0].get_key(rel_key), self.shard)
+
+    def get_destination_names(self, destinations=None):
+        """
+        The bucket (and prefix) names of the destinations.
+        """
+        if destinations is None:
+            destinations = xrange(len(self.destinations))
+        names = []
+        for num in destinations:
+            destination = self.destinations[num]
+            if destination.prefix:
+                names.append('%s:%s' % (destination.bucket_name, destination.prefix))
+            else:
+                names.append(destination.bucket_name)
+        return ' '.join(names)
+
+    def get_journal_path(self, options):
+        """
+        The local journal file, by default in settings.AWS_JOURNAL_DIR (or
+        the temp directory).
+        """
+        if options.get('journal'):
+            return options.get('journal')
+        journal_dir = getattr(settings, 'AWS_JOURNAL_DIR', None) or tempfile.gettempdir()
+        return os.path.join(journal_dir, '%s-%s%s.journal' % (self.SYNC_NAME,
+            '+'.join([ destination.name for destination in self.destinations ]),
+            get_shard_suffix(self.shard)))
+
+    def get_conf_key(self, name, destination=0):
+        """
+        The name of a config file in the config bucket of the destination.
+        The destinations sharing a bucket keep their files under their
+        prefix.
+        """
+        prefix = self.destinations[destination].prefix.strip('/')
+        if prefix:
+            return '%s/%s' % (prefix, name)
+        return name
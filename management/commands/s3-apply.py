@@ -0,0 +1,376 @@
+"""
+Apply a Sync Plan to S3
+=======================
+
+Django command that runs the plan written by s3-push, s3-svnsync or s3-gitsync
+with the --plan option.  The planning run did the expensive work once (the
+bucket listing, the change checks, the digests and the copy sources), the
+apply sends the planned uploads, copies and deletes without checking the
+bucket again, with all of the upload workers.  The plan can be written in CI
+and applied in the deploy window, on another host with the same MEDIA_ROOT
+content.
+
+The files are read from the MEDIA_ROOT of this host.  The uploaded files are
+digested again, a file that no longer has the planned size or content (MD5)
+fails.  The svn revision (or git commit) of a planned sync
+is stored once the plan is applied without failures.
+
+Note: This script requires the Python boto library and a valid Amazon Web
+Services API key.
+
+Requires Python 2.6 or newer.
+
+Required settings.py variables:
+AWS_ACCESS_KEY_ID = ''
+AWS_SECRET_ACCESS_KEY = ''
+(or the credentials of the AWS_DESTINATIONS, matched by the destination names
+of the plan)
+
+Usage: manage.py s3-apply [options] PLAN
+
+Command options are:
+  --compress-cache=PATH The directory caching the compressed files by content
+                        digest. Defaults to settings.AWS_COMPRESS_CACHE if set.
+  --compress-cache-size=MB
+                        The compression cache size limit (default 512).
+  --dryrun              Only show actions instead of uploading files
+  --workers             Specify the number of worker processes to use for uploading files.
+  --prepare-workers     Specify the number of worker processes used to gzip
+                        the files (defaults to the CPU count).
+  --adaptive            Adapts the number of S3 requests in flight to the
+                        throughput (AIMD), starting at --workers.
+  --max-workers=N       The most upload workers used by --adaptive (default 32).
+  --retries=N           The retries of a throttled or failed S3 request, with
+                        a jittered exponential backoff (default 5).
+  --engine=ENGINE       Runs the upload workers as processes (default) or as threads.
+  --schedule=MODE       The upload order: size (largest files first, default)
+                        or fifo (plan order).
+  --lookahead=N         The number of planned files reordered by the size
+                        schedule (default 1000).
+  --multipart-threshold=MB
+                        Files larger than this size are sent as S3 multipart
+                        uploads (default 64).
+  --part-size=MB        The multipart upload part size (default 16, 5 minimum).
+  --part-threads=N      The number of parts sent in parallel by each worker
+                        (default 4).
+  --destination=NAME    Only applies the plan to the named destination. Can be
+                        repeated.
+  --shard=I/N           Only applies the I-th of N slices of the plan, split
+                        by a hash of the S3 key. A sync plan stores its
+                        revision once applied and can't be sharded.
+  --journal=PATH        The journal of the completed operations. A rerun after
+                        a failed or interrupted apply skips the journaled
+                        operations. Defaults to a file in
+                        settings.AWS_JOURNAL_DIR if set.
+  --report=PATH         Writes the JSON run report (counts, bytes, request
+                        latency histograms, slowest directories) to the file.
+  --progress            Shows the live progress with the throughput and ETA.
+  --verbose             Prints the basic output
+  --debug               Prints the maximum output
+
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import os
+import sys
+
+if sys.version_info < (2, 6):
+    raise "Python 2.6+ required"
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+try:
+    import boto
+    import boto.exception
+except ImportError:
+    raise ImportError, "The boto library is not installed."
+
+from . import S3ApplyWorker, S3UploadWorker, S3File, S3Target, S3DeleteBatch, S3Destination, \
+    DEFAULT_OPTIONS, get_worker_options, get_upload_worker_count, create_compress_cache, \
+    schedule_files, create_workers, run_pipeline, connect_s3, finish_run, parse_shard, in_shard, \
+    get_shard_suffix, get_destinations, utf8
+from ...journal import SyncJournal
+from ...metrics import RunMetrics
+from ...plan import SyncPlan, PlanError
+
+
+class Command(BaseCommand):
+
+    # the options of the planning run don't apply
+    PLANNED_OPTIONS = ('gzip', 'brotli', 'expires', 'no_copy', 'plan',)
+
+    option_list = BaseCommand.option_list + tuple([ option for option in DEFAULT_OPTIONS \
+                                                      if option.dest not in PLANNED_OPTIONS ])
+
+    args = 'PLAN'
+
+    help = "Applies the plan of a s3-push, s3-svnsync or s3-gitsync --plan run to S3."
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Please give the plan file to apply.")
+
+        if not hasattr(settings, 'MEDIA_ROOT') or not settings.MEDIA_ROOT:
+            raise CommandError("MEDIA_ROOT must be set in your settings.")
+
+        try:
+            self.plan = SyncPlan(args[0]).load()
+        except PlanError, e:
+            raise CommandError(str(e))
+
+        self.verbosity = 0
+        if options.get('verbose'):
+            self.verbosity = 1
+        if options.get('debug'):
+            self.verbosity = 2
+
+        try:
+            self.shard = parse_shard(options.get('shard'))
+            self.destinations, destination_map = self.get_plan_destinations(options)
+        except ValueError, e:
+            raise CommandError(str(e))
+        if self.shard is not None and self.plan.states:
+            raise CommandError("The %s plan stores the sync revision, it can't be sharded." % \
+                               self.plan.header['command'])
+
+        # the compression of the planning run
+        options = dict(options, no_copy=True, expires=False,
+                       gzip=self.plan.header['options'].get('gzip'),
+                       brotli=self.plan.header['options'].get('brotli'))
+
+        media_root = settings.MEDIA_ROOT
+        if not media_root.endswith('/'):
+            media_root += '/'
+
+        if self.verbosity > 0:
+            summary = self.plan.summary['counts']
+            print "Applying the %s plan of %s: %d uploads, %d copies, %d deletes" % (
+                self.plan.header['command'],
+                ', '.join([ destination.name for destination in self.destinations ]),
+                summary['uploaded'], summary['copied'], summary['deleted'])
+
+        journal = None
+        journal_path = options.get('journal')
+        if not journal_path and getattr(settings, 'AWS_JOURNAL_DIR', None):
+            journal_path = os.path.join(settings.AWS_JOURNAL_DIR, 'apply-%s%s.journal' % (
+                os.path.basename(args[0]), get_shard_suffix(self.shard)))
+        if journal_path and not options.get('dryrun'):
+            journal = SyncJournal(journal_path, 's3-apply %s %r%s' % (
+                os.path.abspath(args[0]), self.plan.header['created'],
+                get_shard_suffix(self.shard)))
+            resumed = journal.open()
+            if self.verbosity > 0 and resumed:
+                print "Resuming the plan, %d operations completed in %s" % (resumed,
+                                                                           journal_path)
+
+        s3_files = self.get_plan_files(media_root, destination_map, journal)
+        delete_batches = self.get_plan_deletes(destination_map, journal)
+
+        # arg list for the worker processes
+        process_args = (
+            self.destinations[0].bucket_name,
+            self.destinations[0].aws_access_key_id,
+            self.destinations[0].aws_secret_key,
+            self.verbosity,
+            self.destinations[0].prefix,
+            options.get('gzip'),
+            False,
+            True, # the changes were checked by the plan
+            options.get('dryrun'),
+        )
+
+        compress_cache = create_compress_cache(
+            options.get('compress_cache') or getattr(settings, 'AWS_COMPRESS_CACHE', None),
+            options.get('compress_cache_size'))
+        worker_options = get_worker_options(options)
+        worker_options['compress_cache'] = compress_cache
+        worker_options['destinations'] = self.destinations
+        prepare_workers = create_workers(S3ApplyWorker, options.get('prepare_processes'),
+                                         process_args, worker_options)
+        upload_workers = create_workers(S3UploadWorker, get_upload_worker_count(options),
+                                        process_args, worker_options)
+
+        metrics = RunMetrics('s3-apply', ','.join([ destination.bucket_name \
+                                                      for destination in self.destinations ]),
+                             options.get('dryrun'))
+        s3_files = schedule_files(s3_files, options.get('schedule'), options.get('lookahead'))
+        process_result = run_pipeline(s3_files, prepare_workers, upload_workers,
+                                      options.get('engine'), metrics, options.get('progress'),
+                                      journal, final_files=delete_batches)
+        finish_run(metrics, options, self.verbosity)
+        if compress_cache is not None:
+            compress_cache.evict()
+
+        if process_result:
+            # the journal is kept for the rerun of a failed apply
+            if journal is not None:
+                journal.close()
+            sys.exit(process_result)
+
+        # all completed successfully, store the revisions of the planned sync
+        if not options.get('dryrun'):
+            self.store_states(destination_map)
+        if journal is not None:
+            journal.finish()
+
+    def get_plan_destinations(self, options):
+        """
+        Returns the destinations of the plan applied by this host and the
+        map of the plan destination numbers to them.  The buckets and
+        prefixes are those of the plan, the credentials those of the
+        configured destination with the same name (or the AWS keys).
+        Raises a ValueError if a planned destination isn't configured.
+        """
+        configured = {}
+        if getattr(settings, 'AWS_DESTINATIONS', None) or \
+                getattr(settings, 'AWS_BUCKET_NAME', None):
+            for destination in get_destinations(options):
+                configured[destination.name] = destination
+        elif options.get('destination'):
+            raise ValueError("--destination requires the AWS_DESTINATIONS setting.")
+
+        destinations = []
+        destination_map = {}
+        for num, (name, bucket_name, prefix) in enumerate(self.plan.header['destinations']):
+            name, bucket_name, prefix = utf8(name), utf8(bucket_name), utf8(prefix)
+            if options.get('destination') and name not in options.get('destination'):
+                continue
+            destination = configured.get(name)
+            if destination is None and (options.get('destination') or configured):
+                raise ValueError("The planned destination %s is not configured." % name)
+            if destination is not None and destination.bucket_name != bucket_name:
+                raise ValueError("The planned destination %s is the bucket %s, not %s." % (
+                    name, bucket_name, destination.bucket_name))
+
+            destination_map[num] = len(destinations)
+            destinations.append(S3Destination(name, bucket_name, prefix,
+                destination and destination.aws_access_key_id or \
+                    getattr(settings, 'AWS_ACCESS_KEY_ID', None),
+                destination and destination.aws_secret_key or \
+                    getattr(settings, 'AWS_SECRET_ACCESS_KEY', None)))
+
+        if not destinations:
+            raise ValueError("The plan has none of the destinations %s." % \
+                             ', '.join(options.get('destination')))
+        for destination in destinations:
+            destination.qualified = len(destinations) > 1
+        return destinations, destination_map
+
+    def get_plan_files(self, media_root, destination_map, journal=None):
+        """
+        Yields the planned S3 files with the targets of the applied
+        destinations.  The operations completed by an interrupted apply
+        are skipped.
+        """
+        for entry in self.plan.files:
+            rel_key = utf8(entry['key'])
+            s3_file = S3File(self.destinations[0].bucket_name, rel_key,
+                             os.path.join(media_root, rel_key))
+            s3_file.size = entry['size']
+            s3_file.digest = utf8(entry['digest'])
+            s3_file.fingerprint = utf8(entry['fingerprint'])
+            s3_file.headers = dict([ (utf8(name), utf8(value),) \
+                                        for name, value in entry['headers'].iteritems() ])
+
+            s3_file.targets = []
+            for destination, file_key, copy_source, deferred in entry['targets']:
+                if destination not in destination_map:
+                    continue
+                target = S3Target(destination_map[destination], utf8(file_key))
+                target.copy_source = utf8(copy_source)
+                target.deferred = deferred
+                if not s3_file.targets:
+                    s3_file.file_key = target.file_key
+                if not in_shard(target.file_key, self.shard):
+                    continue
+                if target.deferred and not in_shard(target.copy_source, self.shard):
+                    # the source is uploaded by the host of its shard
+                    target.copy_source = None
+                    target.deferred = False
+
+                if journal is not None:
+                    event_key = self.destinations[target.destination].get_event_key(
+                        target.file_key)
+                    if journal.is_done('put:%s' % event_key):
+                        continue
+                    journal.expect(event_key, [('put:%s' % event_key, '',)])
+                s3_file.targets.append(target)
+
+            if s3_file.targets:
+                yield s3_file
+
+    def get_plan_deletes(self, destination_map, journal=None):
+        """
+        Returns the delete batches of the applied destinations, sent once
+        the uploads and copies are done.
+        """
+        delete_keys = [ [] for destination in self.destinations ]
+        for entry in self.plan.deletes:
+            if entry['destination'] not in destination_map:
+                continue
+            destination = destination_map[entry['destination']]
+            for file_key in entry['keys']:
+                file_key = utf8(file_key)
+                if not in_shard(file_key, self.shard):
+                    continue
+                if journal is not None and journal.is_done('del:%s' % \
+                        self.destinations[destination].get_event_key(file_key)):
+                    continue
+                delete_keys[destination].append(file_key)
+
+        delete_batches = []
+        for num, destination in enumerate(self.destinations):
+            delete_batches.extend(S3DeleteBatch.create_batches(destination.bucket_name,
+                delete_keys[num], destination=num))
+        if journal is not None:
+            for batch in delete_batches:
+                destination = self.destinations[batch.destination]
+                journal.expect(destination.get_event_key(batch.file_keys[0]),
+                    [ ('del:%s' % destination.get_event_key(file_key), '',) \
+                        for file_key in batch.file_keys ])
+        return delete_batches
+
+    def store_states(self, destination_map):
+        """
+        Stores the planned state keys (the svn revision or git commit of a
+        sync plan) of the applied destinations, in plan order.
+        """
+        buckets = {}
+        for entry in self.plan.states:
+            if entry['destination'] not in destination_map:
+                continue
+            destination = self.destinations[destination_map[entry['destination']]]
+            bucket_name = utf8(entry['bucket'])
+            if bucket_name not in buckets:
+                conn = connect_s3(destination.aws_access_key_id, destination.aws_secret_key)
+                try:
+                    buckets[bucket_name] = conn.get_bucket(bucket_name)
+                except boto.exception.S3ResponseError:
+                    buckets[bucket_name] = conn.create_bucket(bucket_name)
+            s3_key = boto.s3.key.Key(buckets[bucket_name])
+            s3_key.name = utf8(entry['key'])
+            s3_key.set_contents_from_string(utf8(entry['content']))
+            if self.verbosity > 0:
+                print "Stored %s in bucket %s" % (s3_key.name, bucket_name)
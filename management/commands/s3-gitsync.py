@@ -0,0 +1,512 @@
+"""
+Sync Media from Git to S3
+=========================
+
+Django command for synchronizing the S3 bucket with the local git MEDIA_ROOT repository.
+The commit pushed last is stored next to the bucket and the changes are computed with a
+tree to tree diff (git diff-tree) between that commit and HEAD, so a sync only reads the
+added, changed, renamed and deleted files.  Renamed and copied files are copied on S3
+(server-side) from the key of their source when the content is unchanged.
+
+Note: This script requires the Python boto library and valid Amazon Web
+Services API keys.  The git command line client must be on the PATH.
+
+Requires Python 2.6 or newer.
+
+Required Django settings:
+AWS_ACCESS_KEY_ID = ''
+AWS_SECRET_ACCESS_KEY = ''
+AWS_BUCKET_NAME = ''
+(or AWS_DESTINATIONS, the buckets and prefixes the files are pushed to)
+
+The local MEDIA_ROOT needs to be in a git working tree, the files of its directory
+(relative to the directory) are synchronized.
+
+This command optionally:
+* gzip any CSS/Javascript files it finds and adds the appropriate
+  'Content-Encoding' header.
+* sets an 'Expires' header for 2 years from today.
+
+Command options are:
+  --gzip                Enables gzipping of javascript/css files.
+  --brotli              Enables brotli (.br) variants of javascript/css files.
+  --compress-cache=PATH The directory caching the compressed files by content
+                        digest. Defaults to settings.AWS_COMPRESS_CACHE if set.
+  --compress-cache-size=MB
+                        The compression cache size limit (default 512).
+  --expires             Enables expires header
+  --dryrun              Only show actions instead of uploading files
+  --workers             Specify the number of worker processes to use for uploading files.
+  --prepare-workers     Specify the number of worker processes used to check, digest and
+                        gzip the files (defaults to the CPU count).
+  --adaptive            Adapts the number of S3 requests in flight to the
+                        throughput (AIMD), starting at --workers.
+  --max-workers=N       The most upload workers used by --adaptive (default 32).
+  --retries=N           The retries of a throttled or failed S3 request, with
+                        a jittered exponential backoff (default 5).
+  --engine=ENGINE       Runs the upload workers as processes (default) or as threads.
+  --no-copy             Uploads every file instead of copying renamed files and
+                        the files with the content of another key (server-side
+                        COPY).
+  --schedule=MODE       The upload order: size (largest files first, default)
+                        or fifo (scan order).
+  --lookahead=N         The number of scanned files reordered by the size
+                        schedule (default 1000).
+  --multipart-threshold=MB
+                        Files larger than this size are sent as S3 multipart
+                        uploads (default 64).
+  --part-size=MB        The multipart upload part size (default 16, 5 minimum).
+  --part-threads=N      The number of parts sent in parallel by each worker
+                        (default 4).
+  --destination=NAME    Only syncs to the named settings.AWS_DESTINATIONS
+                        destination. Can be repeated.
+  --shard=I/N           Only syncs the I-th of N slices of the changes, split
+                        by a hash of the S3 key. Each shard stores its
+                        completed commit in the git bucket, the S3 commit is
+                        advanced once every shard has completed it.
+  --journal=PATH        The journal of the completed operations. A rerun after
+                        a failure only does the remaining work of the commit
+                        range. Defaults to a file in settings.AWS_JOURNAL_DIR
+                        (or the temp directory).
+  --plan=PATH           Looks up the changes as usual but writes the uploads,
+                        copies, deletes and the new S3 commit to the plan file
+                        instead of sending them (see s3-apply).
+  --report=PATH         Writes the JSON run report (counts, bytes, request
+                        latency histograms, slowest directories) to the file.
+  --progress            Shows the live progress with the throughput and ETA.
+  --verbose             Prints the basic output
+  --debug               Prints the maximum output
+
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+if sys.version_info < (2, 6):
+    raise "Python 2.6+ required"
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+try:
+    import boto
+    import boto.exception
+except ImportError:
+    raise ImportError, "The boto library is not installed."
+
+from . import S3File, S3SyncCommand, DEFAULT_OPTIONS, connect_s3, parse_shard, \
+    get_shard_suffix, get_destinations, create_plan, finish_plan
+from ...journal import SyncJournal
+
+try:
+    import yaml
+except ImportError:
+    raise ImportError, "The yaml library is not installed."
+
+# the git file modes synchronized, symlinks and submodules (gitlinks) are skipped
+GIT_FILE_MODES = ('100644', '100755',)
+
+
+class GitError(Exception):
+    """
+    A failed git command.
+    """
+    pass
+
+
+class Command(S3SyncCommand):
+
+    SYNC_NAME = 'gitsync'
+
+    # the config file for the pushed commit
+    GIT_REVISION_CONF = 'git_revision.yaml'
+
+    # the commits completed by each shard (--shard=I/N)
+    GIT_SHARD_CONF = 'git_shards/%d-of-%d.yaml'
+
+    option_list = BaseCommand.option_list + DEFAULT_OPTIONS
+
+    help = "Synchronizes the MEDIA_ROOT git changes to Amazon S3"
+
+    def handle(self, *args, **options):
+
+        # Check for AWS keys in settings
+        if not hasattr(settings, 'AWS_ACCESS_KEY_ID') or \
+                not hasattr(settings, 'AWS_SECRET_ACCESS_KEY'):
+            raise CommandError("Missing AWS keys from settings file.  Please " \
+                     "supply both AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY.")
+
+        # the AWS_DESTINATIONS replace the bucket name
+        if not getattr(settings, 'AWS_DESTINATIONS', None) and \
+                (not hasattr(settings, 'AWS_BUCKET_NAME') or not settings.AWS_BUCKET_NAME):
+            raise CommandError("AWS_BUCKET_NAME must be set in your settings.")
+
+        if not hasattr(settings, 'MEDIA_ROOT') or not settings.MEDIA_ROOT:
+            raise CommandError("MEDIA_ROOT must be set in your settings.")
+
+        self.dryrun = options.get('dryrun')
+        self.git_buckets = {}
+        self.copy_files = not options.get('no_copy')
+
+        try:
+            self.shard = parse_shard(options.get('shard'))
+            self.destinations = get_destinations(options)
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        if options.get('plan') and (self.dryrun or self.shard is not None):
+            raise CommandError("--plan can't be used with --dryrun or --shard.")
+
+        self.verbosity = 0
+        if options.get('verbose'):
+            self.verbosity = 1
+        if options.get('debug'):
+            self.verbosity = 2
+
+        try:
+            head = self.git('rev-parse', '--verify', 'HEAD^{commit}').strip()
+            branch = self.git('rev-parse', '--abbrev-ref', 'HEAD').strip()
+        except GitError, e:
+            raise CommandError("MEDIA_ROOT is not a git working tree: %s" % e)
+
+        # the operations and commits are written to the plan instead of S3
+        self.plan = create_plan(options, 's3-gitsync', self.destinations)
+
+        # the commit pushed to each destination, the destinations at the same
+        # commit are synchronized together
+        s3_git_revisions = []
+        ranges = []
+        for destination in xrange(len(self.destinations)):
+            s3_git_revision = self.get_s3_git_revision(destination)
+            if self.shard is not None:
+                # a shard continues from its own completed commit
+                shard_commit = self.get_shard_commit(destination=destination)
+                if shard_commit is not None:
+                    s3_git_revision['commit'] = shard_commit
+            s3_git_revisions.append(s3_git_revision)
+
+            base = s3_git_revision['commit']
+            if base is not None and not self.has_commit(base):
+                raise CommandError("The S3 commit %s of %s is not in the local repository, " \
+                    "fetch it first." % (base, self.destinations[destination].name))
+            for base_commit, destinations in ranges:
+                if base_commit == base:
+                    destinations.append(destination)
+                    break
+            else:
+                ranges.append((base, [ destination ],))
+
+        if self.verbosity > 0:
+            print "Local git commit: %s (%s)" % (head, branch)
+
+        # the changes of each commit range, a tree diff (or the whole tree on the
+        # first sync) of the MEDIA_ROOT directory
+        range_files = []
+        changed_files = []
+        for base, destinations in ranges:
+            if base is None:
+                if self.verbosity > 0:
+                    print "Bootstrapping S3 from the tree of commit %s" % head
+                files = self.get_tree_files(head)
+            elif base == head:
+                files = []
+            else:
+                if self.verbosity > 0:
+                    print "S3 git commit: %s" % base
+                    print "Running git diff-tree"
+                files = self.get_changed_files(base, head)
+            range_files.append(files)
+            changed_files.extend(files)
+
+        if self.verbosity > 0:
+            print "Found %d changes" % len(changed_files)
+
+        # the uncommitted changes of the synchronized files halt the sync, the
+        # files are uploaded from the working tree
+        modified = self.get_modified_paths()
+        outofsync_files = [ s3_file for s3_file in changed_files \
+                                if s3_file.rel_key in modified ]
+        if outofsync_files:
+            print "Unable to upload changes to S3. The local repository has uncommitted " \
+                "changes. Please commit the following files:"
+            for s3_file in outofsync_files:
+                print "\t%s (status: %s)" % (s3_file.filename, modified[s3_file.rel_key])
+            sys.exit(1)
+
+        for num, (base, destinations) in enumerate(ranges):
+            if base == head:
+                continue
+            if range_files[num]:
+                process_result = self.sync_range(range_files[num], destinations, base, head,
+                                                 options)
+                if process_result:
+                    if self.plan is not None:
+                        finish_plan(self.plan, process_result)
+                    sys.exit(process_result)
+
+            # all completed successfully, store the synchronized commit
+            for destination in destinations:
+                if self.verbosity > 0:
+                    print "Updating S3 commit of %s to %s" % (
+                        self.destinations[destination].name, head)
+                s3_git_revision = s3_git_revisions[destination]
+                s3_git_revision['commit'] = head
+                s3_git_revision['branch'] = branch
+                s3_git_revision['last_update'] = datetime.now().ctime()
+                if self.shard is not None:
+                    self.set_shard_commit(s3_git_revision, destination)
+                else:
+                    self.set_s3_revision(s3_git_revision, destination=destination)
+
+        if self.plan is not None:
+            finish_plan(self.plan)
+        if self.verbosity > 0:
+            print "Finished (exit code: 0)"
+
+    def git(self, *args):
+        """
+        Runs the git command in the MEDIA_ROOT directory and returns its
+        output.  Raises a GitError if the command fails.
+        """
+        if self.verbosity > 1:
+            print "Running git %s" % ' '.join(args)
+        try:
+            process = subprocess.Popen(('git',) + args, cwd=settings.MEDIA_ROOT,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError, e:
+            raise GitError("Unable to run git: %s" % e)
+        output, error = process.communicate()
+        if process.returncode:
+            raise GitError(error.strip() or "git %s failed" % args[0])
+        return output
+
+    def has_commit(self, commit):
+        try:
+            self.git('cat-file', '-e', '%s^{commit}' % commit)
+        except GitError:
+            return False
+        return True
+
+    def create_file(self, rel_key, delete=False):
+        return S3File.create(self.destinations, rel_key,
+                             os.path.join(settings.MEDIA_ROOT, rel_key), delete)
+
+    def get_tree_files(self, commit):
+        """
+        Returns the S3 files of every file of the MEDIA_ROOT directory in the
+        tree of the commit.
+        """
+        tree_files = []
+        for entry in self.git('ls-tree', '-r', '-z', commit).split('\0'):
+            if not entry:
+                continue
+            info, rel_key = entry.split('\t', 1)
+            mode, kind, sha = info.split(' ')
+            if mode in GIT_FILE_MODES:
+                tree_files.append(self.create_file(rel_key))
+        return tree_files
+
+    def get_changed_files(self, base, head):
+        """
+        Returns the S3 files of the changes between the two commits from the
+        tree diff of the MEDIA_ROOT directory.  The renamed and copied files
+        get the key of their source as copy hint, the source of a rename is
+        deleted once the uploads are done.
+        """
+        fields = self.git('diff-tree', '-r', '-z', '-M', '--relative', '--no-commit-id',
+                          base, head).split('\0')
+        uploads = []
+        deletes = []
+        num = 0
+        while num < len(fields) and fields[num].startswith(':'):
+            old_mode, new_mode, old_sha, new_sha, status = fields[num][1:].split(' ')
+            if status[0] in ('R', 'C',):
+                paths = fields[num + 1:num + 3]
+                num += 3
+            else:
+                paths = fields[num + 1:num + 2]
+                num += 2
+
+            if status[0] in ('R', 'C',):
+                source, rel_key = paths
+                if status[0] == 'R' and old_mode in GIT_FILE_MODES:
+                    deletes.append(source)
+                if new_mode in GIT_FILE_MODES:
+                    uploads.append((rel_key, source,))
+            elif status[0] in ('A', 'M', 'T',) and new_mode in GIT_FILE_MODES:
+                uploads.append((paths[0], None,))
+            elif status[0] in ('D', 'T',) and old_mode in GIT_FILE_MODES:
+                # a removed file (or one replaced by a symlink or submodule)
+                deletes.append(paths[0])
+
+        changed_files = []
+        for rel_key, source in uploads:
+            s3_file = self.create_file(rel_key)
+            if source and self.copy_files:
+                for target in s3_file.targets:
+                    target.copy_hint = self.destinations[target.destination].get_key(source)
+            changed_files.append(s3_file)
+
+        # a path renamed away and written again (a swap) is only uploaded
+        uploaded = set([ rel_key for rel_key, source in uploads ])
+        for rel_key in deletes:
+            if rel_key not in uploaded:
+                changed_files.append(self.create_file(rel_key, delete=True))
+        return changed_files
+
+    def get_modified_paths(self):
+        """
+        Returns the uncommitted changes of the MEDIA_ROOT directory, the
+        path (relative to MEDIA_ROOT) => status.
+        """
+        prefix = self.git('rev-parse', '--show-prefix').strip()
+        fields = self.git('status', '--porcelain', '-z', '--untracked-files=no', '--',
+                          '.').split('\0')
+        modified = {}
+        num = 0
+        while num < len(fields):
+            entry = fields[num]
+            num += 1
+            if not entry:
+                continue
+            status, path = entry[:2], entry[3:]
+            if status[0] in ('R', 'C',):
+                # the source path follows
+                num += 1
+            if path.startswith(prefix):
+                modified[path[len(prefix):]] = status.strip()
+        return modified
+
+    def sync_range(self, changed_files, destinations, base, head, options):
+        """
+        Runs the changes of the commit range through the workers, to the
+        given destinations.  The completed operations are journaled, a rerun
+        of the same range only does the remaining work.  Returns the worker
+        exit code.
+        """
+        journal = None
+        if not self.dryrun and not self.plan:
+            journal = SyncJournal(self.get_journal_path(options), 'gitsync %s %s:%s%s' % (
+                self.get_destination_names(destinations), base or 'bootstrap', head,
+                get_shard_suffix(self.shard)))
+            resumed = journal.open()
+            if self.verbosity > 0 and resumed:
+                print "Resuming commits %s to %s, %d operations completed" % (base, head,
+                                                                             resumed)
+
+        process_result = self.sync_changes(changed_files, destinations, journal, options)
+
+        if journal is not None:
+            # the journal is kept for the rerun of a failed sync
+            if process_result:
+                journal.close()
+            else:
+                journal.finish()
+        return process_result
+
+    def get_git_bucket(self, destination=0):
+        """
+        The git s3 configuration bucket of the destination (the bucket name
+        with a .git suffix).  If the bucket does not exist, it will be created.
+        """
+        if destination not in self.git_buckets:
+            if self.verbosity > 1:
+                print "Connecting to s3"
+            conn = connect_s3(self.destinations[destination].aws_access_key_id,
+                              self.destinations[destination].aws_secret_key)
+            git_bucket_name = '.'.join([self.destinations[destination].bucket_name, 'git'])
+            try:
+                git_bucket = conn.get_bucket(git_bucket_name)
+            except boto.exception.S3ResponseError:
+                git_bucket = conn.create_bucket(git_bucket_name)
+            self.git_buckets[destination] = git_bucket
+        return self.git_buckets[destination]
+
+    def get_s3_git_revision(self, destination=0):
+        """
+        Retrieves the commit pushed to the destination from its S3 conf
+        bucket, the commit is None before the first sync.
+        """
+        s3_revision = dict(commit=None, branch=None, last_update=None)
+        git_key = self.get_git_bucket(destination).get_key(
+            self.get_conf_key(self.GIT_REVISION_CONF, destination))
+        if git_key:
+            s3_revision.update(yaml.load(git_key.read()))
+        return s3_revision
+
+    def set_s3_revision(self, s3_revision, destination=0):
+        """
+        Stores the pushed commit in the S3 conf bucket of the destination.
+        """
+        git_key = boto.s3.key.Key(self.get_git_bucket(destination))
+        git_key.name = self.get_conf_key(self.GIT_REVISION_CONF, destination)
+        yaml_data = yaml.dump(s3_revision, default_flow_style=False)
+        if self.plan is not None:
+            # stored by s3-apply once the planned changes are done
+            self.plan.add_state(destination, git_key.bucket.name, git_key.name, yaml_data)
+        elif not self.dryrun:
+            git_key.set_contents_from_string(yaml_data)
+        if self.verbosity > 1:
+            print "Stored S3 git commit %s" % s3_revision['commit']
+
+    def get_shard_commit(self, shard=None, destination=0):
+        """
+        Returns the commit of the destination completed by the shard (this
+        host's shard by default) or None if the shard has not completed one.
+        """
+        index, count = shard or self.shard
+        git_key = self.get_git_bucket(destination).get_key(
+            self.get_conf_key(self.GIT_SHARD_CONF % (index + 1, count), destination))
+        if not git_key:
+            return None
+        return yaml.load(git_key.read()).get('commit')
+
+    def set_shard_commit(self, s3_revision, destination=0):
+        """
+        Stores the completion marker of this host's shard.  The S3 commit is
+        advanced once every shard has completed the same commit, any shard
+        finding every marker advances it, there's no coordinator.
+        """
+        git_key = boto.s3.key.Key(self.get_git_bucket(destination))
+        git_key.name = self.get_conf_key(self.GIT_SHARD_CONF % (self.shard[0] + 1,
+                                                                self.shard[1]), destination)
+        if not self.dryrun:
+            git_key.set_contents_from_string(yaml.dump(s3_revision, default_flow_style=False))
+        if self.verbosity > 1:
+            print "Stored the shard %d/%d commit %s" % (self.shard[0] + 1, self.shard[1],
+                                                        s3_revision['commit'])
+
+        pending = [ index for index in xrange(self.shard[1]) if index != self.shard[0] and \
+                        self.get_shard_commit((index, self.shard[1],), destination) != \
+                            s3_revision['commit'] ]
+        if pending:
+            if self.verbosity > 0:
+                print "Waiting for %d shards to complete the commit" % len(pending)
+            return
+
+        if self.verbosity > 0:
+            print "All shards completed commit %s" % s3_revision['commit']
+        self.set_s3_revision(s3_revision, destination)
@@ -3,9 +3,9 @@ Sync Media to S3
 ================
 
 Django command that scans all files in your settings.MEDIA_ROOT folder and
-uploads them to S3 using the same directory structure. This command does
-not mirror the files, just pushing them if the local copy is newer than 
-the remote copy.
+uploads them to S3 using the same directory structure. By default this
+command does not mirror the files, just pushing them if the local copy is
+newer than the remote copy (see --mirror).
 
 Note: This script requires the Python boto library and a valid Amazon Web
 Services API key.  It will skip .svn directories.
@@ -16,6 +16,7 @@ Required settings.py variables:
 AWS_ACCESS_KEY_ID = ''
 AWS_SECRET_ACCESS_KEY = ''
 AWS_BUCKET_NAME = ''
+(or AWS_DESTINATIONS, the buckets and prefixes the files are pushed to)
 
 This command optionally:
 * gzip any CSS/Javascript files it finds and adds the appropriate
@@ -26,11 +27,77 @@ Command options are:
   -p PREFIX, --prefix=PREFIX
                         The prefix to prepend to the path on S3.
   --gzip                Enables gzipping of javascript/css files.
+  --brotli              Enables brotli (.br) variants of javascript/css files.
+  --compress-cache=PATH The directory caching the compressed files by content
+                        digest. Defaults to settings.AWS_COMPRESS_CACHE if set.
+  --compress-cache-size=MB
+                        The compression cache size limit (default 512).
   --expires             Enables expires header.
   --force               Skip the file mtime check to force upload of all
                         files.
+  --compare=MODE        The change detection mode: mtime (default), hash
+                        (local MD5 vs the S3 ETag) or size.
+  --no-index            Check each file with a HEAD request instead of the
+                        bucket listing index.
+  --include=PATTERN     Only pushes the files matching the glob pattern. The
+                        pattern is matched against the file name and the path
+                        relative to MEDIA_ROOT. Can be repeated.
+  --exclude=PATTERN     Skips the files and directories matching the glob
+                        pattern. Can be repeated.
+  --scan-workers=N      The number of threads scanning the MEDIA_ROOT
+                        directories (default 8).
+  --manifest=PATH       The local sync manifest (SQLite) used to skip files
+                        that haven't changed since the last push. Defaults to
+                        settings.AWS_MANIFEST_PATH if set.
+  --verify              Reconciles the manifest against the bucket listing
+                        before pushing.
+  --mirror              Deletes the keys under the prefix that have no local
+                        file (and the compressed variants of removed files)
+                        after the push. The number of keys and bytes to
+                        delete is shown first, --dryrun only shows them.
+  --watch               Keeps running after the push and pushes the changed
+                        and removed files as they happen (inotify with the
+                        pyinotify library, polling the tree otherwise).
+  --watch-delay=SECONDS The seconds a changed file must be quiet before it is
+                        pushed (default 0.5).
   --dryrun              Only show actions instead of uploading files
   --workers             Specify the number of worker processes to use for uploading files.
+  --prepare-workers     Specify the number of worker processes used to check, digest and
+                        gzip the files (defaults to the CPU count).
+  --adaptive            Adapts the number of S3 requests in flight to the
+                        throughput (AIMD), starting at --workers.
+  --max-workers=N       The most upload workers used by --adaptive (default 32).
+  --retries=N           The retries of a throttled or failed S3 request, with
+                        a jittered exponential backoff (default 5).
+  --engine=ENGINE       Runs the upload workers as processes (default) or as threads.
+  --no-copy             Uploads every file instead of copying the content of
+                        an existing key or a file of the run with the same
+                        content (server-side COPY).
+  --schedule=MODE       The upload order: size (largest files first, default)
+                        or fifo (scan order).
+  --lookahead=N         The number of scanned files reordered by the size
+                        schedule (default 1000).
+  --multipart-threshold=MB
+                        Files larger than this size are sent as S3 multipart
+                        uploads (default 64).
+  --part-size=MB        The multipart upload part size (default 16, 5 minimum).
+  --part-threads=N      The number of parts sent in parallel by each worker
+                        (default 4).
+  --destination=NAME    Only pushes to the named settings.AWS_DESTINATIONS
+                        destination. Can be repeated.
+  --shard=I/N           Only pushes the I-th of N slices of the files, split
+                        by a hash of the S3 key. N hosts running the shards
+                        1/N to N/N push disjoint slices of the tree.
+  --plan=PATH           Checks the files as usual but writes the uploads,
+                        copies and deletes (with the byte totals) to the plan
+                        file instead of sending them. The s3-apply command
+                        runs the plan later, possibly on another host.
+  --journal=PATH        The journal of the completed uploads. A rerun after a
+                        failed or interrupted push skips the journaled files.
+                        Defaults to a file in settings.AWS_JOURNAL_DIR if set.
+  --report=PATH         Writes the JSON run report (counts, bytes, request
+                        latency histograms, slowest directories) to the file.
+  --progress            Shows the live progress with the throughput and ETA.
   --verbose             Prints the basic output
   --debug               Prints the maximum output
 
@@ -57,9 +124,12 @@ THE SOFTWARE.
 
 """
 
+import heapq
+import itertools
+import mimetypes
 import optparse
 import os
-import re
+import signal
 import sys
 
 if sys.version_info < (2, 6):
@@ -74,12 +144,17 @@ try:
 except ImportError:
     raise ImportError, "The boto library is not installed."
 
-from multiprocessing import Process
-from . import S3UploadWorker, S3File, DEFAULT_OPTIONS, get_queue
-
-
-# svn directory filter
-svn_re = re.compile(r'/\.svn/?')
+from . import S3PrepareWorker, S3UploadWorker, S3Worker, S3File, S3BucketIndex, S3KeyInfo, \
+    S3DeleteBatch, S3WorkerPool, DEFAULT_OPTIONS, COMPARE_MODES, get_worker_options, \
+    get_upload_worker_count, create_compress_cache, schedule_files, create_workers, \
+    run_pipeline, build_headers, upload_fingerprint, finish_run, original_key, parse_shard, \
+    in_shard, create_header_policy, get_destinations, get_engine, create_plan, finish_plan, \
+    create_upload_workers, get_shard_suffix, utf8
+from ...journal import SyncJournal
+from ...manifest import SyncManifest
+from ...metrics import RunMetrics
+from ...scanner import MediaScanner
+from ...watcher import MediaWatcher, DEBOUNCE
 
 
 class Command(BaseCommand):
@@ -87,6 +162,9 @@ class Command(BaseCommand):
     # Extra variables to avoid passing these around
     FILTER_LIST = ['.DS_Store', '.svn', '.project', '.pydevproject',]
 
+    # Default number of directory scanning threads
+    SCAN_WORKERS = 8
+
     option_list = BaseCommand.option_list + DEFAULT_OPTIONS + (
         optparse.make_option('-p', '--prefix',
             dest='prefix', default='',
@@ -94,6 +172,36 @@ class Command(BaseCommand):
         optparse.make_option('--force',
             action='store_true', dest='force', 
             help="Skip the file mtime check to force upload of all files."),
+        optparse.make_option('--compare',
+            dest='compare', default='mtime', type='choice', choices=COMPARE_MODES,
+            help="The change detection mode: mtime (default), hash or size."),
+        optparse.make_option('--no-index',
+            action='store_true', dest='no_index',
+            help="Check each file with a HEAD request instead of the bucket listing index."),
+        optparse.make_option('--include',
+            action='append', dest='include', metavar='PATTERN',
+            help="Only pushes the files matching the glob pattern (repeatable)."),
+        optparse.make_option('--exclude',
+            action='append', dest='exclude', metavar='PATTERN',
+            help="Skips the files and directories matching the glob pattern (repeatable)."),
+        optparse.make_option('--scan-workers',
+            dest='scan_workers', default=SCAN_WORKERS, type='int',
+            help="Specifies the number of threads scanning the MEDIA_ROOT directories."),
+        optparse.make_option('--manifest',
+            dest='manifest', default=None,
+            help="The local sync manifest used to skip unchanged files."),
+        optparse.make_option('--verify',
+            action='store_true', dest='verify',
+            help="Reconciles the sync manifest against the bucket listing."),
+        optparse.make_option('--mirror',
+            action='store_true', dest='mirror',
+            help="Deletes the keys under the prefix without a local file after the push."),
+        optparse.make_option('--watch',
+            action='store_true', dest='watch',
+            help="Keeps pushing the changed files as they happen after the push."),
+        optparse.make_option('--watch-delay',
+            dest='watch_delay', default=DEBOUNCE, type='float', metavar='SECONDS',
+            help="The seconds a changed file must be quiet before it is pushed."),
     )
 
     help = "Pushes the complete MEDIA_ROOT structure and files to the given S3 bucket."
@@ -106,11 +214,12 @@ class Command(BaseCommand):
            raise CommandError("Missing AWS keys from settings file.  Please " \
                      "supply both AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY.")
 
-        if not hasattr(settings, 'AWS_BUCKET_NAME'):
-            raise CommandError("Missing bucket name from settings file. Please " \
-                " add the AWS_BUCKET_NAME to your settings file.")
-        else:
-            if not settings.AWS_BUCKET_NAME:
+        # the AWS_DESTINATIONS replace the bucket name
+        if not getattr(settings, 'AWS_DESTINATIONS', None):
+            if not hasattr(settings, 'AWS_BUCKET_NAME'):
+                raise CommandError("Missing bucket name from settings file. Please " \
+                    " add the AWS_BUCKET_NAME to your settings file.")
+            elif not settings.AWS_BUCKET_NAME:
                 raise CommandError("AWS_BUCKET_NAME cannot be empty.")
 
         if not hasattr(settings, 'MEDIA_ROOT'):
@@ -119,11 +228,15 @@ class Command(BaseCommand):
             if not settings.MEDIA_ROOT:
                 raise CommandError("settings.MEDIA_ROOT must have a value")
 
-        self.prefix = options.get('prefix')
-        
-        processes_count = int(options.get('processes'))
-        if processes_count < 1:
-            processes_count = 1
+        try:
+            self.shard = parse_shard(options.get('shard'))
+            self.policy = create_header_policy(options)
+            self.destinations = get_destinations(options)
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        if options.get('plan') and (options.get('dryrun') or options.get('watch')):
+            raise CommandError("--plan can't be used with --dryrun or --watch.")
         
         self.verbosity = 0
         if options.get('verbose'):
@@ -133,45 +246,418 @@ class Command(BaseCommand):
         
         # arg list for the worker processes
         process_args = (
-            settings.AWS_BUCKET_NAME,                        
-            settings.AWS_ACCESS_KEY_ID,
-            settings.AWS_SECRET_ACCESS_KEY,
+            self.destinations[0].bucket_name,
+            self.destinations[0].aws_access_key_id,
+            self.destinations[0].aws_secret_key,
             self.verbosity,
-            options.get('prefix'),
+            self.destinations[0].prefix,
             options.get('gzip'),
             options.get('expires'),
             options.get('force'),
             options.get('dryrun'),
         )
 
-        file_filter = lambda f: not f in self.FILTER_LIST
-        
+        self.buckets = {}
+        self.bucket_names = ','.join([ destination.bucket_name \
+                                         for destination in self.destinations ])
+        self.metrics = RunMetrics('s3-push', self.bucket_names, options.get('dryrun'))
+
+        # load the manifests of the previous pushes, one per destination
+        manifest_path = options.get('manifest') or getattr(settings, 'AWS_MANIFEST_PATH', None)
+        manifest_entries = [ {} for destination in self.destinations ]
+        if manifest_path:
+            for num, destination in enumerate(self.destinations):
+                manifest = SyncManifest(manifest_path, destination.bucket_name)
+                manifest_entries[num] = entries = manifest.load()
+                if self.verbosity > 0:
+                    print "Loaded %d manifest entries of %s from %s" % (len(entries),
+                        destination.name, manifest_path)
+
+                if options.get('verify'):
+                    bucket_index = self.build_index(num)
+                    removed = 0
+                    for file_key, entry in entries.items():
+                        s3_key = bucket_index.get(file_key)
+                        if not s3_key or s3_key.etag != entry.etag:
+                            manifest.remove(file_key)
+                            del entries[file_key]
+                            removed += 1
+                    if self.verbosity > 0:
+                        print "Removed %d stale manifest entries" % removed
+
+                # the workers open their own manifest connection
+                manifest.close()
+
+        elif options.get('verify'):
+            raise CommandError("--verify requires a manifest.")
+
         media_root = settings.MEDIA_ROOT
         if not media_root.endswith('/'):
             media_root += '/'
-        
-        for root, dirs, files in os.walk(media_root):
-            files = filter(file_filter, files)
-            if not files:
-                continue
-            if bool(svn_re.search(root)):
+
+        # the journal of an interrupted push with the same options
+        self.journal = None
+        journal_path = options.get('journal')
+        if not journal_path and getattr(settings, 'AWS_JOURNAL_DIR', None):
+            journal_path = os.path.join(settings.AWS_JOURNAL_DIR, 'push-%s%s.journal' % (
+                '+'.join([ destination.name for destination in self.destinations ]),
+                get_shard_suffix(self.shard)))
+        if journal_path and not options.get('dryrun') and not options.get('plan'):
+            self.journal = SyncJournal(journal_path,
+                's3-push %s gzip=%s brotli=%s expires=%s shard=%s' % (
+                    ' '.join([ '%s:%s' % (destination.bucket_name, destination.prefix) \
+                                 for destination in self.destinations ]),
+                    bool(options.get('gzip')),
+                    bool(options.get('brotli')), bool(options.get('expires')),
+                    options.get('shard')))
+            resumed = self.journal.open()
+            if self.verbosity > 0 and resumed:
+                print "Resuming the push, %d files completed in %s" % (resumed, journal_path)
+
+        # the operations are written to the plan instead of being sent
+        self.plan = create_plan(options, 's3-push', self.destinations)
+
+        # the watch is started first so the changes made during the push are seen
+        watcher = None
+        if options.get('watch'):
+            watcher = MediaWatcher(self.create_scanner(media_root, options),
+                                   options.get('watch_delay'))
+            watcher.start()
+
+        # the scan is streamed into the pipeline while the workers run
+        self.unchanged_count = 0
+        s3_files = self.scan_media_root(media_root, manifest_entries, options)
+
+        if manifest_path:
+            # the manifest may resolve every file, then there's nothing to list
+            try:
+                first_file = s3_files.next()
+            except StopIteration:
+                first_file = None
+            if self.verbosity > 0 and first_file is None:
+                print "Skipped %d files unchanged in the manifest" % self.unchanged_count
+            if first_file is None and not options.get('mirror'):
+                if self.journal is not None:
+                    self.journal.finish()
+                finish_run(self.metrics, options, self.verbosity)
+                if self.plan is not None:
+                    finish_plan(self.plan, skipped=self.metrics.counts['skipped'])
+                if watcher is not None:
+                    sys.exit(self.watch(watcher, media_root, manifest_path, process_args,
+                                        options))
+                return
+            if first_file is not None:
+                s3_files = itertools.chain([first_file], s3_files)
+
+        # index the existing keys once instead of a HEAD request per file
+        if not options.get('force') and not options.get('no_index'):
+            for num, destination in enumerate(self.destinations):
+                if destination.bucket_index is None:
+                    self.build_index(num)
+
+        # the orphaned keys are deleted once the pushed files are done
+        delete_batches = []
+        if options.get('mirror'):
+            delete_batches = self.find_orphans(media_root, options)
+
+        compress_cache = create_compress_cache(
+            options.get('compress_cache') or getattr(settings, 'AWS_COMPRESS_CACHE', None),
+            options.get('compress_cache_size'))
+        worker_options = get_worker_options(options)
+        worker_options.update(
+            compress_cache=compress_cache,
+            destinations=self.destinations,
+            compare=options.get('compare'),
+            manifest_path=manifest_path,
+        )
+
+        prepare_workers = create_workers(S3PrepareWorker, options.get('prepare_processes'),
+                                         process_args, worker_options)
+        upload_workers = create_upload_workers(options, process_args, worker_options, self.plan)
+        s3_files = schedule_files(s3_files, options.get('schedule'), options.get('lookahead'))
+        process_result = run_pipeline(s3_files, prepare_workers, upload_workers,
+                                      get_engine(options), self.metrics, options.get('progress'),
+                                      self.journal, delete_batches)
+        if self.journal is not None:
+            # the journal is kept for the rerun of a failed push
+            if process_result:
+                self.journal.close()
+            else:
+                self.journal.finish()
+
+        if self.verbosity > 0 and manifest_path:
+            print "Skipped %d files unchanged in the manifest" % self.unchanged_count
+        finish_run(self.metrics, options, self.verbosity)
+
+        if self.plan is not None:
+            finish_plan(self.plan, process_result, self.metrics.counts['skipped'])
+
+        if compress_cache is not None:
+            compress_cache.evict()
+
+        if watcher is not None:
+            process_result = self.watch(watcher, media_root, manifest_path, process_args,
+                                        options) or process_result
+
+        if process_result:
+            sys.exit(process_result)
+
+    def scan_media_root(self, media_root, manifest_entries, options):
+        """
+        Scans the media root and yields the S3 files to check.  Files that
+        are unchanged in the manifest are skipped without being read.
+        """
+        scanner = self.create_scanner(media_root, options)
+
+        for rel_path, filename, file_stat in scanner.scan():
+            s3_file = S3File.create(self.destinations, rel_path, filename)
+            s3_file.stat = file_stat
+
+            # the files of the other shards are pushed by their hosts (to every destination)
+            if not in_shard(s3_file.file_key, self.shard):
                 continue
 
-            for file in files:
-                file_key = os.path.join(root[len(media_root):], file)
-                if self.prefix:
-                    file_key = self.prefix + file_key
+            fingerprint = None
+            targets = []
+            for target in s3_file.targets:
+                event_key = self.destinations[target.destination].get_event_key(target.file_key)
+
+                # skip the keys unchanged since the last push without reading the file
+                entry = manifest_entries and \
+                    manifest_entries[target.destination].get(target.file_key)
+                if entry and not options.get('force'):
+                    if fingerprint is None:
+                        fingerprint = upload_fingerprint(
+                            build_headers(rel_path, filename, self.policy),
+                            options.get('gzip'), options.get('brotli'))
+                    if entry.is_current(file_stat, fingerprint):
+                        self.unchanged_count += 1
+                        self.metrics.skip(event_key, file_stat.st_size)
+                        continue
+
+                # skip the keys completed by the interrupted push
+                if self.journal is not None:
+                    entry_name = 'put:%s' % event_key
+                    token = '%d:%r' % (file_stat.st_size, file_stat.st_mtime)
+                    if self.journal.is_done(entry_name, token):
+                        self.metrics.skip(event_key, file_stat.st_size)
+                        continue
+                    self.journal.expect(event_key, [(entry_name, token,)])
+
+                if entry:
+                    target.last_fingerprint = entry.fingerprint
+                targets.append(target)
+
+            # queue the file object for S3
+            if targets:
+                s3_file.targets = targets
+                yield s3_file
+
+    def create_scanner(self, media_root, options):
+        return MediaScanner(media_root,
+                            exclude=self.FILTER_LIST + (options.get('exclude') or []),
+                            include=options.get('include') or [],
+                            workers=options.get('scan_workers'))
+
+    def get_bucket(self, destination=0):
+        if destination not in self.buckets:
+            self.buckets[destination] = self.destinations[destination].connect()
+        return self.buckets[destination]
+
+    def build_index(self, destination=0):
+        """
+        Lists the destination prefix into the in-memory bucket index of the
+        destination.
+        """
+        prefix = self.destinations[destination].prefix
+        if self.verbosity > 0:
+            print "Building the bucket index of %s for prefix '%s'" % (
+                self.destinations[destination].name, prefix)
+        bucket_index = S3BucketIndex(self.get_bucket(destination), prefix).build()
+        if self.verbosity > 0:
+            print "Indexed %d keys" % len(bucket_index)
+        self.destinations[destination].bucket_index = bucket_index
+        return bucket_index
+
+    def iter_bucket_keys(self, destination):
+        """
+        Yields the (relative name, destination, key info) of the keys under
+        the destination prefix in the S3 listing order, from the bucket index
+        if one was built or else from a streamed listing.
+        """
+        prefix = self.destinations[destination].prefix
+        bucket_index = self.destinations[destination].bucket_index
+        if bucket_index is not None:
+            key_infos = sorted(bucket_index.keys.itervalues(),
+                               key=lambda key_info: utf8(key_info.name))
+        else:
+            key_infos = itertools.imap(S3KeyInfo.from_key,
+                                       self.get_bucket(destination).list(prefix=prefix))
+        for key_info in key_infos:
+            yield utf8(key_info.name)[len(prefix):], destination, key_info
+
+    def find_orphans(self, media_root, options):
+        """
+        Finds the keys under the destination prefixes without a local file
+        with a merge join of the sorted local scan and the bucket listings,
+        all are streamed in the same (byte) order of the names relative to
+        the prefixes, so the tree is scanned once for every destination.
+        The compressed variants of the local CSS/javascript files are kept,
+        only the names of those files are held in memory.  Returns the
+        delete batches of the orphans of each destination.
+        """
+        scanner = self.create_scanner(media_root, options)
+        compressible = set()
+
+        def local_keys():
+            for rel_path, filename, file_stat in scanner.sorted_scan():
+                if mimetypes.guess_type(filename)[0] in S3Worker.GZIP_CONTENT_TYPES:
+                    compressible.add(rel_path)
+                yield rel_path
+
+        local_iter = local_keys()
+        local_key = next(local_iter, None)
+        if local_key is None:
+            # an empty (or unmounted) media root would delete everything
+            raise CommandError("MEDIA_ROOT has no files to mirror.")
+
+        orphans = []
+        variants = []
+        for rel_path, destination, key_info in heapq.merge(*[ self.iter_bucket_keys(num) \
+                for num in xrange(len(self.destinations)) ]):
+            while local_key is not None and local_key < rel_path:
+                local_key = next(local_iter, None)
+            if local_key == rel_path:
+                continue
 
-                filename = os.path.join(root, file)
-                
-                # queue the file object for S3
-                s3_file = S3File(settings.AWS_BUCKET_NAME, file_key, filename)
-                get_queue().put(s3_file)
+            # folder markers, the files left out of the push and the keys
+            # of the other shards are kept
+            if not rel_path or rel_path.endswith('/') or not scanner.is_managed(rel_path) or \
+                    not in_shard(self.destinations[0].get_key(rel_path), self.shard):
+                continue
 
-        process_workers = []
-        for num in xrange(processes_count):
-            process_workers.append(S3UploadWorker(num, *process_args))
+            original_path = original_key(rel_path)
+            if original_path != rel_path:
+                # decided once the scan has seen the original file
+                variants.append((original_path, destination, key_info,))
+            else:
+                orphans.append((destination, key_info,))
+
+        if variants:
+            for local_key in local_iter:
+                pass
+            orphans.extend([ (destination, key_info,) \
+                                for rel_path, destination, key_info in variants \
+                                    if rel_path not in compressible ])
+
+        print "Mirror: %d orphaned keys (%.1f MB) to delete%s" % (
+            len(orphans), sum([ key_info.size for destination, key_info in orphans ]) / 1048576.0,
+            options.get('dryrun') and ' (dry run)' or '')
+        if self.verbosity > 1:
+            for destination, key_info in orphans:
+                print "\t%s" % self.destinations[destination].get_event_key(utf8(key_info.name))
+
+        delete_batches = []
+        for num, destination in enumerate(self.destinations):
+            delete_batches.extend(S3DeleteBatch.create_batches(destination.bucket_name,
+                [ key_info.name for key_num, key_info in orphans if key_num == num ],
+                destination=num))
+        return delete_batches
+
+    def watch(self, watcher, media_root, manifest_path, process_args, options):
+        """
+        Pushes the changes reported by the watcher until the command is
+        interrupted (or terminated).  The workers are started once and keep
+        their connections open, the files of each change are queued into
+        the running pool.  Returns the sum of the worker exit codes.
+        """
+        # the bucket index of the initial push goes stale once the watched
+        # changes are pushed, each change is checked with a HEAD request
+        for destination in self.destinations:
+            destination.bucket_index = None
+
+        # the journal of the initial push is finished, the rescans aren't journaled
+        self.journal = None
+
+        # there's no end of the run to wait for, the run copies are disabled
+        worker_options = get_worker_options(dict(options, no_copy=True))
+        worker_options.update(
+            compress_cache=create_compress_cache(
+                options.get('compress_cache') or getattr(settings, 'AWS_COMPRESS_CACHE', None),
+                options.get('compress_cache_size')),
+            destinations=self.destinations,
+            compare=options.get('compare'),
+            manifest_path=manifest_path,
+        )
+        self.metrics = RunMetrics('s3-push', self.bucket_names, options.get('dryrun'))
+        pool = S3WorkerPool(
+            create_workers(S3PrepareWorker, options.get('prepare_processes'),
+                           process_args, worker_options),
+            create_workers(S3UploadWorker, get_upload_worker_count(options),
+                           process_args, worker_options),
+            options.get('engine'), self.metrics, options.get('progress'))
+        pool.start()
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, terminate)
+
+        if self.verbosity > 0:
+            print "Watching %s for changes (%s)" % (
+                media_root, watcher.use_inotify and 'inotify' or 'polling')
+        try:
+            try:
+                for changes in watcher.changes():
+                    if self.verbosity > 0:
+                        print "Pushing %d changes" % len(changes)
+                    for s3_file in self.get_change_files(changes, media_root, options):
+                        pool.put(s3_file)
+            except KeyboardInterrupt:
+                pass
+            except RuntimeError, e:
+                print e
+                return pool.finish()
+        finally:
+            watcher.stop()
+
+        process_result = pool.stop()
+        finish_run(self.metrics, options, self.verbosity)
+        return process_result
+
+    def get_change_files(self, changes, media_root, options):
+        """
+        Yields the S3 files (and delete batches) of the watched changes.
+        """
+        put_paths = set([ rel_path for action, rel_path in changes if action == 'put' ])
+        for action, rel_path in changes:
+            file_key = self.destinations[0].get_key(rel_path)
+            filename = os.path.join(media_root, rel_path)
+            if action in ('put', 'delete',) and not in_shard(file_key, self.shard):
+                continue
+            if action == 'rescan':
+                for s3_file in self.scan_media_root(media_root, (), options):
+                    yield s3_file
+            elif action == 'put':
+                try:
+                    file_stat = os.stat(filename)
+                except OSError:
+                    # removed again, the delete follows
+                    continue
+                s3_file = S3File.create(self.destinations, rel_path, filename)
+                s3_file.stat = file_stat
+                yield s3_file
+            elif action == 'delete':
+                yield S3File.create(self.destinations, rel_path, filename, delete=True)
+            elif action == 'delete_dir':
+                # the files written again into the directory are kept
+                for num, destination in enumerate(self.destinations):
+                    file_keys = []
+                    for key in self.get_bucket(num).list(prefix=destination.get_key(rel_path + '/')):
+                        key_path = utf8(key.name)[len(destination.prefix):]
+                        if original_key(key_path) not in put_paths and \
+                                in_shard(self.destinations[0].get_key(key_path), self.shard):
+                            file_keys.append(key.name)
+                    for delete_batch in S3DeleteBatch.create_batches(destination.bucket_name,
+                                                                     file_keys, destination=num):
+                        yield delete_batch
 
-        for process_worker in process_workers:
-            process = Process(target=process_worker)
-            process.start()
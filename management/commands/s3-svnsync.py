@@ -16,6 +16,7 @@ Required Django settings:
 AWS_ACCESS_KEY_ID = ''
 AWS_SECRET_ACCESS_KEY = ''
 AWS_BUCKET_NAME = ''
+(or AWS_DESTINATIONS, the buckets and prefixes the files are pushed to)
 
 The local MEDIA_ROOT needs to a valid SVN repository.
 
@@ -28,11 +29,59 @@ Command options are:
   -p PREFIX, --prefix=PREFIX
                         The prefix to prepend to the path on S3.
   --gzip                Enables gzipping of javascript/css files.
+  --brotli              Enables brotli (.br) variants of javascript/css files.
+  --compress-cache=PATH The directory caching the compressed files by content
+                        digest. Defaults to settings.AWS_COMPRESS_CACHE if set.
+  --compress-cache-size=MB
+                        The compression cache size limit (default 512).
   --expires             Enables expires header
   --dryrun              Only show actions instead of uploading files
   --workers             Specify the number of worker processes to use for uploading files.
+  --prepare-workers     Specify the number of worker processes used to check, digest and
+                        gzip the files (defaults to the CPU count).
+  --adaptive            Adapts the number of S3 requests in flight to the
+                        throughput (AIMD), starting at --workers.
+  --max-workers=N       The most upload workers used by --adaptive (default 32).
+  --retries=N           The retries of a throttled or failed S3 request, with
+                        a jittered exponential backoff (default 5).
+  --engine=ENGINE       Runs the upload workers as processes (default) or as threads.
+  --no-copy             Uploads every file instead of copying the content of
+                        an existing key or a file of the run with the same
+                        content (server-side COPY).
+  --schedule=MODE       The upload order: size (largest files first, default)
+                        or fifo (scan order).
+  --lookahead=N         The number of scanned files reordered by the size
+                        schedule (default 1000).
+  --multipart-threshold=MB
+                        Files larger than this size are sent as S3 multipart
+                        uploads (default 64).
+  --part-size=MB        The multipart upload part size (default 16, 5 minimum).
+  --part-threads=N      The number of parts sent in parallel by each worker
+                        (default 4).
+  --destination=NAME    Only syncs to the named settings.AWS_DESTINATIONS
+                        destination. Can be repeated.
+  --shard=I/N           Only syncs the I-th of N slices of the changes, split
+                        by a hash of the S3 key. Each shard stores its
+                        completed revision in the svn bucket, the S3 revision
+                        is advanced once every shard has completed it.
+  --plan=PATH           Looks up the changes as usual but writes the uploads,
+                        copies, deletes and the new S3 revision to the plan
+                        file instead of sending them (see s3-apply). The
+                        revisions are planned as a single window.
+  --report=PATH         Writes the JSON run report (counts, bytes, request
+                        latency histograms, slowest directories) to the file.
+  --progress            Shows the live progress with the throughput and ETA.
   --verbose             Prints the basic output
   --debug               Prints the maximum output
+  --journal=PATH        The local journal of the completed operations, also
+                        stored in the svn bucket. A rerun after a failure only
+                        does the remaining work of the revision window.
+  --bootstrap=MODE      The first sync of the bucket: push (default) uploads
+                        every versioned file of the working copy and starts
+                        from its revision, history diffs from the first
+                        revision of the repository.
+  --revision-window=N   Synchronizes and commits the S3 revision in windows of
+                        N revisions.
   --ignore-url          Ignores the stored SVN url. This is needed if you access the 
                         repository via different endpoints. For example file:///svnhost/repo and 
                         ssh+svn://svnhost/repo
@@ -64,7 +113,8 @@ import optparse
 import os
 import re
 import sys 
-import time
+import threading
+import urllib
 from datetime import datetime
 
 if sys.version_info < (2, 6):
@@ -79,8 +129,9 @@ try:
 except ImportError:
     raise ImportError, "The boto library is not installed."
 
-from multiprocessing import Process
-from . import S3UploadWorker, S3File, DEFAULT_OPTIONS, get_queue
+from . import S3File, S3SyncCommand, DEFAULT_OPTIONS, connect_s3, parse_shard, in_shard, \
+    get_shard_suffix, get_destinations, create_plan, finish_plan
+from ...journal import SyncJournal
 
 
 try:
@@ -96,18 +147,61 @@ except ImportError:
 INITIAL_REVISION = -1  # if svn config not present 
 
 
-class Command(BaseCommand):
+class WorkingCopyStatus(threading.Thread):
+    """
+    Collects the uncommitted changes of the working copy with a single
+    recursive status pass.  Runs with its own svn client while the S3
+    config and the svn diff are fetched.
+    """
+    def __init__(self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.changes = {}
+        self.error = None
+
+    def run(self):
+        try:
+            client = pysvn.Client()
+            for file_status in client.status(self.path, recurse=True, get_all=False):
+                if file_status.text_status not in (pysvn.wc_status_kind.normal,):
+                    self.changes[os.path.normpath(file_status.path)] = file_status
+        except Exception, e:
+            self.error = e
+
+    def get(self, filename):
+        """
+        Returns the status of the given file if it has uncommitted changes.
+        """
+        return self.changes.get(os.path.normpath(filename))
+
+
+class Command(S3SyncCommand):
 
     # Extra variables to avoid passing these around
     FILTER_LIST = ['.DS_Store']
+
+    SYNC_NAME = 'svnsync'
     
     # the config file for the svn revision
     SVN_REVISION_CONF = 'svn_revision.yaml'
 
+    # the journal of the interrupted revision window
+    SVN_JOURNAL = 'svn_journal.txt'
+
+    # the revisions completed by each shard (--shard=I/N)
+    SVN_SHARD_CONF = 'svn_shards/%d-of-%d.yaml'
+
     option_list = BaseCommand.option_list + DEFAULT_OPTIONS + (
         optparse.make_option('--ignore-url',
             dest='ignore_url', action='store_true',
             help="Ignores the remote svn repository url"),
+        optparse.make_option('--bootstrap',
+            dest='bootstrap', default='push', type='choice', choices=('push', 'history',),
+            help="The first sync: push (the working copy, default) or history (diff from the first revision)."),
+        optparse.make_option('--revision-window',
+            dest='revision_window', default=0, type='int', metavar='N',
+            help="Synchronizes and commits the revisions in windows of N revisions."),
     )
 
     help = "Synchronizes the MEDIA_ROOT Subversion (svn) changes to Amazon S3"
@@ -120,17 +214,29 @@ class Command(BaseCommand):
             raise CommandError("Missing AWS keys from settings file.  Please " \
                      "supply both AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY.")
 
-        if not hasattr(settings, 'AWS_BUCKET_NAME') or not settings.AWS_BUCKET_NAME:
+        # the AWS_DESTINATIONS replace the bucket name
+        if not getattr(settings, 'AWS_DESTINATIONS', None) and \
+                (not hasattr(settings, 'AWS_BUCKET_NAME') or not settings.AWS_BUCKET_NAME):
             raise CommandError("AWS_BUCKET_NAME must be set in your settings.")
         
         if not hasattr(settings, 'MEDIA_ROOT') or not settings.MEDIA_ROOT:
             raise CommandError("MEDIA_ROOT must be set in your settings.")
         
-        processes_count = int(options.get('processes'))
-        if processes_count < 1:
-            processes_count = 1
        
         self.dryrun = options.get('dryrun')
+        self.buckets = {}
+        self.svn_buckets = {}
+        self.deleted_dirs = set()
+        self.copy_files = not options.get('no_copy')
+
+        try:
+            self.shard = parse_shard(options.get('shard'))
+            self.destinations = get_destinations(options)
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        if options.get('plan') and (self.dryrun or self.shard is not None):
+            raise CommandError("--plan can't be used with --dryrun or --shard.")
 
         self.verbosity = 0
         if options.get('verbose'):
@@ -146,66 +252,122 @@ class Command(BaseCommand):
 
         client = pysvn.Client()
         client.set_interactive(True)
-            
-        # grab s3 config file data
-        s3_svn_revision = self.get_s3_svn_revision()
 
-        if s3_svn_revision['revision'] == INITIAL_REVISION:
-            # look up initial revision for the given repo
-            # basically, push the repo from the first log entry revision
-            if self.verbosity > 0:
-                print "Pulling svn logs for local repo"
-            history = client.log(settings.MEDIA_ROOT)
-            first_entry = history[-1]
-            s3_svn_revision['revision'] = first_entry.revision.number
-            s3_svn_revision['initial_revision'] = s3_svn_revision['revision']
-            if self.verbosity > 0:
-                print "Using revision %s for first upload" % s3_svn_revision['revision']
+        # the operations and revisions are written to the plan instead of S3
+        self.plan = create_plan(options, 's3-svnsync', self.destinations)
+
+        # the working copy status is crawled once while the changes are looked up
+        wc_status = WorkingCopyStatus(settings.MEDIA_ROOT)
+        wc_status.start()
+            
+        # grab the s3 config file data of each destination
+        s3_svn_revisions = []
+        for destination in xrange(len(self.destinations)):
+            s3_svn_revision = self.get_s3_svn_revision(destination)
+            if self.shard is not None:
+                # a shard continues from its own completed revision
+                shard_revision = self.get_shard_revision(destination=destination)
+                if shard_revision is not None:
+                    s3_svn_revision['revision'] = shard_revision
+            s3_svn_revisions.append(s3_svn_revision)
+
+        # the new destinations are bootstrapped from the working copy (push) or
+        # synchronized from the first revision of the repo (history)
+        bootstrapped = []
+        first_revision = None
+        for destination, s3_svn_revision in enumerate(s3_svn_revisions):
+            if s3_svn_revision['revision'] != INITIAL_REVISION:
+                continue
+            if options.get('bootstrap') == 'history':
+                # look up initial revision for the given repo, only the oldest
+                # log entry is fetched.  push the repo from the first revision
+                if first_revision is None:
+                    if self.verbosity > 0:
+                        print "Looking up the first svn log entry of the local repo"
+                    first_revision = client.log(settings.MEDIA_ROOT,
+                        revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, 0),
+                        revision_end=pysvn.Revision(pysvn.opt_revision_kind.base),
+                        limit=1)[0].revision.number
+                s3_svn_revision['revision'] = first_revision
+                s3_svn_revision['initial_revision'] = first_revision
+                if self.verbosity > 0:
+                    print "Using revision %s for first upload of %s" % (first_revision,
+                        self.destinations[destination].name)
+            else:
+                # push the working copy and start from its revision, no history is read
+                bootstrapped.append(destination)
 
         # local svn repo information
         local_repo_info = client.info(settings.MEDIA_ROOT)
-        if 'url' in s3_svn_revision and s3_svn_revision['url']:
-            if s3_svn_revision['url'] != local_repo_info.url:
-                if not self.ignore_svn_url :
-                    raise CommandError("The S3 repo %s does not match the local repo %s" % \
-                                       (s3_svn_revision['url'], local_repo_info.url))
+        for s3_svn_revision in s3_svn_revisions:
+            if 'url' in s3_svn_revision and s3_svn_revision['url']:
+                if s3_svn_revision['url'] != local_repo_info.url:
+                    if not self.ignore_svn_url :
+                        raise CommandError("The S3 repo %s does not match the local repo %s" % \
+                                           (s3_svn_revision['url'], local_repo_info.url))
            
-        # set the url location to remote s3 conf container for update later
-        if not self.ignore_svn_url:
-            s3_svn_revision['url'] = str(local_repo_info.url)
-        
-        s3_svn_revision['uuid'] = str(local_repo_info.uuid)
-
-        if self.verbosity > 0:
-            print "Local SVN revision: %s" % local_repo_info.revision.number
-            print "S3 SVN revision: %s" % s3_svn_revision['revision']
-            print "Running svn diff"
+            # set the url location to remote s3 conf container for update later
+            if not self.ignore_svn_url:
+                s3_svn_revision['url'] = str(local_repo_info.url)
         
-        # calculates the changes from the local svn revision vs the s3 svn revision
-        changes = client.diff_summarize(url_or_path1=settings.MEDIA_ROOT, 
-                        revision1=pysvn.Revision(pysvn.opt_revision_kind.number, s3_svn_revision['revision']),
-                        url_or_path2=local_repo_info.url,
-                        revision2=local_repo_info.revision,
-                        recurse=True)
+            s3_svn_revision['uuid'] = str(local_repo_info.uuid)
 
-        # the list of changes from the local to s3 repository
+        # the (start, end, destinations) revision windows and their changes
+        windows = []
+        window_files = []
         changed_files = []
+        if bootstrapped:
+            if self.verbosity > 0:
+                print "Bootstrapping S3 from the working copy at revision %s" % \
+                    local_repo_info.revision.number
+
+            # a single window of every versioned file
+            for destination in bootstrapped:
+                s3_svn_revisions[destination]['initial_revision'] = \
+                    local_repo_info.revision.number
+            windows.append((0, local_repo_info.revision.number, bootstrapped,))
+            window_files.append(self.get_working_copy_files(client))
+            changed_files.extend(window_files[0])
+
+        synchronized = [ destination for destination in xrange(len(self.destinations)) \
+                            if destination not in bootstrapped ]
+        if synchronized:
+            # the destinations continue from the lowest of their revisions
+            start_revision = min([ s3_svn_revisions[destination]['revision'] \
+                                    for destination in synchronized ])
+            if self.verbosity > 0:
+                print "Local SVN revision: %s" % local_repo_info.revision.number
+                print "S3 SVN revision: %s" % start_revision
+                print "Running svn diff"
         
-        for change in changes:
-            if change.node_kind in (pysvn.node_kind.file, pysvn.node_kind.dir,) and \
-                    change.summarize_kind != pysvn.diff_summarize_kind.normal:
-                s3_file = S3File(settings.AWS_BUCKET_NAME, change.path, os.path.join(settings.MEDIA_ROOT, change.path))
-                
-                if change.summarize_kind == pysvn.diff_summarize_kind.delete:
-                    s3_file.delete = True
-
-                if change.node_kind == pysvn.node_kind.dir and \
-                        change.summarize_kind != pysvn.diff_summarize_kind.delete:
-                    # don't upload individual directories, only delete
-                    continue
+            # the revision windows, each window is synchronized and committed in turn by
+            # the destinations behind its end revision.  A plan is applied at once, the
+            # deletes after the uploads, so it's a single window
+            first_window = len(windows)
+            for start_revision, end_revision in self.get_revision_windows(start_revision,
+                    local_repo_info.revision.number,
+                    not self.plan and options.get('revision_window')):
+                windows.append((start_revision, end_revision,
+                    [ destination for destination in synchronized \
+                        if s3_svn_revisions[destination]['revision'] < end_revision ],))
+
+            # the changes of each window.  The files are uploaded from the working copy,
+            # so a path is only synchronized in the last window it changed in (the later
+            # windows have the destinations of the earlier ones)
+            last_window = {}
+            for num in xrange(first_window, len(windows)):
+                start_revision, end_revision, destinations = windows[num]
+                window_files.append(self.get_changed_files(client, local_repo_info,
+                                                           start_revision, end_revision))
+                for s3_file in window_files[num]:
+                    last_window[s3_file.rel_key] = num
+
+            # the list of changes from the local to s3 repository
+            for num in xrange(first_window, len(windows)):
+                window_files[num] = [ f for f in window_files[num] \
+                                        if last_window[f.rel_key] == num ]
+                changed_files.extend(window_files[num])
 
-                changed_files.append(s3_file)
-        
         if self.verbosity > 0:
             print "Found %d changes" % len(changed_files)
         
@@ -213,13 +375,15 @@ class Command(BaseCommand):
         # if one or more files is out-of-sync, the upload is halted to prevent
         # uncommitted changes from being uploaded.
         outofsync_files = []
+
+        wc_status.join()
+        if wc_status.error is not None:
+            raise CommandError("Unable to check the working copy status: %s" % wc_status.error)
   
-        for i, file in enumerate(changed_files):
-            status_list = client.status(file.filename)
-            if status_list:
-                file_status = status_list[0]
-                if file_status.text_status not in (pysvn.wc_status_kind.normal,):
-                    outofsync_files.append((file, file_status,))
+        for file in changed_files:
+            file_status = wc_status.get(file.filename)
+            if file_status is not None:
+                outofsync_files.append((file, file_status,))
                     
         if outofsync_files:
             print "Unable to upload changes to S3. The local repository is out-of-sync. " \
@@ -230,70 +394,268 @@ class Command(BaseCommand):
             sys.exit(1)
         
         if not changed_files:
+            if self.plan is not None:
+                finish_plan(self.plan)
             sys.exit(0)
-        
-        # load the queue
-        [ get_queue().put(s3_file) for s3_file in changed_files ]
-      
-        # build the args for the process workers
-        process_args = (
-            settings.AWS_BUCKET_NAME,                        
-            settings.AWS_ACCESS_KEY_ID,
-            settings.AWS_SECRET_ACCESS_KEY,
-            self.verbosity,
-            options.get('prefix'),
-            options.get('gzip'),
-            options.get('expires'),
-            True, # run with force 
-            self.dryrun,
-        )        
-        
-        processes = [ Process(target=S3UploadWorker(num, *process_args)) \
-                                for num in xrange(processes_count) ]
-        
-        # fire off workers
-        for s3_worker in processes:
-            s3_worker.start()
 
-        # poll the workers until they are all finished
-        while True:
-            some_alive = any([ worker.is_alive() for worker in processes ])
+        for num, (start_revision, end_revision, destinations) in enumerate(windows):
+            if window_files[num] and destinations:
+                if self.verbosity > 0 and len(windows) > 1:
+                    print "Synchronizing revisions %d to %d (%d changes)" % (start_revision,
+                        end_revision, len(window_files[num]))
+                process_result = self.sync_window(window_files[num], destinations,
+                                                  s3_svn_revisions[destinations[0]],
+                                                  start_revision, end_revision, options)
+                if process_result:
+                    if self.plan is not None:
+                        finish_plan(self.plan, process_result)
+                    sys.exit(process_result)
 
-            if some_alive:
-                time.sleep(0.1)
-            else:
-                process_result = sum([ abs(worker.exitcode) for worker in processes ])    
-                if not process_result:
-                    # all completed successfully
-                    if self.verbosity > 0:
-                        print "Updating S3 revision number to %d" % local_repo_info.revision.number
-                        
-                    # store the current repo number
-                    s3_svn_revision['revision'] = local_repo_info.revision.number
-                    s3_svn_revision['last_update'] = datetime.now().ctime()
-                    self.set_s3_revision(s3_svn_revision)
-                        
-                    if self.verbosity > 0:
-                        print "Finished (exit code: %d)" % process_result
-                    break
-                
+            # all completed successfully, store the synchronized repo number
+            for destination in destinations:
+                if self.verbosity > 0:
+                    print "Updating S3 revision number of %s to %d" % (
+                        self.destinations[destination].name, end_revision)
+                s3_svn_revision = s3_svn_revisions[destination]
+                s3_svn_revision['revision'] = end_revision
+                s3_svn_revision['last_update'] = datetime.now().ctime()
+                if self.shard is not None:
+                    self.set_shard_revision(s3_svn_revision, destination)
                 else:
-                    sys.exit(process_result)
+                    self.set_s3_revision(s3_svn_revision, destination=destination)
 
-    
-    def get_s3_svn_bucket(self):
+        if self.plan is not None:
+            finish_plan(self.plan)
+        if self.verbosity > 0:
+            print "Finished (exit code: 0)"
+
+    def get_revision_windows(self, start_revision, end_revision, window_size=None):
+        """
+        Splits the revision range into (start, end) windows of the given
+        number of revisions.  Without a window size the range is a single
+        window.
+        """
+        if not window_size or window_size < 1 or end_revision - start_revision <= window_size:
+            return [(start_revision, end_revision,)]
+        windows = []
+        while start_revision < end_revision:
+            windows.append((start_revision, min(start_revision + window_size, end_revision),))
+            start_revision = windows[-1][1]
+        return windows
+
+    def get_working_copy_files(self, client):
+        """
+        Returns the S3 files of every versioned file in the working copy.
+        The entries are read from the working copy, the repository isn't
+        contacted.
+        """
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        working_copy_files = []
+        for path, info in client.info2(media_root,
+                                       revision=pysvn.Revision(pysvn.opt_revision_kind.working),
+                                       recurse=True):
+            if info.kind != pysvn.node_kind.file:
+                continue
+            rel_key = os.path.relpath(path, media_root).replace(os.sep, '/')
+            working_copy_files.append(S3File.create(self.destinations, rel_key,
+                                                    os.path.join(settings.MEDIA_ROOT, rel_key)))
+        return working_copy_files
+
+    def get_changed_files(self, client, local_repo_info, start_revision, end_revision):
+        """
+        Returns the S3 files of the changes between the two revisions.  The
+        deleted directories (relative to the destination prefixes) are
+        collected into self.deleted_dirs.
+        """
+        # calculates the changes from the local svn revision vs the s3 svn revision
+        changes = client.diff_summarize(url_or_path1=settings.MEDIA_ROOT, 
+                        revision1=pysvn.Revision(pysvn.opt_revision_kind.number, start_revision),
+                        url_or_path2=local_repo_info.url,
+                        revision2=pysvn.Revision(pysvn.opt_revision_kind.number, end_revision),
+                        recurse=True)
+
+        # the svn copies and moves (a delete and an add) are copied on S3 if unchanged
+        copy_hints = {}
+        if self.copy_files:
+            copy_hints = self.get_copy_hints(client, local_repo_info, start_revision, end_revision)
+
+        changed_files = []
+        for change in changes:
+            if change.node_kind in (pysvn.node_kind.file, pysvn.node_kind.dir,) and \
+                    change.summarize_kind != pysvn.diff_summarize_kind.normal:
+                s3_file = S3File.create(self.destinations, change.path,
+                                        os.path.join(settings.MEDIA_ROOT, change.path))
+                
+                if change.summarize_kind == pysvn.diff_summarize_kind.delete:
+                    s3_file.delete = True
+                    if change.node_kind == pysvn.node_kind.dir:
+                        self.deleted_dirs.add(s3_file.rel_key)
+
+                if change.node_kind == pysvn.node_kind.dir and \
+                        change.summarize_kind != pysvn.diff_summarize_kind.delete:
+                    # don't upload individual directories, only delete
+                    continue
+
+                copy_hint = copy_hints and s3_file.do_upload() and \
+                    self.find_copy_hint(copy_hints, s3_file.rel_key)
+                if copy_hint:
+                    for target in s3_file.targets:
+                        target.copy_hint = self.destinations[target.destination].get_key(copy_hint)
+                changed_files.append(s3_file)
+        return changed_files
+
+    def get_copy_hints(self, client, local_repo_info, start_revision, end_revision):
+        """
+        Returns the copied paths (file key => source key) of the revisions
+        from the svn log.  Copied directories map the directory paths.
+        """
+        if start_revision >= end_revision:
+            return {}
+
+        # the MEDIA_ROOT path in the repository, the log paths are relative to the root
+        media_path = urllib.unquote(local_repo_info.url[len(local_repo_info.repos):]).rstrip('/') + '/'
+
+        copy_hints = {}
+        for entry in client.log(local_repo_info.url,
+                revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, start_revision + 1),
+                revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, end_revision),
+                discover_changed_paths=True):
+            for changed_path in entry.changed_paths:
+                copyfrom_path = changed_path.copyfrom_path
+                if changed_path.action in ('A', 'R',) and copyfrom_path and \
+                        changed_path.path.startswith(media_path) and \
+                        copyfrom_path.startswith(media_path):
+                    copy_hints[changed_path.path[len(media_path):]] = copyfrom_path[len(media_path):]
+        return copy_hints
+
+    def is_shard_file(self, s3_file):
+        """
+        Returns True if the changed file belongs to this host's shard, the
+        keys of a deleted directory are split when they are listed.
+        """
+        return s3_file.rel_key in self.deleted_dirs or in_shard(s3_file.file_key, self.shard)
+
+    def get_delete_keys(self, s3_file, target):
+        """
+        The keys of the target deleted for the removed file, the keys under
+        a deleted directory are listed.  Only the keys of this host's shard
+        are returned.
         """
-        Looks up the svn s3 configuration bucket instance.  If the bucket
-        does not exist, it will be created.
+        if s3_file.rel_key in self.deleted_dirs:
+            file_keys = self.list_prefix_keys(target.destination,
+                                              target.file_key.rstrip('/') + '/')
+        else:
+            file_keys = S3SyncCommand.get_delete_keys(self, s3_file, target)
+        return [ file_key for file_key in file_keys \
+                     if self.in_shard(target.destination, file_key) ]
+
+    def find_copy_hint(self, copy_hints, file_key):
+        """
+        Returns the copy source of the file key, the file or one of its
+        parent directories was copied.
+        """
+        path = file_key
+        while path:
+            if path in copy_hints:
+                return copy_hints[path] + file_key[len(path):]
+            path = path.rpartition('/')[0]
+        return None
+
+    def sync_window(self, changed_files, destinations, s3_svn_revision, start_revision,
+                    end_revision, options):
+        """
+        Runs the changes of the revision window through the workers, to the
+        given destinations.  The completed operations are journaled, a rerun
+        of the same window only does the remaining work.  Returns the worker
+        exit code.
+        """
+        journal = None
+        if not self.dryrun and not self.plan:
+            journal = SyncJournal(self.get_journal_path(options), 'svnsync %s %s %d:%d%s' % (
+                self.get_destination_names(destinations),
+                s3_svn_revision.get('url') or s3_svn_revision['uuid'],
+                start_revision, end_revision, get_shard_suffix(self.shard)),
+                on_checkpoint=self.store_journal)
+            self.load_journal(journal.path)
+            resumed = journal.open()
+            if self.verbosity > 0 and resumed:
+                print "Resuming revisions %d to %d, %d operations completed" % (start_revision,
+                    end_revision, resumed)
+
+        process_result = self.sync_changes(changed_files, destinations, journal, options)
+
+        if journal is not None:
+            if process_result:
+                # kept (and stored in the svn bucket) for the rerun
+                journal.close()
+            else:
+                journal.finish()
+                self.remove_journal()
+        return process_result
+
+    def get_journal_key(self):
+        """
+        The name of the journal copy in the svn bucket, one per shard.
+        """
+        name, ext = os.path.splitext(self.SVN_JOURNAL)
+        return self.get_conf_key(name + get_shard_suffix(self.shard) + ext)
+
+    def load_journal(self, path):
+        """
+        Restores the journal stored in the svn bucket when there's no local
+        journal (for example a rerun on another host).
+        """
+        if os.path.exists(path):
+            return
+        svn_key = self.get_svn_bucket().get_key(self.get_journal_key())
+        if svn_key:
+            if self.verbosity > 0:
+                print "Restoring the journal from the svn bucket"
+            svn_key.get_contents_to_filename(path)
+
+    def store_journal(self, path):
+        """
+        Copies the journal checkpoint into the svn bucket.
+        """
+        svn_key = boto.s3.key.Key(self.get_svn_bucket())
+        svn_key.name = self.get_journal_key()
+        svn_key.set_contents_from_filename(path)
+
+    def remove_journal(self):
+        self.get_svn_bucket().delete_key(self.get_journal_key())
+
+    def get_svn_bucket(self, destination=0):
+        """
+        The cached svn s3 configuration bucket of the destination.
+        """
+        if destination not in self.svn_buckets:
+            self.svn_buckets[destination] = self.get_s3_svn_bucket(destination)
+        return self.svn_buckets[destination]
+
+    def list_prefix_keys(self, destination, prefix):
+        """
+        Lists the keys stored under the given prefix in the destination bucket.
+        """
+        if self.verbosity > 1:
+            print "Listing deleted directory %s" % self.get_event_key(destination, prefix)
+        if destination not in self.buckets:
+            self.buckets[destination] = self.destinations[destination].connect()
+        return [ key.name for key in self.buckets[destination].list(prefix=prefix) ]
+
+    def get_s3_svn_bucket(self, destination=0):
+        """
+        Looks up the svn s3 configuration bucket instance of the destination.
+        If the bucket does not exist, it will be created.
         """
         if self.verbosity > 1:
             print "Connecting to s3"
             
         # open s3 connection to retrieve the current revision 
-        conn = boto.connect_s3(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
+        conn = connect_s3(self.destinations[destination].aws_access_key_id,
+                          self.destinations[destination].aws_secret_key)
         
         # the s3 svn configuration bucket
-        svn_bucket_name = '.'.join([settings.AWS_BUCKET_NAME, 'svn'])
+        svn_bucket_name = '.'.join([self.destinations[destination].bucket_name, 'svn'])
         
         try:
             svn_bucket = conn.get_bucket(svn_bucket_name)
@@ -302,17 +664,18 @@ class Command(BaseCommand):
         
         return svn_bucket
       
-    def get_s3_svn_revision(self):
+    def get_s3_svn_revision(self, destination=0):
         """ 
-        Retrieves the SVN revision number for the S3 conf bucket.
+        Retrieves the SVN revision number of the destination from its S3
+        conf bucket.
         """
         # the s3 revision conf
         s3_revision = dict(url='', revision=INITIAL_REVISION, last_update=None, uuid=None)
-        svn_bucket = self.get_s3_svn_bucket()
-        svn_key = svn_bucket.get_key(self.SVN_REVISION_CONF)
+        svn_bucket = self.get_svn_bucket(destination)
+        svn_key = svn_bucket.get_key(self.get_conf_key(self.SVN_REVISION_CONF, destination))
         
         if not svn_key:
-            self.set_s3_revision(s3_revision, svn_bucket)
+            self.set_s3_revision(s3_revision, svn_bucket, destination)
         else:
             s3_data = svn_key.read()
             s3_revision_yaml = yaml.load(s3_data)
@@ -320,21 +683,69 @@ class Command(BaseCommand):
                 
         return s3_revision
     
-    def set_s3_revision(self, s3_revision, bucket_instance=None):
+    def set_s3_revision(self, s3_revision, bucket_instance=None, destination=0):
         """
-        Stores the svn revision number in the S3 conf bucket
+        Stores the svn revision number in the S3 conf bucket of the destination.
         """
-        svn_bucket = bucket_instance or self.get_s3_svn_bucket() 
-        svn_key = svn_bucket.get_key(self.SVN_REVISION_CONF)
+        svn_bucket = bucket_instance or self.get_svn_bucket(destination)
+        conf_key = self.get_conf_key(self.SVN_REVISION_CONF, destination)
+        svn_key = svn_bucket.get_key(conf_key)
         
         if not svn_key:
             svn_key = boto.s3.key.Key(svn_bucket)
-            svn_key.name = self.SVN_REVISION_CONF
+            svn_key.name = conf_key
             if self.verbosity > 0:
                 print "Creating S3 SVN config file %s in bucket %s" % (svn_key.name, svn_bucket.name)
 
         yaml_data = yaml.dump(s3_revision, default_flow_style=False)
-        if not self.dryrun:
+        if self.plan is not None:
+            # stored by s3-apply once the planned changes are done
+            self.plan.add_state(destination, svn_bucket.name, conf_key, yaml_data)
+        elif not self.dryrun:
             svn_key.set_contents_from_string(yaml_data)
         if self.verbosity > 1:
             print "Stored S3 SVN revision %s" % s3_revision['revision']
+
+    def get_shard_revision(self, shard=None, destination=0):
+        """
+        Returns the revision of the destination completed by the shard (this
+        host's shard by default) or None if the shard has not completed a
+        revision.
+        """
+        index, count = shard or self.shard
+        svn_key = self.get_svn_bucket(destination).get_key(
+            self.get_conf_key(self.SVN_SHARD_CONF % (index + 1, count), destination))
+        if not svn_key:
+            return None
+        return yaml.load(svn_key.read()).get('revision')
+
+    def set_shard_revision(self, s3_revision, destination=0):
+        """
+        Stores the completion marker of this host's shard.  The S3 revision
+        is advanced to the lowest revision completed by all of the shards,
+        any shard finding every marker advances it, there's no coordinator.
+        """
+        svn_bucket = self.get_svn_bucket(destination)
+        svn_key = boto.s3.key.Key(svn_bucket)
+        svn_key.name = self.get_conf_key(self.SVN_SHARD_CONF % (self.shard[0] + 1, self.shard[1]),
+                                         destination)
+        if not self.dryrun:
+            svn_key.set_contents_from_string(yaml.dump(s3_revision, default_flow_style=False))
+        if self.verbosity > 1:
+            print "Stored the shard %d/%d revision %s" % (self.shard[0] + 1, self.shard[1],
+                                                          s3_revision['revision'])
+
+        revisions = [ s3_revision['revision'] ]
+        for index in xrange(self.shard[1]):
+            if index != self.shard[0]:
+                revisions.append(self.get_shard_revision((index, self.shard[1],), destination))
+        if None in revisions:
+            if self.verbosity > 0:
+                print "Waiting for %d shards to complete the revision" % revisions.count(None)
+            return
+
+        completed = dict(s3_revision, revision=min(revisions))
+        if completed['revision'] > self.get_s3_svn_revision(destination)['revision']:
+            if self.verbosity > 0:
+                print "All shards completed revision %d" % completed['revision']
+            self.set_s3_revision(completed, svn_bucket, destination)
@@ -0,0 +1,149 @@
+"""
+Local sync manifest for the S3 commands.
+
+The manifest is a small SQLite database mapping each pushed S3 key to the
+local file details (size, mtime, inode, digest) along with the uploaded
+ETag and the header fingerprint.  Files whose stat details and headers are
+unchanged since the last push can be skipped without being read and
+without a bucket listing.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import sqlite3
+
+# seconds to wait on a manifest locked by another worker process
+LOCK_TIMEOUT = 60
+
+
+class ManifestEntry(object):
+    """
+    The local file and S3 details of a pushed key.
+    """
+    __slots__ = ('file_key', 'filename', 'size', 'mtime', 'inode',
+                 'digest', 'etag', 'fingerprint',)
+
+    def __init__(self, file_key, filename, size, mtime, inode,
+                 digest=None, etag=None, fingerprint=None):
+        self.file_key = file_key
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.digest = digest
+        self.etag = etag
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_stat(cls, file_key, filename, file_stat, **kwargs):
+        """
+        Creates the entry from the local file stat result.
+        """
+        return cls(file_key, filename, file_stat.st_size, file_stat.st_mtime,
+                   file_stat.st_ino, **kwargs)
+
+    def is_current(self, file_stat, fingerprint):
+        """
+        Returns True if the local file and headers are unchanged since
+        this entry was recorded.
+        """
+        return self.size == file_stat.st_size and \
+            self.mtime == file_stat.st_mtime and \
+            self.inode == file_stat.st_ino and \
+            self.fingerprint == fingerprint
+
+    def __str__(self):
+        return '<ManifestEntry %s => %s>' % (self.file_key, self.filename)
+
+
+class SyncManifest(object):
+    """
+    The SQLite manifest of the pushed keys for a single bucket.  The database
+    connection is opened on first use so a manifest instance can be created
+    in the parent and used inside a worker process.  Every write is committed
+    in its own short transaction, the write lock is never held while the
+    worker is sending a file.
+    """
+    def __init__(self, path, bucket_name):
+        self.path = path
+        self.bucket_name = bucket_name
+        self._conn = None
+
+    def connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+            # the write-ahead log keeps the per-write commits cheap and lets the
+            # other workers read while one of them writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS manifest ("
+                "bucket TEXT NOT NULL, file_key TEXT NOT NULL, filename TEXT, "
+                "size INTEGER, mtime REAL, inode INTEGER, digest TEXT, etag TEXT, "
+                "fingerprint TEXT, PRIMARY KEY (bucket, file_key))")
+            self._conn.commit()
+        return self._conn
+
+    def load(self):
+        """
+        Loads all of the bucket entries keyed by the S3 file key.
+        """
+        entries = {}
+        cursor = self.connect().execute(
+            "SELECT file_key, filename, size, mtime, inode, digest, etag, "
+            "fingerprint FROM manifest WHERE bucket = ?", (self.bucket_name,))
+        for row in cursor:
+            entries[row[0]] = ManifestEntry(*row)
+        return entries
+
+    def update(self, entry):
+        """
+        Records the given entry, replacing any previous entry for the key.
+        """
+        self.connect().execute(
+            "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.bucket_name, entry.file_key, entry.filename, entry.size,
+             entry.mtime, entry.inode, entry.digest, entry.etag, entry.fingerprint,))
+        self.commit()
+
+    def remove(self, file_key):
+        self.remove_keys([ file_key ])
+
+    def remove_keys(self, file_keys):
+        """
+        Removes the entries of the given keys (a delete batch) in a single
+        transaction.
+        """
+        self.connect().executemany(
+            "DELETE FROM manifest WHERE bucket = ? AND file_key = ?",
+            [ (self.bucket_name, file_key,) for file_key in file_keys ])
+        self.commit()
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self.commit()
+            self._conn.close()
+            self._conn = None
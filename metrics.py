@@ -0,0 +1,321 @@
+"""
+Run metrics for the S3 commands.
+
+The pipeline workers send an event for every processed file (uploaded,
+copied, skipped, deleted or failed) with the timings of the S3 requests it
+made.  The command process collects the events into the run totals, the
+request latency histograms and the per directory timings, shows the live
+progress and writes the JSON run report.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import sys
+import time
+import json
+import bisect
+import datetime
+import posixpath
+import threading
+
+from Queue import Empty
+
+# the file events sent by the workers
+EVENTS = ('uploaded', 'copied', 'skipped', 'deleted', 'failed',)
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,)
+
+# the number of slowest directories and failures kept in the report
+REPORT_PREFIXES = 20
+REPORT_FAILURES = 100
+
+# seconds between the progress updates on a terminal and in a log
+PROGRESS_INTERVAL = 1.0
+PROGRESS_LOG_INTERVAL = 10.0
+
+
+class LatencyHistogram(object):
+    """
+    The request latencies of a single S3 operation.
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket holding the given percentile.
+        """
+        if not self.count:
+            return None
+        target = self.count * percent / 100.0
+        seen = 0
+        for num, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                if num < len(LATENCY_BUCKETS):
+                    return min(LATENCY_BUCKETS[num], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        bounds = [ '<=%s' % bound for bound in LATENCY_BUCKETS ] + [ '>%s' % LATENCY_BUCKETS[-1] ]
+        return dict(
+            count=self.count,
+            total=round(self.total, 3),
+            mean=round(self.total / self.count, 4) if self.count else None,
+            min=round(self.min, 4) if self.min is not None else None,
+            max=round(self.max, 4),
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            buckets=dict([ (bound, count) for bound, count in zip(bounds, self.buckets) if count ]),
+        )
+
+
+class RunMetrics(object):
+    """
+    The aggregated metrics of a command run.  The files queued into the
+    pipeline are counted by the command, the processed files are recorded
+    from the worker events.
+    """
+    def __init__(self, command, bucket_name, dry_run=False):
+        self.command = command
+        self.bucket_name = bucket_name
+        self.dry_run = bool(dry_run)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+
+        self.queued = 0
+        self.queued_bytes = 0
+        self.queue_done = False
+        self.done = 0
+        self.done_bytes = 0
+
+        self.counts = dict([ (event, 0) for event in EVENTS ])
+        self.bytes = dict([ (event, 0) for event in EVENTS ])
+        self.latencies = {}
+        self.prefixes = {}
+        self.failures = []
+        self.restarts = 0
+
+    def queue(self, size=0, count=1):
+        """
+        Counts a file queued into the pipeline, once per destination.
+        """
+        self.lock.acquire()
+        try:
+            self.queued += count
+            self.queued_bytes += (size or 0) * count
+        finally:
+            self.lock.release()
+
+    def skip(self, file_key, size=0):
+        """
+        Records a file skipped by the command before it was queued.
+        """
+        self.queue(size)
+        self.record('skipped', file_key, size)
+
+    def record(self, event, file_key, size=0, keys=1, timings=(), error=None, failed=0):
+        """
+        Records the worker event of a processed file.  Deletes count the
+        number of removed (and failed) keys, the timings are (operation,
+        seconds) pairs.
+        """
+        self.lock.acquire()
+        try:
+            self.done += 1
+            self.done_bytes += size or 0
+            self.counts[event] += keys
+            self.counts['failed'] += failed
+            self.bytes[event] += size or 0
+
+            elapsed = 0.0
+            for operation, seconds in timings:
+                if operation not in self.latencies:
+                    self.latencies[operation] = LatencyHistogram()
+                self.latencies[operation].add(seconds)
+                elapsed += seconds
+
+            if file_key and timings:
+                prefix = posixpath.dirname(file_key)
+                stats = self.prefixes.setdefault(prefix, [0, 0, 0.0])
+                stats[0] += 1
+                stats[1] += size or 0
+                stats[2] += elapsed
+
+            if error and len(self.failures) < REPORT_FAILURES:
+                self.failures.append(dict(file_key=file_key, error=error))
+        finally:
+            self.lock.release()
+
+    def restart(self):
+        """
+        Counts a crashed worker restarted by the pool supervisor.
+        """
+        self.lock.acquire()
+        try:
+            self.restarts += 1
+        finally:
+            self.lock.release()
+
+    def close_queue(self):
+        """
+        Marks the queue complete, the ETA is known from here on.
+        """
+        self.queue_done = True
+
+    def finish(self):
+        self.queue_done = True
+        self.finished = time.time()
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def eta(self):
+        """
+        The estimated seconds remaining, None until the queue is complete.
+        """
+        if not self.queue_done or not self.done:
+            return None
+        return max(self.queued - self.done, 0) * self.elapsed() / self.done
+
+    def progress(self):
+        """
+        Returns the one line progress summary.
+        """
+        elapsed = max(self.elapsed(), 0.001)
+        eta = self.eta()
+        if eta is None:
+            eta_str = 'ETA --:--:--'
+        else:
+            eta_str = 'ETA %s' % datetime.timedelta(seconds=int(eta))
+        return '%d/%d%s files, %d failed, %.1f MB, %.1f files/s, %.2f MB/s, %s' % (
+            self.done, self.queued, not self.queue_done and '+' or '', self.counts['failed'],
+            self.done_bytes / 1048576.0, self.done / elapsed,
+            self.done_bytes / 1048576.0 / elapsed, eta_str)
+
+    def to_dict(self):
+        elapsed = max(self.elapsed(), 0.001)
+        prefixes = sorted(self.prefixes.items(), key=lambda item: item[1][2], reverse=True)
+        return dict(
+            command=self.command,
+            bucket=self.bucket_name,
+            dry_run=self.dry_run,
+            started=datetime.datetime.utcfromtimestamp(self.started).isoformat() + 'Z',
+            seconds=round(elapsed, 3),
+            files=self.done,
+            counts=self.counts,
+            bytes=self.bytes,
+            files_per_sec=round(self.done / elapsed, 2),
+            bytes_per_sec=round(self.bytes['uploaded'] / elapsed, 1),
+            latencies=dict([ (operation, histogram.to_dict()) \
+                                for operation, histogram in self.latencies.items() ]),
+            slowest_prefixes=[ dict(prefix=prefix, files=stats[0], bytes=stats[1],
+                                    seconds=round(stats[2], 3)) \
+                                for prefix, stats in prefixes[:REPORT_PREFIXES] ],
+            failures=self.failures,
+            restarts=self.restarts,
+        )
+
+    def write_report(self, filename):
+        """
+        Writes the JSON run report to the given file.
+        """
+        report_file = open(filename, 'w')
+        try:
+            json.dump(self.to_dict(), report_file, indent=2, sort_keys=True)
+        finally:
+            report_file.close()
+
+    def summary(self):
+        elapsed = self.elapsed()
+        return 'Uploaded %d, copied %d, skipped %d, deleted %d, failed %d files ' \
+               '(%.1f MB sent, %.1f MB copied) in %.1fs' % (
+            self.counts['uploaded'], self.counts['copied'], self.counts['skipped'],
+            self.counts['deleted'], self.counts['failed'], self.bytes['uploaded'] / 1048576.0,
+            self.bytes['copied'] / 1048576.0, elapsed)
+
+
+class MetricsCollector(threading.Thread):
+    """
+    Collects the worker events from the result queue into the run metrics
+    until the end of queue marker (None) is received.  Shows the progress
+    on stderr when enabled.  The successfully processed files are completed
+    in the run journal if given.
+    """
+    def __init__(self, result_queue, metrics, show_progress=False, stream=None, journal=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.result_queue = result_queue
+        self.metrics = metrics
+        self.show_progress = show_progress
+        self.journal = journal
+        self.stream = stream or sys.stderr
+        self.is_tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.interval = self.is_tty and PROGRESS_INTERVAL or PROGRESS_LOG_INTERVAL
+        self.last_progress = 0
+
+    def run(self):
+        while True:
+            try:
+                event = self.result_queue.get(timeout=PROGRESS_INTERVAL)
+            except Empty:
+                event = False
+            if event is None:
+                break
+            if event:
+                self.metrics.record(*event)
+                if self.journal is not None and event[0] != 'failed' and not event[6]:
+                    self.journal.complete(event[1])
+            self.print_progress()
+        self.print_progress(True)
+
+    def print_progress(self, final=False):
+        if not self.show_progress:
+            return
+        now = time.time()
+        if not final and now - self.last_progress < self.interval:
+            return
+        self.last_progress = now
+        if self.is_tty:
+            self.stream.write('\r%s\033[K' % self.metrics.progress())
+            if final:
+                self.stream.write('\n')
+        else:
+            self.stream.write('%s\n' % self.metrics.progress())
+        self.stream.flush()
@@ -0,0 +1,177 @@
+"""
+Serialized sync plans for the S3 commands.
+
+A command run with --plan=PATH checks the files as usual (the bucket index,
+digests, copy sources and deletes) and writes the resulting operations to
+the plan instead of sending them.  The s3-apply command executes the plan
+later, possibly on another host with the same MEDIA_ROOT content, without
+checking the bucket again.
+
+The plan is a gzipped file of JSON lines: the header (the command, the
+destinations and the compression options), a line per file (the key
+relative to the destination prefixes, its size, digest, headers and the
+target keys with their copy sources), a line per delete batch, the state
+stored once the plan is applied (the svn revision or git commit of the sync
+commands) and a summary line closing the plan.  A plan without the summary
+was interrupted and can't be applied.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import gzip
+import json
+import time
+import threading
+
+# the plan format version
+PLAN_VERSION = 1
+
+# the operations counted in the plan summary
+OPERATIONS = ('uploaded', 'copied', 'deleted',)
+
+
+class PlanError(Exception):
+    """
+    An unreadable, incomplete or incompatible plan.
+    """
+    pass
+
+
+class SyncPlan(object):
+    """
+    The plan file of a run.  The planning run writes the header with
+    create(), then the files and delete batches of the upload stage and
+    closes the plan with the summary.  load() reads a complete plan.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.files = []
+        self.deletes = []
+        self.states = []
+        self.summary = None
+        self.counts = dict([ (operation, 0) for operation in OPERATIONS ])
+        self.bytes = dict([ (operation, 0) for operation in OPERATIONS ])
+        self.lock = threading.Lock()
+        self._file = None
+
+    def create(self, command, destinations, **options):
+        """
+        Starts a new plan of the command and destinations.  The options
+        (such as gzip and brotli) are applied with the plan.
+        """
+        self.header = dict(version=PLAN_VERSION, command=command, created=time.time(),
+                           destinations=[ [ destination.name, destination.bucket_name,
+                                            destination.prefix ] \
+                                              for destination in destinations ],
+                           options=options)
+        self._file = gzip.open(self.path, 'wb')
+        self.write(plan=self.header)
+        return self
+
+    def write(self, **record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self.lock.acquire()
+        try:
+            self._file.write(line)
+        finally:
+            self.lock.release()
+
+    def count(self, operation, size=0, keys=1):
+        self.lock.acquire()
+        try:
+            self.counts[operation] += keys
+            self.bytes[operation] += size
+        finally:
+            self.lock.release()
+
+    def add_file(self, s3_file):
+        """
+        Adds the prepared file with its targets (destination, key, copy
+        source, deferred).
+        """
+        self.write(file=dict(key=s3_file.rel_key, size=s3_file.size, digest=s3_file.digest,
+                             fingerprint=s3_file.fingerprint, headers=s3_file.headers,
+                             targets=[ [ target.destination, target.file_key,
+                                         target.copy_source, target.deferred ] \
+                                          for target in s3_file.targets ]))
+        for target in s3_file.targets:
+            self.count(target.copy_source and 'copied' or 'uploaded', s3_file.size)
+
+    def add_delete(self, destination, file_keys):
+        self.write(delete=dict(destination=destination, keys=file_keys))
+        self.count('deleted', keys=len(file_keys))
+
+    def add_state(self, destination, bucket_name, key_name, content):
+        """
+        Adds a key stored once the plan is applied, such as the revision
+        config of a sync command.
+        """
+        self.write(state=dict(destination=destination, bucket=bucket_name, key=key_name,
+                              content=content))
+
+    def close(self, skipped=0):
+        """
+        Writes the summary line (the operation counts and bytes), the plan
+        is complete.
+        """
+        self.summary = dict(counts=dict(self.counts, skipped=skipped), bytes=self.bytes)
+        self.write(summary=self.summary)
+        self._file.close()
+        self._file = None
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def load(self):
+        """
+        Reads the complete plan.  Raises a PlanError if the plan is not
+        readable or was not completed.
+        """
+        try:
+            plan_file = gzip.open(self.path, 'rb')
+            try:
+                for line in plan_file:
+                    record = json.loads(line)
+                    if 'plan' in record:
+                        self.header = record['plan']
+                    elif 'file' in record:
+                        self.files.append(record['file'])
+                    elif 'delete' in record:
+                        self.deletes.append(record['delete'])
+                    elif 'state' in record:
+                        self.states.append(record['state'])
+                    elif 'summary' in record:
+                        self.summary = record['summary']
+            finally:
+                plan_file.close()
+        except (IOError, ValueError), e:
+            raise PlanError("Unable to read the plan %s: %s" % (self.path, e))
+
+        if self.header is None or self.header.get('version') != PLAN_VERSION:
+            raise PlanError("%s is not a plan of this version." % self.path)
+        if self.summary is None:
+            raise PlanError("The plan %s is incomplete (the planning run was interrupted)." % \
+                            self.path)
+        return self
@@ -0,0 +1,174 @@
+"""
+Upload header policy for the S3 commands.
+
+The AWS_HEADER_POLICY setting is a list of rules mapping file name globs
+and content types to the Cache-Control, Expires, canned ACL, storage class
+and metadata of the pushed keys, for example:
+
+    AWS_HEADER_POLICY = (
+        {'match': 'css/*', 'cache_control': 'max-age=31536000, public', 'expires': 365},
+        {'content_type': 'image/*', 'storage_class': 'STANDARD_IA'},
+        {'match': 'private/*', 'acl': 'private'},
+        {'match': '*.pdf', 'headers': {'Content-Disposition': 'attachment'}},
+    )
+
+The rules are compiled once per run.  The headers of every matching rule are
+merged in order (a later rule overrides an earlier one) and the merged
+headers are cached by the set of matching rules, so a file costs a content
+type lookup and the glob matches.  The ACL and storage class are sent as
+the x-amz-acl and x-amz-storage-class headers of the upload itself.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import re
+import time
+import fnmatch
+import posixpath
+
+from email.Utils import formatdate
+
+# the canned ACL of the pushed keys unless a rule sets another one
+DEFAULT_ACL = 'public-read'
+
+# the far future expires of the --expires option (days)
+EXPIRES_DAYS = 365 * 2
+
+# the rule options setting a single header
+RULE_HEADERS = {
+    'cache_control': 'Cache-Control',
+    'acl': 'x-amz-acl',
+    'storage_class': 'x-amz-storage-class',
+}
+
+# the rule options
+RULE_OPTIONS = ('match', 'content_type', 'expires', 'metadata', 'headers',) + \
+    tuple(RULE_HEADERS)
+
+
+class HeaderRule(object):
+    """
+    A compiled policy rule.  The rule applies to the files matching one of
+    its globs (file name or the path relative to MEDIA_ROOT) and one of its
+    content types (exact or major type, image/*), a rule without globs or
+    types applies to all.
+    """
+    def __init__(self, num, match=None, content_type=None, expires=None, metadata=None,
+                 headers=None, now=None, **options):
+        self.num = num
+        if isinstance(match, basestring):
+            match = [match]
+        if isinstance(content_type, basestring):
+            content_type = [content_type]
+        self.match_re = None
+        if match:
+            self.match_re = re.compile('|'.join([ '(?:%s)' % fnmatch.translate(p) \
+                                                    for p in match ]))
+        self.content_types = content_type and tuple(content_type) or ()
+
+        self.headers = {}
+        for option, header in RULE_HEADERS.items():
+            if options.get(option):
+                self.headers[header] = options[option]
+        if expires:
+            # the date is formatted once per run
+            self.headers['Expires'] = formatdate((now or time.time()) + expires * 86400,
+                                                 usegmt=True)
+        for name, value in (metadata or {}).items():
+            self.headers['x-amz-meta-%s' % name] = value
+        self.headers.update(headers or {})
+
+    def matches(self, rel_path, name):
+        return self.match_re is None or \
+            bool(self.match_re.match(name) or self.match_re.match(rel_path))
+
+
+class HeaderPolicy(object):
+    """
+    The compiled header policy.  get_headers() returns the upload headers
+    of a file key and content type, the rules are matched without the key
+    prefix.
+    """
+    def __init__(self, rules=(), prefix='', acl=DEFAULT_ACL, now=None):
+        now = now or time.time()
+        self.prefix = prefix or ''
+        self.default_headers = {}
+        if acl:
+            self.default_headers['x-amz-acl'] = acl
+
+        self.rules = []
+        for num, options in enumerate(rules):
+            unknown = [ option for option in options if option not in RULE_OPTIONS ]
+            if unknown:
+                raise ValueError("Unknown header policy options: %s" % ', '.join(unknown))
+            self.rules.append(HeaderRule(num, now=now, **options))
+
+        # the rules by content type, the rules matching any type are checked for every file
+        self.type_rules = {}
+        self.any_type_rules = []
+        for rule in self.rules:
+            if not rule.content_types:
+                self.any_type_rules.append(rule)
+            for content_type in rule.content_types:
+                self.type_rules.setdefault(content_type, []).append(rule)
+        self.merged = {}
+
+    @classmethod
+    def from_settings(cls, rules=(), do_expires=False, prefix=''):
+        """
+        Creates the policy of the AWS_HEADER_POLICY rules.  The --expires
+        option is the first rule, the settings rules override it.
+        """
+        rules = list(rules or ())
+        if do_expires:
+            rules.insert(0, dict(expires=EXPIRES_DAYS,
+                                 cache_control='max-age=%d' % (EXPIRES_DAYS * 86400)))
+        return cls(rules, prefix)
+
+    def get_rules(self, content_type):
+        if not content_type:
+            return self.any_type_rules
+        major_type = content_type.split('/')[0] + '/*'
+        return self.any_type_rules + self.type_rules.get(content_type, []) + \
+            self.type_rules.get(major_type, [])
+
+    def get_headers(self, file_key, content_type=None):
+        """
+        Returns a new dict of the upload headers of the file key.
+        """
+        rel_path = file_key
+        if self.prefix and rel_path.startswith(self.prefix):
+            rel_path = rel_path[len(self.prefix):]
+        name = posixpath.basename(rel_path)
+        matched = tuple(sorted([ rule.num for rule in self.get_rules(content_type) \
+                                    if rule.matches(rel_path, name) ]))
+        headers = self.merged.get(matched)
+        if headers is None:
+            headers = dict(self.default_headers)
+            for num in matched:
+                headers.update(self.rules[num].headers)
+            self.merged[matched] = headers
+
+        headers = dict(headers)
+        if content_type:
+            headers['Content-Type'] = content_type
+        return headers
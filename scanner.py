@@ -0,0 +1,226 @@
+"""
+Parallel media directory scanner for the S3 commands.
+
+Lists the MEDIA_ROOT tree with a pool of threads (directory listings and
+stat calls release the GIL, which matters on NFS mounted media roots).
+Excluded directories are pruned before they are descended and the files
+are streamed with their stat results as soon as they are found.  The
+sorted scan lists the files in the S3 key order for the mirror merge join.
+
+Uses os.scandir (or the scandir backport) when available and falls back
+to os.listdir and os.lstat.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import os
+import re
+import stat
+import fnmatch
+import threading
+
+from Queue import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def compile_patterns(patterns):
+    """
+    Compiles the glob patterns into a single regular expression, or
+    None if there are no patterns.
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join([ '(?:%s)' % fnmatch.translate(p) for p in patterns ]))
+
+
+class MediaScanner(object):
+    """
+    Scans the root directory for files.  The include and exclude glob
+    patterns are matched against both the name and the path relative to
+    the root.  Excluded directories are not descended.
+    """
+    def __init__(self, root, exclude=(), include=(), workers=8, queue_size=1000):
+        self.root = root
+        self.exclude_re = compile_patterns(exclude)
+        self.include_re = compile_patterns(include)
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size
+
+    def is_excluded(self, name, rel_path):
+        return self.exclude_re is not None and \
+            bool(self.exclude_re.match(name) or self.exclude_re.match(rel_path))
+
+    def is_included(self, name, rel_path):
+        return self.include_re is None or \
+            bool(self.include_re.match(name) or self.include_re.match(rel_path))
+
+    def list_dir(self, path):
+        """
+        Yields the (name, is directory, stat result) entries of the directory.
+        The stat result is only looked up for files, only regular files
+        (or links to regular files) are returned.
+        """
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.name, True, None
+                    continue
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    continue
+                if stat.S_ISREG(file_stat.st_mode):
+                    yield entry.name, False, file_stat
+        else:
+            for name in os.listdir(path):
+                filename = os.path.join(path, name)
+                try:
+                    file_stat = os.lstat(filename)
+                    if stat.S_ISDIR(file_stat.st_mode):
+                        yield name, True, None
+                        continue
+                    if stat.S_ISLNK(file_stat.st_mode):
+                        file_stat = os.stat(filename)
+                except OSError:
+                    continue
+                if stat.S_ISREG(file_stat.st_mode):
+                    yield name, False, file_stat
+
+    def scan(self):
+        """
+        Yields (relative path, filename, stat result) for every file found.
+        The files are yielded while the directories are still being listed.
+        The first error of a scan thread (other than an unreadable
+        directory) is raised once the threads have stopped.
+        """
+        dir_queue = Queue()
+        file_queue = Queue(self.queue_size)
+        state = dict(pending=1, errors=[])
+        lock = threading.Lock()
+
+        dir_queue.put('')
+        threads = [ threading.Thread(target=self.scan_worker,
+                        args=(dir_queue, file_queue, state, lock,)) \
+                            for i in xrange(self.workers) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            entry = file_queue.get()
+            if entry is None:
+                break
+            if not state['errors']:
+                yield entry
+
+        for thread in threads:
+            thread.join()
+        if state['errors']:
+            raise state['errors'][0]
+
+    def scan_worker(self, dir_queue, file_queue, state, lock):
+        """
+        Lists the queued directories until the end of scan marker (None).
+        After an error the remaining directories are only counted down, so
+        the scan still ends.
+        """
+        while True:
+            rel_dir = dir_queue.get()
+            if rel_dir is None:
+                break
+            try:
+                if state['errors']:
+                    continue
+                for name, is_dir, file_stat in self.list_dir(os.path.join(self.root, rel_dir)):
+                    rel_path = rel_dir and '/'.join([rel_dir, name]) or name
+                    if self.is_excluded(name, rel_path):
+                        continue
+                    if is_dir:
+                        lock.acquire()
+                        state['pending'] += 1
+                        lock.release()
+                        dir_queue.put(rel_path)
+                    elif self.is_included(name, rel_path):
+                        file_queue.put((rel_path, os.path.join(self.root, rel_path), file_stat,))
+            except OSError:
+                # unreadable directories are skipped, the same as os.walk
+                pass
+            except Exception, e:
+                state['errors'].append(e)
+            finally:
+                lock.acquire()
+                state['pending'] -= 1
+                finished = not state['pending']
+                lock.release()
+
+                if finished:
+                    # the last directory is done, stop the scan and the other threads
+                    file_queue.put(None)
+                    for i in xrange(self.workers):
+                        dir_queue.put(None)
+
+    def is_managed(self, rel_path, is_dir=False):
+        """
+        Returns True if the relative path would be scanned: no directory
+        of the path is excluded and the file is not excluded and included.
+        """
+        parts = rel_path.split('/')
+        for num, name in enumerate(parts):
+            if self.is_excluded(name, '/'.join(parts[:num + 1])):
+                return False
+        return is_dir or self.is_included(parts[-1], rel_path)
+
+    def sorted_scan(self, rel_dir=''):
+        """
+        Yields (relative path, filename, stat result) for every file in the
+        byte order of the relative paths (the S3 listing order), a
+        directory sorts as its name followed by a slash.  Only a single
+        directory listing is held in memory at a time.
+        """
+        entries = []
+        try:
+            for name, is_dir, file_stat in self.list_dir(os.path.join(self.root, rel_dir)):
+                rel_path = rel_dir and '/'.join([rel_dir, name]) or name
+                if self.is_excluded(name, rel_path):
+                    continue
+                if is_dir:
+                    entries.append((rel_path + '/', None,))
+                elif self.is_included(name, rel_path):
+                    entries.append((rel_path, file_stat,))
+        except OSError:
+            return
+
+        entries.sort()
+        for rel_path, file_stat in entries:
+            if file_stat is None:
+                for entry in self.sorted_scan(rel_path[:-1]):
+                    yield entry
+            else:
+                yield rel_path, os.path.join(self.root, rel_path), file_stat
+
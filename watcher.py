@@ -0,0 +1,219 @@
+"""
+Media root watcher for the s3-push watch mode.
+
+Collects the file system changes below the MEDIA_ROOT with inotify (the
+optional pyinotify library) and falls back to polling the tree when it is
+not available.  The events of a path are coalesced into its last action
+and a path is only pushed once it has been quiet for the debounce delay,
+so a burst of writes results in a single upload.
+
+Copyright (c) 2010 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+import time
+
+# optional inotify library, the tree is polled without it
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# the change actions: upload a file, delete a file (and its variants), delete
+# the keys below a removed directory and push the whole tree again
+ACTIONS = ('put', 'delete', 'delete_dir', 'rescan',)
+
+# seconds a path must be quiet before it is pushed, the longest a busy
+# path waits and the seconds between the polls of the tree
+DEBOUNCE = 0.5
+MAX_DELAY = 2.0
+POLL_INTERVAL = 2.0
+
+# seconds between the checks for ready changes
+TICK = 0.1
+
+if pyinotify is not None:
+    WATCH_MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+        pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+
+    class WatchHandler(pyinotify.ProcessEvent):
+        """
+        Passes the inotify events to the watcher.
+        """
+        def my_init(self, watcher=None):
+            self.watcher = watcher
+
+        def process_default(self, event):
+            self.watcher.handle_event(event)
+
+
+class MediaWatcher(object):
+    """
+    Watches the root directory of the scanner.  changes() yields the lists
+    of (action, relative path) changes that are ready to push.  The files
+    and directories left out by the scanner patterns are ignored.
+    """
+    def __init__(self, scanner, delay=DEBOUNCE, max_delay=MAX_DELAY,
+                 poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.scanner = scanner
+        self.root = scanner.root
+        if not self.root.endswith('/'):
+            self.root += '/'
+        self.delay = delay
+        self.max_delay = max(max_delay, delay)
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and pyinotify is not None
+        self.pending = {}
+        self.notifier = None
+        self.snapshot = None
+        self.last_poll = 0
+
+    def start(self):
+        """
+        Starts watching the tree.  The changes made from here on are
+        reported by changes().
+        """
+        if self.use_inotify:
+            watch_manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(watch_manager, WatchHandler(watcher=self),
+                                               timeout=int(TICK * 1000))
+            watch_manager.add_watch(self.root, WATCH_MASK, rec=True, auto_add=True,
+                                    exclude_filter=self.is_excluded_dir)
+        else:
+            # a polled file is only pushed once a poll has seen it unchanged
+            self.delay = max(self.delay, self.poll_interval)
+            self.max_delay = max(self.max_delay, self.delay)
+            self.snapshot = self.take_snapshot()
+            self.last_poll = time.time()
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+    def get_rel_path(self, path):
+        if path.startswith(self.root):
+            return path[len(self.root):]
+        return None
+
+    def is_excluded_dir(self, path):
+        rel_path = self.get_rel_path(path.rstrip('/') + '/')
+        if rel_path is None:
+            return True
+        return bool(rel_path) and not self.scanner.is_managed(rel_path.rstrip('/'), is_dir=True)
+
+    def add(self, action, rel_path, now=None):
+        """
+        Records the change of the path, the last action of a path wins.
+        """
+        if now is None:
+            now = time.time()
+        if action == 'delete_dir':
+            # the keys below the directory are deleted with it
+            dir_prefix = rel_path + '/'
+            for pending_path in self.pending.keys():
+                if pending_path.startswith(dir_prefix):
+                    del self.pending[pending_path]
+        entry = self.pending.get(rel_path)
+        if entry is None:
+            self.pending[rel_path] = [action, now, now]
+        else:
+            entry[0] = action
+            entry[2] = now
+
+    def add_dir(self, rel_dir, now=None):
+        """
+        Records the files of a new or moved in directory, the files may
+        have been written before its watch was added.
+        """
+        for rel_path, filename, file_stat in self.scanner.sorted_scan(rel_dir):
+            self.add('put', rel_path, now)
+
+    def handle_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            # events were lost, the whole tree is checked again
+            self.add('rescan', '')
+            return
+        rel_path = self.get_rel_path(event.pathname)
+        if not rel_path or not self.scanner.is_managed(rel_path, is_dir=event.dir):
+            return
+
+        if event.dir:
+            if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                self.add_dir(rel_path)
+            elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                self.add('delete_dir', rel_path)
+        elif event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO):
+            self.add('put', rel_path)
+        elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            self.add('delete', rel_path)
+
+    def take_snapshot(self):
+        """
+        Returns the (size, mtime) of every file of the tree.
+        """
+        return dict([ (rel_path, (file_stat.st_size, file_stat.st_mtime,)) \
+                        for rel_path, filename, file_stat in self.scanner.scan() ])
+
+    def poll(self, now):
+        """
+        Compares the tree against the last snapshot (polling fallback).
+        """
+        snapshot = self.take_snapshot()
+        for rel_path, file_info in snapshot.iteritems():
+            if self.snapshot.get(rel_path) != file_info:
+                self.add('put', rel_path, now)
+        for rel_path in self.snapshot:
+            if rel_path not in snapshot:
+                self.add('delete', rel_path, now)
+        self.snapshot = snapshot
+        self.last_poll = now
+
+    def pop_ready(self, now):
+        """
+        Returns and removes the changes quiet for the debounce delay (or
+        waiting for the longest delay).  The rescan comes first, then the
+        directory deletes.
+        """
+        ready = [ (entry[0], rel_path,) for rel_path, entry in self.pending.iteritems() \
+                    if now - entry[2] >= self.delay or now - entry[1] >= self.max_delay ]
+        ready.sort(key=lambda change: -ACTIONS.index(change[0]))
+        for action, rel_path in ready:
+            del self.pending[rel_path]
+        return ready
+
+    def changes(self):
+        """
+        Yields the lists of ready changes until stopped.
+        """
+        while True:
+            if self.notifier is not None:
+                if self.notifier.check_events():
+                    self.notifier.read_events()
+                    self.notifier.process_events()
+            else:
+                if time.time() - self.last_poll >= self.poll_interval:
+                    self.poll(time.time())
+                time.sleep(TICK)
+
+            ready = self.pop_ready(time.time())
+            if ready:
+                yield ready